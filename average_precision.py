@@ -54,4 +54,115 @@ def mapk(actual, predicted, k=10):
     score : double
             The mean average precision at k over the input lists
     """
-    return np.mean([apk(a,p,k) for a,p in zip(actual, predicted)])
\ No newline at end of file
+    return np.mean([apk(a,p,k) for a,p in zip(actual, predicted)])
+
+def to_csr(lists):
+    """
+    Packs a list of lists of elements into the CSR form.
+    Parameters
+    ----------
+    lists : list
+            A list of lists of elements
+    Returns
+    -------
+    offsets : numpy.ndarray
+              The positions of the lists starts in ``ids`` (the length
+              is the number of lists plus one)
+    ids : numpy.ndarray
+          The concatenated elements of the lists
+    """
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(items) for items in lists], out=offsets[1:])
+    ids = np.fromiter((item for items in lists for item in items), dtype=np.int64, count=offsets[-1])
+    return offsets, ids
+
+def apk_csr(actual_offsets, actual_ids, predicted_offsets, predicted_ids, k=10):
+    """
+    Computes the average precision at k for every user in one batched pass.
+    This function gives the same results as ``apk`` applied to each pair of
+    lists, but takes the lists packed into the CSR form (see ``to_csr``).
+    The lists are paired by position, as ``zip`` does in ``mapk``.
+    Parameters
+    ----------
+    actual_offsets : numpy.ndarray
+                     The starts of the actual lists in ``actual_ids``
+    actual_ids : numpy.ndarray
+                 The concatenated elements that are to be predicted
+                 (order doesn't matter in the lists)
+    predicted_offsets : numpy.ndarray
+                        The starts of the predicted lists in ``predicted_ids``
+    predicted_ids : numpy.ndarray
+                    The concatenated predicted elements
+                    (order matters in the lists)
+    k : int, optional
+        The maximum number of predicted elements
+    Returns
+    -------
+    scores : numpy.ndarray
+             The average precision at k of every pair of lists
+    """
+    actual_offsets = np.asarray(actual_offsets, dtype=np.int64)
+    predicted_offsets = np.asarray(predicted_offsets, dtype=np.int64)
+    actual_ids = np.asarray(actual_ids, dtype=np.int64)
+    predicted_ids = np.asarray(predicted_ids, dtype=np.int64)
+    users = min(len(actual_offsets), len(predicted_offsets)) - 1
+    if users <= 0:
+        return np.zeros(0)
+    actual_offsets = actual_offsets[:users + 1]
+    predicted_offsets = predicted_offsets[:users + 1]
+
+    # Only the first k predicted elements of every list are taken into account
+    predicted_sizes = np.minimum(np.diff(predicted_offsets), k)
+    segment_starts = np.cumsum(predicted_sizes) - predicted_sizes
+    predicted_users = np.repeat(np.arange(users), predicted_sizes)
+    positions = np.arange(len(predicted_users)) - np.repeat(segment_starts, predicted_sizes)
+    predicted_ids = predicted_ids[np.repeat(predicted_offsets[:-1], predicted_sizes) + positions]
+
+    # Pairs (user, element) are encoded into single keys to look them up in all lists at once
+    actual_sizes = np.diff(actual_offsets)
+    actual_users = np.repeat(np.arange(users), actual_sizes)
+    actual_ids = actual_ids[actual_offsets[0]:actual_offsets[-1]]
+    shift = min(actual_ids.min(initial=0), predicted_ids.min(initial=0))
+    base = max(actual_ids.max(initial=0), predicted_ids.max(initial=0)) - shift + 1
+    actual_keys = actual_users * base + (actual_ids - shift)
+    predicted_keys = predicted_users * base + (predicted_ids - shift)
+
+    # An element is a hit if it is actual and is met in the prediction for the first time
+    hits = np.isin(predicted_keys, actual_keys)
+    first = np.zeros(len(predicted_keys), dtype=bool)
+    first[np.unique(predicted_keys, return_index=True)[1]] = True
+    hits &= first
+
+    # Number of hits up to every position inside its own list
+    cumulative_hits = np.concatenate(([0], np.cumsum(hits)))
+    num_hits = cumulative_hits[1:] - np.repeat(cumulative_hits[segment_starts], predicted_sizes)
+
+    scores = np.bincount(predicted_users, weights=np.where(hits, num_hits / (positions + 1.0), 0.0),
+                         minlength=users)
+    scores[actual_sizes > 0] /= np.minimum(actual_sizes[actual_sizes > 0], k)
+    scores[actual_sizes == 0] = 0.0
+    return scores
+
+def mapk_csr(actual_offsets, actual_ids, predicted_offsets, predicted_ids, k=10):
+    """
+    Computes the mean average precision at k in one batched pass.
+    This function gives the same result as ``mapk``, but takes the lists
+    packed into the CSR form (see ``apk_csr``).
+    Parameters
+    ----------
+    actual_offsets : numpy.ndarray
+                     The starts of the actual lists in ``actual_ids``
+    actual_ids : numpy.ndarray
+                 The concatenated elements that are to be predicted
+    predicted_offsets : numpy.ndarray
+                        The starts of the predicted lists in ``predicted_ids``
+    predicted_ids : numpy.ndarray
+                    The concatenated predicted elements
+    k : int, optional
+        The maximum number of predicted elements
+    Returns
+    -------
+    score : double
+            The mean average precision at k over the input lists
+    """
+    return np.mean(apk_csr(actual_offsets, actual_ids, predicted_offsets, predicted_ids, k))
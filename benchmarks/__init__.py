@@ -0,0 +1,10 @@
+"""
+Benchmarks of the model on synthetic Instacart-like transaction logs.
+
+Run from the repository folder:
+
+    python -m benchmarks --users 10000 100000 --output benchmarks.json
+"""
+
+from benchmarks.generator import generate_instacart
+from benchmarks.suite import run_benchmarks, save_results
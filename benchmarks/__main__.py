@@ -0,0 +1,36 @@
+import argparse
+import time
+from benchmarks.suite import run_benchmarks, save_results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the model on synthetic transaction logs.')
+    parser.add_argument('--users', type=int, nargs='+', default=[10000], help='Numbers of users of the logs.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the log generator.')
+    parser.add_argument('--k', type=int, default=10, help='Size of the recommendations.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of parallel workers of the fitting.')
+    parser.add_argument('--executor', default='serial', help="Executor of the fitting: 'process', 'thread', 'serial'.")
+    parser.add_argument('--dtypes', default='compact', help="Dtype policy: 'compact' or 'wide'.")
+    parser.add_argument('--single_users', type=int, default=1000, help='Number of single-user recommendations.')
+    parser.add_argument('--searches', nargs='*', default=['joint'],
+                        help="Rate search strategies compared with the grid search: 'golden', 'refine', 'joint'.")
+    parser.add_argument('--output', default='benchmarks.json', help='Path to the JSON file of the results.')
+
+    args = parser.parse_args()
+
+    runs = [run_benchmarks(n_users, args.seed, args.k, args.workers, args.executor, args.dtypes, args.single_users,
+                           tuple(args.searches))
+            for n_users in args.users]
+    save_results(args.output, runs)
+
+    for run in runs:
+        print('-----------------------------------------------------------------')
+        print(f'{run["scale"]["users"]} users, {run["scale"]["transactions"]} transactions:')
+        for stage in run['stages']:
+            print(f'{stage["stage"]:>32}: {stage["seconds"]:9.3f} s, {stage["rows_per_second"] or 0:12.0f} rows/s, '
+                  f'peak RSS {stage["peak_rss_mb"]:8.1f} MB')
+        for search, result in run['rate_searches'].items():
+            evaluations = sum(count for count in result['evaluations'].values() if count is not None)
+            print(f'{search + " rate search":>32}: {result["seconds"]:9.3f} s, {evaluations:4d} evaluations, '
+                  f'MAP@10={result["map10"]:.5f}')
+    print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: results saved to {args.output}.')
@@ -0,0 +1,91 @@
+"""
+Generator of synthetic transaction logs shaped like the Instacart dataset.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def get_days_probabilities(monthly_share: float = 0.12) -> np.ndarray:
+    """
+    Returns the distribution of the number of days since the prior order: rising during the first week and decaying
+    after it with weekly peaks, and a peak at 30 days, which caps the longer intervals in the Instacart log.
+    :param monthly_share: share of the orders 30 or more days after the prior order.
+    :return: probabilities of 0, 1, ..., 30 days.
+    """
+
+    days = np.arange(30)
+    probabilities = (days + 1) * np.exp(-days / 5) * np.where((days > 0) & (days % 7 == 0), 2., 1.)
+    probabilities *= (1 - monthly_share) / probabilities.sum()
+    return np.append(probabilities, monthly_share)
+
+
+def generate_instacart(n_users: int = 10000, n_products: int = 49688, n_aisles: int = 134,
+                       n_departments: int = 21, reorder_share: float = 0.6,
+                       seed: int = 0) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Generates a products registry and a transaction log with Instacart-like distributions:
+    - 4-100 orders per user (3 plus a geometric number with the mean of 14);
+    - basket sizes of 1-145 products (1 plus a negative binomial number with the mean of 9), unique inside an order;
+    - 0-30 days since the prior order with weekly peaks (missing for the first order);
+    - Zipf-like product popularity and aisles of uneven sizes;
+    - reorders of the user's favourite products, the rest drawn by the global popularity.
+    :param n_users: number of users.
+    :param n_products: number of products.
+    :param n_aisles: number of aisles.
+    :param n_departments: number of departments.
+    :param reorder_share: share of the products taken from the user's favourites.
+    :param seed: seed of the random generator.
+    :return: products registry with columns ``product_id``, ``product_name``, ``aisle_id``, ``department_id``,
+    and transaction log with columns ``user_id``, ``order_number``, ``days_since_prior_order``, ``product_id``,
+    ``add_to_cart_order``.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Products
+    aisle_ids = rng.choice(n_aisles, n_products, p=rng.dirichlet(np.full(n_aisles, 2.))) + 1
+    aisle_departments = rng.integers(1, n_departments + 1, n_aisles + 1)
+    product_ids = np.arange(1, n_products + 1)
+    products = pd.DataFrame({
+        'product_id': product_ids,
+        'product_name': [f'Product {product_id}' for product_id in product_ids],
+        'aisle_id': aisle_ids,
+        'department_id': aisle_departments[aisle_ids],
+    })
+    popularity = 1 / rng.permutation(product_ids) ** 0.9
+    popularity /= popularity.sum()
+
+    # Orders
+    orders = np.minimum(3 + rng.geometric(1 / 14, n_users), 100)
+    order_users = np.repeat(np.arange(1, n_users + 1), orders)
+    order_numbers = np.arange(len(order_users)) - np.repeat(np.cumsum(orders) - orders, orders) + 1
+    days = rng.choice(31, len(order_users), p=get_days_probabilities()).astype(np.float64)
+    days[order_numbers == 1] = np.nan
+    basket_sizes = np.minimum(1 + rng.negative_binomial(2, 2 / 11, len(order_users)), 145)
+
+    # Products of the orders: favourites of the users or popular products
+    favourite_sizes = rng.integers(5, 60, n_users)
+    favourite_offsets = np.cumsum(favourite_sizes) - favourite_sizes
+    favourites = rng.choice(n_products, favourite_sizes.sum(), p=popularity) + 1
+    item_orders = np.repeat(np.arange(len(order_users)), basket_sizes)
+    item_users = order_users[item_orders] - 1
+    favourite_items = favourite_offsets[item_users] + \
+        (rng.random(len(item_orders)) * favourite_sizes[item_users]).astype(np.int64)
+    item_products = np.where(rng.random(len(item_orders)) < reorder_share, favourites[favourite_items],
+                             rng.choice(n_products, len(item_orders), p=popularity) + 1)
+
+    # Products are unique inside an order, the cart order is counted over the remaining ones
+    _, first = np.unique(item_orders.astype(np.int64) * (n_products + 1) + item_products, return_index=True)
+    kept = np.zeros(len(item_orders), dtype=bool)
+    kept[first] = True
+    item_orders, item_products = item_orders[kept], item_products[kept]
+    starts = np.searchsorted(item_orders, item_orders)
+    transactions = pd.DataFrame({
+        'user_id': order_users[item_orders],
+        'order_number': order_numbers[item_orders],
+        'days_since_prior_order': days[item_orders],
+        'product_id': item_products,
+        'add_to_cart_order': np.arange(len(item_orders)) - starts + 1,
+    })
+    return products, transactions
@@ -0,0 +1,182 @@
+"""
+Benchmarks of the hot paths of the model fitting and the recommendations.
+"""
+
+import contextlib
+import io
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from os import PathLike
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import functions as f
+from average_precision import mapk, mapk_csr, to_csr
+from profiler import RSSMonitor, Profiler
+from recommender import Recommender
+from segments import Segments
+from benchmarks.generator import generate_instacart
+
+
+def measure(results: list[dict], stage: str, rows: int, func, *args, **kwargs):
+    """
+    Runs the benchmarked stage and appends its measurements to the results.
+    :param results: list of the measurements of the stages.
+    :param stage: stage name.
+    :param rows: number of rows (transactions, ratings, users, calls) processed by the stage.
+    :param func: function of the stage.
+    :param args: positional arguments of the function.
+    :param kwargs: keyword arguments of the function.
+    :return: result of the function.
+    """
+
+    print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: benchmarking `{stage}`...')
+    with RSSMonitor() as monitor:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    results.append({
+        'stage': stage,
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_second': rows / seconds if seconds > 0 else None,
+        'peak_rss_mb': monitor.peak_rss / 2 ** 20,
+        'rss_growth_mb': (monitor.peak_rss - monitor.start_rss) / 2 ** 20,
+    })
+    return result
+
+
+def recommend_users(model: Recommender, user_ids: list[int], k: int = 10):
+    """
+    Generates recommendations for users one by one (the progress output of the model is suppressed).
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for user_id in user_ids:
+            model.recommend(user_id, k)
+
+
+def get_rate_search(model: Recommender, seconds: float) -> dict:
+    """
+    Describes the rate search of the fitted model: duration of the fitting, numbers of MAP@10 evaluations,
+    the found rates and MAP@10 of the predictions filtered by all of them.
+    """
+
+    return {
+        'seconds': seconds,
+        'evaluations': {filtering: model.get_evaluations(filtering)
+                        for filtering in ('days', 'cart', 'total', 'joint')},
+        'rates': {filtering: model.get_rate(filtering) for filtering in ('days', 'cart', 'total')},
+        'map10': model.get_eval_map10('total'),
+    }
+
+
+def run_benchmarks(n_users: int = 10000, seed: int = 0, k: int = 10, workers: int = 1,
+                   executor: str = 'serial', dtypes: str = 'compact', single_users: int = 1000,
+                   searches: tuple[str, ...] = ('joint',)) -> dict:
+    """
+    Benchmarks the stages of the model on a synthetic transaction log (see ``generator.generate_instacart``).
+    :param n_users: number of users of the log.
+    :param seed: seed of the log generator.
+    :param k: size of the recommendations.
+    :param workers: number of parallel workers of the model fitting.
+    :param executor: executor of the model fitting (see ``multiproc.get_executor``).
+    :param dtypes: dtype policy of the transactions (see ``functions.DTYPE_POLICIES``).
+    :param single_users: number of single-user recommendation calls.
+    :param searches: rate search strategies compared with the sequential grid search
+    (see the ``search`` argument of ``Recommender.fit``).
+    :return: scale of the log and the measurements of the stages: duration, number of processed rows,
+    throughput, peak resident set size of the process and its growth during the stage,
+    the report of the profiler of the model fitting (see ``profiler.Profiler``)
+    and the comparison of the rate search strategies (see ``get_rate_search``).
+    """
+
+    products, transactions = generate_instacart(n_users, seed=seed)
+    results = []
+
+    prior_transactions, last_transactions, last_products = measure(
+        results, 'preprocess_transactions', len(transactions),
+        f.preprocess_transactions, transactions.copy(), dtypes)
+    weights = measure(results, 'get_weights', len(prior_transactions),
+                      f.get_weights, prior_transactions, 0.005, 0.03, dtypes=dtypes)
+    measure(results, 'get_ratings', len(weights), f.get_ratings, weights, 0.5)
+    ratings = measure(results, 'get_sparse_ratings', len(weights), f.get_sparse_ratings, weights, 0.5)
+    prediction = measure(results, 'get_prediction', ratings.nnz,
+                         f.get_prediction, ratings, k, 'partition')
+    aisle_ranks = f.get_aisle_ranks(ratings, products)
+    inside_aisle_ranks = f.get_inside_aisle_ranks(ratings, products)
+    segments = Segments.from_frame(prediction)
+    measure(results, 'fill_in_prediction', ratings.n_users,
+            f.fill_in_prediction, prediction, aisle_ranks, inside_aisle_ranks, k, segments=segments)
+    predicted = f.get_prediction_csr(prediction, segments)
+    predicted_lists = np.split(predicted[1], predicted[0][1:-1])
+    measure(results, 'mapk', len(last_products), mapk, last_products, predicted_lists, k)
+    measure(results, 'mapk_csr', len(last_products), mapk_csr, *to_csr(last_products), *predicted, k)
+
+    model = Recommender()
+    report = measure(results, 'Recommender.fit', len(transactions),
+                     model.fit, products, transactions.copy(), workers, executor, dtypes, Profiler())
+    rate_searches = {'grid': get_rate_search(model, results[-1]['seconds'])}
+    measure(results, 'Recommender.recommend', len(model.users), model.recommend, None, k)
+    user_ids = model.users[:single_users]
+    measure(results, 'Recommender.recommend(user_id)', len(user_ids), recommend_users, model, user_ids, k)
+    recommendations = model.recommend(None, k, ids_only=True, verbose=False)
+    with tempfile.TemporaryDirectory() as dir_path:
+        measure(results, 'save_kaggle_submission_csv', len(recommendations),
+                f.save_kaggle_submission_csv, recommendations, Path(dir_path) / 'submission.csv')
+
+    for search in searches:
+        model = Recommender()
+        measure(results, f'Recommender.fit(search={search})', len(transactions),
+                model.fit, products, transactions.copy(), workers, executor, dtypes, None, search)
+        rate_searches[search] = get_rate_search(model, results[-1]['seconds'])
+
+    return {
+        'scale': {
+            'users': n_users,
+            'products': len(products),
+            'transactions': len(transactions),
+            'prior_transactions': len(prior_transactions),
+            'last_transactions': len(last_transactions),
+        },
+        'settings': {'seed': seed, 'k': k, 'workers': workers, 'executor': executor, 'dtypes': dtypes},
+        'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'stages': results,
+        'fit_stages': report.to_dicts(),
+        'rate_searches': rate_searches,
+    }
+
+
+def get_environment() -> dict:
+    """
+    Describes the version of the code and the environment of the benchmarks.
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time())),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+    }
+
+
+def save_results(path: str | PathLike, runs: list[dict]):
+    """
+    Saves the results of the benchmarks into a JSON file together with the environment description.
+    :param path: path to the file.
+    :param runs: results of ``run_benchmarks`` at different scales.
+    """
+
+    with open(path, 'w') as fp:
+        json.dump({'environment': get_environment(), 'runs': runs}, fp, indent=2)
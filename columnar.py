@@ -0,0 +1,142 @@
+"""
+Columnar storage of tables.
+
+Every column is written as a raw little-endian array into a separate binary file,
+and a small JSON manifest describes the data types and shapes of the columns.
+String columns are written as UTF-8 encoded bytes with the offsets of the strings in a second file.
+The columns are opened by memory mapping, so several processes reading the same table
+share a single copy of it in the page cache.
+"""
+
+import json
+from os import PathLike
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+def save_columns(path: str | PathLike, columns: dict[str, np.ndarray] | pd.DataFrame, attrs: dict | None = None):
+    """
+    Saves columns into the folder in the columnar format.
+    :param path: path to the table folder.
+    :param columns: mapping of column names to numeric arrays (of any shape) or 1D string arrays,
+    or a dataframe with such columns.
+    :param attrs: additional JSON-serializable attributes of the table.
+    """
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if isinstance(columns, pd.DataFrame):
+        columns = {column: columns[column].to_numpy() for column in columns.columns}
+
+    manifest = {'version': FORMAT_VERSION, 'columns': {}, 'attrs': attrs or {}}
+    for name, values in columns.items():
+        values = np.ascontiguousarray(values)
+        if values.dtype.kind in 'OU':
+            encoded = [str(value).encode() for value in values]
+            offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            np.frombuffer(b''.join(encoded), dtype=np.uint8).tofile(path / f'{name}.bin')
+            offsets.tofile(path / f'{name}.offsets.bin')
+            manifest['columns'][name] = {'dtype': 'str', 'shape': list(values.shape)}
+            continue
+        if values.dtype.kind not in 'biuf':
+            raise TypeError(f'Column `{name}` has unsupported type {values.dtype}.')
+        values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+        values.tofile(path / f'{name}.bin')
+        manifest['columns'][name] = {'dtype': values.dtype.str, 'shape': list(values.shape)}
+
+    with open(path / MANIFEST_FILE, 'w') as fp:
+        json.dump(manifest, fp)
+
+
+def append_columns(path: str | PathLike, columns: dict[str, np.ndarray] | pd.DataFrame):
+    """
+    Appends rows to a table in the columnar format (the table is created if it does not exist),
+    so a table larger than memory can be written in parts.
+    :param path: path to the table folder.
+    :param columns: mapping of column names to 1D numeric arrays, or a dataframe with such columns.
+    The columns have to match the columns of the table, and their values have to be safely castable
+    to the types of the table columns.
+    """
+
+    path = Path(path)
+    if not is_columnar(path):
+        save_columns(path, columns)
+        return
+    if isinstance(columns, pd.DataFrame):
+        columns = {column: columns[column].to_numpy() for column in columns.columns}
+
+    with open(path / MANIFEST_FILE) as fp:
+        manifest = json.load(fp)
+    if set(columns) != set(manifest['columns']):
+        raise ValueError(f'Columns {sorted(columns)} do not match the table columns {sorted(manifest["columns"])}.')
+    for name, values in columns.items():
+        spec = manifest['columns'][name]
+        if spec['dtype'] == 'str' or len(spec['shape']) != 1:
+            raise TypeError(f'Rows cannot be appended to column `{name}`.')
+        dtype = np.dtype(spec['dtype'])
+        if not np.can_cast(values.dtype, dtype, 'safe'):
+            raise TypeError(f'Column `{name}` of type {values.dtype} cannot be appended to {dtype}.')
+    for name, values in columns.items():
+        spec = manifest['columns'][name]
+        with open(path / f'{name}.bin', 'ab') as fp:
+            np.ascontiguousarray(values, dtype=spec['dtype']).tofile(fp)
+        spec['shape'][0] += len(values)
+
+    # The manifest is updated last, so the table is never described beyond the written rows
+    with open(path / MANIFEST_FILE, 'w') as fp:
+        json.dump(manifest, fp)
+
+
+def load_columns(path: str | PathLike, mmap: bool = True) -> (dict[str, np.ndarray], dict):
+    """
+    Loads columns saved by ``save_columns``.
+    :param path: path to the table folder.
+    :param mmap: map the numeric column files into memory (read-only) instead of reading them.
+    :return: mapping of column names to arrays and the additional attributes of the table.
+    """
+
+    path = Path(path)
+    with open(path / MANIFEST_FILE) as fp:
+        manifest = json.load(fp)
+    if manifest['version'] > FORMAT_VERSION:
+        raise ValueError(f'Unsupported columnar format version {manifest["version"]}.')
+
+    columns = {}
+    for name, spec in manifest['columns'].items():
+        file_path = path / f'{name}.bin'
+        if spec['dtype'] == 'str':
+            data = file_path.read_bytes()
+            offsets = np.fromfile(path / f'{name}.offsets.bin', dtype='<i8').tolist()
+            columns[name] = np.array([data[start:end].decode() for start, end in zip(offsets[:-1], offsets[1:])],
+                                     dtype=object)
+            continue
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        if not mmap or np.prod(shape) == 0:
+            columns[name] = np.fromfile(file_path, dtype=dtype).reshape(shape)
+        else:
+            columns[name] = np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+    return columns, manifest['attrs']
+
+
+def is_columnar(path: str | PathLike) -> bool:
+    """
+    Checks whether the folder contains a table in the columnar format.
+    :param path: path to the table folder.
+    """
+
+    return (Path(path) / MANIFEST_FILE).exists()
+
+
+def columns_to_frame(columns: dict[str, np.ndarray]) -> pd.DataFrame:
+    """
+    Wraps columns into a dataframe without copying them.
+    :param columns: mapping of column names to 1D arrays.
+    :return: dataframe.
+    """
+
+    return pd.DataFrame(columns, copy=False)
@@ -1,8 +1,82 @@
-from typing import Union
+import gzip
+import shutil
+import tempfile
+from os import PathLike
+from pathlib import Path
+from typing import Iterable, Union
 import numpy as np
 from numpy.polynomial.polynomial import polyfit, polyval, polyder, polyroots
 import pandas as pd
-from average_precision import apk, mapk
+from average_precision import apk, apk_csr, mapk_csr, to_csr
+from sparse_ratings import SparseRatings, RatingsHistogram, JointRatingsHistogram, get_offsets, \
+    expand_segments, rank_segments, segment_top_k, check_top_k
+from segments import Segments, FillIndex, UserIndex
+from columnar import save_columns, append_columns, load_columns, columns_to_frame, is_columnar
+
+
+# Types of the transaction and weight columns by dtype policies:
+# - ``wide`` - ``int64`` columns and ``float64`` weights.
+# - ``compact`` - the narrowest types fitting the values of the Instacart log
+#   (the columns missing in a policy are ``int64``).
+DTYPE_POLICIES = {
+    'wide': {
+        'weight': np.float64,
+    },
+    'compact': {
+        'user_id': np.uint32,
+        'product_id': np.uint32,
+        'order_number': np.uint16,
+        'days_since_prior_order': np.uint16,
+        'days_before_last_order': np.uint16,
+        'days_before_last_order_shift': np.uint16,
+        'add_to_cart_order': np.uint8,
+        'weight': np.float32,
+    },
+}
+
+
+def get_dtype(column: str, dtypes: str = 'compact') -> np.dtype:
+    """
+    Returns the type of the column by the dtype policy.
+    :param column: column name.
+    :param dtypes: dtype policy (see ``DTYPE_POLICIES``).
+    :return: column type.
+    """
+
+    if dtypes not in DTYPE_POLICIES:
+        raise ValueError(f'Unknown dtype policy `{dtypes}`.')
+    return np.dtype(DTYPE_POLICIES[dtypes].get(column, np.float64 if column == 'weight' else np.int64))
+
+
+def get_checked_dtype(values: pd.Series, column: str, dtypes: str = 'compact') -> np.dtype:
+    """
+    Returns the type of the column by the dtype policy and checks that the column values fit into it.
+    :param values: column values.
+    :param column: column name.
+    :param dtypes: dtype policy (see ``DTYPE_POLICIES``).
+    :return: column type.
+    :raise OverflowError: if the values do not fit into the type.
+    """
+
+    dtype = get_dtype(column, dtypes)
+    if dtype.kind in 'iu' and dtype.itemsize < 8 and len(values):
+        info = np.iinfo(dtype)
+        if values.min() < info.min or values.max() > info.max:
+            raise OverflowError(f'Values of column `{column}` do not fit into {dtype} of the `{dtypes}` dtype policy.')
+    return dtype
+
+
+def cast_transactions(transactions: pd.DataFrame, dtypes: str = 'compact') -> pd.DataFrame:
+    """
+    Casts the columns of transactions to the types by the dtype policy.
+    :param transactions: the transaction log of product purchases with integer values.
+    :param dtypes: dtype policy (see ``DTYPE_POLICIES``).
+    :return: the transaction log with cast columns.
+    :raise OverflowError: if the values of a column do not fit into its type.
+    """
+
+    return transactions.astype({column: get_checked_dtype(transactions[column], column, dtypes)
+                                for column in transactions.columns})
 
 
 def approximate_precision_by_rate(rates: np.array, precisions: np.array, deg=3):
@@ -20,11 +94,12 @@ def approximate_precision_by_rate(rates: np.array, precisions: np.array, deg=3):
     approx_precisions = polyval(rates, coefs)
     derivative_coefs = polyder(coefs)
     derivative_roots = polyroots(derivative_coefs)
-    best_rate_candidates = derivative_roots[
+    # The maximum on the segment is at a critical point inside it or at one of the extreme points
+    best_rate_candidates = np.concatenate([derivative_roots[
         (derivative_roots.real >= rates.min()) &
         (derivative_roots.real <= rates.max()) &
         (derivative_roots.imag == 0.0)
-        ].real
+        ].real, [rates.min(), rates.max()]])
 
     best_rate_candidate_values = polyval(best_rate_candidates, coefs)
     best_rate = best_rate_candidates[best_rate_candidate_values.argmax()]
@@ -32,7 +107,167 @@ def approximate_precision_by_rate(rates: np.array, precisions: np.array, deg=3):
     return approx_precisions, best_rate
 
 
-def preprocess_transactions(transactions: pd.DataFrame) -> [pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+# Methods of the optimal filter coefficient search:
+# - ``grid`` - evaluation of a fixed grid and the maximum of its polynomial approximation
+#   (see ``approximate_precision_by_rate``).
+# - ``golden`` - golden-section search evaluating one value per iteration.
+# - ``refine`` - successive refinement of the grid around its best value evaluating a batch of values
+#   per iteration in parallel.
+RATE_SEARCH_METHODS = ('grid', 'golden', 'refine')
+
+GOLDEN_RATIO = (np.sqrt(5.) - 1.) / 2.
+
+
+def search_rate_golden(evaluate, start: float, stop: float, tolerance: float) -> pd.Series:
+    """
+    Searches for the maximum of the accuracy of predictions on the segment of the filter coefficient values
+    by the golden-section search. The accuracy is supposed to be unimodal on the segment.
+    :param evaluate: function calculating the accuracy at an array of the coefficient values
+    (returns Pandas Series indexed by the values).
+    :param start: start of the segment.
+    :param stop: end of the segment.
+    :param tolerance: the search stops when the maximum is bracketed within ``tolerance`` around the best value.
+    :return: Pandas Series with the accuracy at all evaluated values ordered by the values.
+    """
+
+    precisions = evaluate(np.array([stop - GOLDEN_RATIO * (stop - start), start + GOLDEN_RATIO * (stop - start)]))
+    left, right = precisions.index
+    while stop - start > 2 * tolerance:
+        if precisions[left] >= precisions[right]:
+            stop, right = right, left
+            left = stop - GOLDEN_RATIO * (stop - start)
+            rate = left
+        else:
+            start, left = left, right
+            right = start + GOLDEN_RATIO * (stop - start)
+            rate = right
+        precisions = pd.concat([precisions, evaluate(np.array([rate]))])
+    return precisions.sort_index()
+
+
+def search_rate_refine(evaluate, start: float, stop: float, tolerance: float, batch: int = 2) -> pd.Series:
+    """
+    Searches for the maximum of the accuracy of predictions on the segment of the filter coefficient values
+    by the successive refinement of the grid: every iteration evaluates a batch of values between the best value
+    and its neighbours, so the batch can be evaluated in parallel.
+    :param evaluate: function calculating the accuracy at an array of the coefficient values
+    (returns Pandas Series indexed by the values).
+    :param start: start of the segment.
+    :param stop: end of the segment.
+    :param tolerance: the search stops when the maximum is bracketed within ``tolerance`` around the best value.
+    :param batch: number of values evaluated per iteration (e.g. the number of parallel workers).
+    :return: Pandas Series with the accuracy at all evaluated values ordered by the values.
+    """
+
+    batch = max(batch, 2)
+    precisions = evaluate(np.linspace(start, stop, batch + 2)).sort_index()
+    while True:
+        rates = precisions.index.to_numpy()
+        best = precisions.to_numpy().argmax()
+        left, right = rates[max(best - 1, 0)], rates[min(best + 1, len(rates) - 1)]
+        if right - left <= 2 * tolerance:
+            break
+        # Every side of the best value gets its share of the batch (the whole batch if the other side is empty)
+        sides = [(left, rates[best]), (rates[best], right)]
+        sides = [(side_start, side_stop) for side_start, side_stop in sides if side_stop > side_start]
+        points = np.concatenate([np.linspace(side_start, side_stop, batch // len(sides) + 2)[1:-1]
+                                 for side_start, side_stop in sides])
+        points = np.setdiff1d(points, rates)
+        if len(points) == 0:
+            break
+        precisions = pd.concat([precisions, evaluate(points)]).sort_index()
+    return precisions
+
+
+def get_parabolic_maximum(precisions: pd.Series) -> float:
+    """
+    Finds the position of the maximum of the accuracy of predictions by the parabola passing through
+    the best evaluated value of the filter coefficient and its neighbours.
+    :param precisions: Pandas Series with the accuracy ordered by the coefficient values.
+    :return: position of the maximum of the parabola between the neighbours, or the best value
+    if it is at the segment end or the parabola is not concave.
+    """
+
+    rates = precisions.index.to_numpy(dtype=np.float64)
+    values = precisions.to_numpy(dtype=np.float64)
+    best = values.argmax()
+    if best == 0 or best == len(values) - 1:
+        return float(rates[best])
+    (x0, x1, x2), (y0, y1, y2) = rates[best - 1:best + 2], values[best - 1:best + 2]
+    denominator = (x1 - x0) * (y1 - y2) - (x1 - x2) * (y1 - y0)
+    if denominator <= 0:
+        return float(rates[best])
+    vertex = x1 - ((x1 - x0) ** 2 * (y1 - y2) - (x1 - x2) ** 2 * (y1 - y0)) / (2 * denominator)
+    return float(np.clip(vertex, x0, x2))
+
+
+def search_optimal_rates_joint(evaluate, bounds: np.ndarray, tolerances: np.ndarray,
+                               start: np.ndarray | None = None) -> (pd.Series, np.ndarray):
+    """
+    Searches for the combination of the filter coefficients maximizing the accuracy of predictions
+    by the compass search: every iteration evaluates the neighbours of the best combination
+    one step away along every coefficient as one batch, which can be evaluated in parallel.
+    The search moves to the best neighbour if it is better, otherwise the steps are halved,
+    until they are not greater than the tolerances.
+    :param evaluate: function calculating the accuracy at a 2D array of the coefficient combinations
+    (returns Pandas Series indexed by the combinations).
+    :param bounds: 2D array of the start and the end of the segment of every coefficient.
+    :param tolerances: tolerances of the coefficients.
+    :param start: initial combination (e.g. the previously found optimum), the centre of the segments by default.
+    :return: Pandas Series with the accuracy at all evaluated combinations (its length is the number of
+    evaluations) and the best combination.
+    """
+
+    bounds = np.asarray(bounds, dtype=np.float64)
+    tolerances = np.asarray(tolerances, dtype=np.float64)
+    best = bounds.mean(axis=1) if start is None else np.clip(np.asarray(start, dtype=np.float64), *bounds.T)
+    steps = (bounds[:, 1] - bounds[:, 0]) / 4
+    shifts = np.concatenate([np.diag(np.ones(len(bounds))), -np.diag(np.ones(len(bounds)))])
+
+    precisions = evaluate(best[np.newaxis])
+    best_precision = precisions.iloc[0]
+    while (steps > tolerances).any():
+        candidates = np.unique(np.clip(best + shifts * steps, *bounds.T), axis=0)
+        candidates = candidates[[tuple(candidate) not in precisions.index for candidate in candidates]]
+        if len(candidates):
+            batch = evaluate(candidates)
+            precisions = pd.concat([precisions, batch])
+            if batch.max() > best_precision:
+                best, best_precision = np.array(batch.idxmax()), batch.max()
+                continue
+        steps = np.where(steps > tolerances, steps / 2, steps)
+    return precisions.sort_index(), best
+
+
+def search_optimal_rate(evaluate, start: float, stop: float, tolerance: float, method: str = 'golden',
+                        batch: int = 2) -> (pd.Series, float):
+    """
+    Searches for the value of the filter coefficient maximizing the accuracy of predictions adaptively:
+    the accuracy is evaluated only around its maximum until the maximum is bracketed within the tolerance.
+    :param evaluate: function calculating the accuracy at an array of the coefficient values
+    (returns Pandas Series indexed by the values).
+    :param start: start of the segment of the coefficient values.
+    :param stop: end of the segment of the coefficient values.
+    :param tolerance: tolerance of the maximum position.
+    :param method: search method: ``'golden'`` (see ``search_rate_golden``) or ``'refine'``
+    (see ``search_rate_refine``).
+    :param batch: number of values evaluated per iteration of the ``refine`` method.
+    :return: the accuracy at all evaluated values (its length is the number of evaluations)
+    and the position of its maximum (see ``get_parabolic_maximum``).
+    """
+
+    match method:
+        case 'golden':
+            precisions = search_rate_golden(evaluate, start, stop, tolerance)
+        case 'refine':
+            precisions = search_rate_refine(evaluate, start, stop, tolerance, batch)
+        case _:
+            raise ValueError(f'Unknown rate search method `{method}`.')
+    return precisions, get_parabolic_maximum(precisions)
+
+
+def preprocess_transactions(transactions: pd.DataFrame,
+                            dtypes: str = 'compact') -> [pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Adds to transaction log orders flag ``days_before_last_order`` - the number of days
     before the last transaction by this user.
@@ -40,6 +275,7 @@ def preprocess_transactions(transactions: pd.DataFrame) -> [pd.DataFrame, pd.Dat
     user transactions.
     
     :param transactions: the transaction log of product purchases.
+    :param dtypes: dtype policy of the columns (see ``DTYPE_POLICIES``).
     :return: the transaction log of product purchases (except for the last transactions) and the last
     user transactions.
     """
@@ -62,15 +298,17 @@ def preprocess_transactions(transactions: pd.DataFrame) -> [pd.DataFrame, pd.Dat
         .groupby('user_id')['days_before_next_order'] \
         .cumsum()
 
-    transactions = transactions.merge(
+    transactions = cast_transactions(transactions.merge(
         orders[['user_id', 'order_number', 'days_before_last_order']],
-        on=['user_id', 'order_number'], how='right').fillna(0).astype(int)
+        on=['user_id', 'order_number'], how='right').fillna(0), dtypes)
 
     transactions.sort_values(['user_id', 'order_number', 'add_to_cart_order'], inplace=True)
 
     transactions.drop(columns='order_number').drop_duplicates(['user_id', 'days_before_last_order', 'product_id'])
 
-    transactions['add_to_cart_order'] = transactions.groupby(['user_id', 'days_before_last_order']).cumcount() + 1
+    add_to_cart_order = transactions.groupby(['user_id', 'days_before_last_order']).cumcount() + 1
+    transactions['add_to_cart_order'] = add_to_cart_order.astype(
+        get_checked_dtype(add_to_cart_order, 'add_to_cart_order', dtypes))
 
     # Select previous transactions and add information about the time until the penultimate order
     prior_transactions = transactions.loc[transactions['days_before_last_order'] > 0].copy()
@@ -86,22 +324,178 @@ def preprocess_transactions(transactions: pd.DataFrame) -> [pd.DataFrame, pd.Dat
     prior_transactions['days_before_last_order'] -= prior_transactions['days_before_last_order_shift']
 
     # Compile a list of product lists in recent transactions
-    last_products = last_transactions[['user_id', 'product_id']] \
-        .groupby('user_id')['product_id'].apply(lambda x: list(x.values)).to_list()
+    last_segments = Segments.from_frame(last_transactions)
+    last_products = [products.tolist() for products in
+                     np.split(last_segments.take(last_transactions['product_id'].to_numpy()),
+                              last_segments.offsets[1:-1])] if len(last_segments.keys) else []
 
     return prior_transactions, last_transactions, last_products
 
 
+def preprocess_new_transactions(transactions: pd.DataFrame,
+                                dtypes: str = 'compact') -> (pd.DataFrame, pd.DataFrame):
+    """
+    Prepares the transactions of new orders for an update of the fitted ratings (see ``Recommender.update``):
+    adds to the transactions the number of days before the last new order of the user ``days_before_last_order``
+    and numbers the products in the carts (see ``preprocess_transactions``). Unlike the fitting, a new order
+    placed on the day of the last known order is numbered apart from it.
+    :param transactions: the transaction log of the new product purchases.
+    :param dtypes: dtype policy of the columns (see ``DTYPE_POLICIES``).
+    :return: the transactions with columns ``user_id``, ``product_id``, ``days_before_last_order``,
+    ``add_to_cart_order`` and the gaps between the previous and the last orders of the users:
+    a dataframe with columns ``user_id``, ``days`` (the sum of ``days_since_prior_order`` of the new orders).
+    """
+
+    transactions = transactions.sort_values(['user_id', 'order_number', 'add_to_cart_order'])
+
+    orders = transactions[['user_id', 'order_number', 'days_since_prior_order']] \
+        .groupby(['user_id', 'order_number']).head(1).fillna(0).astype(int)
+    orders['days_before_next_order'] = orders.groupby('user_id')['days_since_prior_order'] \
+        .shift(-1).fillna(0).astype(int)
+    orders['days_before_last_order'] = orders \
+        .sort_values(['user_id', 'order_number'], ascending=[True, False]) \
+        .groupby('user_id')['days_before_next_order'] \
+        .cumsum()
+    gaps = orders.groupby('user_id')['days_since_prior_order'].sum().rename('days').reset_index()
+
+    transactions = cast_transactions(transactions[['user_id', 'order_number', 'product_id']].merge(
+        orders[['user_id', 'order_number', 'days_before_last_order']], on=['user_id', 'order_number']), dtypes)
+    add_to_cart_order = transactions.groupby(['user_id', 'days_before_last_order']).cumcount() + 1
+    transactions['add_to_cart_order'] = add_to_cart_order.astype(
+        get_checked_dtype(add_to_cart_order, 'add_to_cart_order', dtypes))
+
+    return transactions.drop(columns='order_number'), gaps
+
+
+def get_user_hashes(user_ids: np.ndarray) -> np.ndarray:
+    """
+    Calculates the (Fibonacci) hashes of user IDs, which spread consecutive IDs uniformly.
+    :param user_ids: user IDs.
+    :return: hash of every user.
+    """
+
+    return (user_ids.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+
+
+def get_user_shards(user_ids: np.ndarray, shards: int) -> np.ndarray:
+    """
+    Distributes users among shards by a (Fibonacci) hash of their IDs.
+    :param user_ids: user IDs.
+    :param shards: number of shards.
+    :return: shard number of every user.
+    """
+
+    return (get_user_hashes(user_ids) % np.uint64(shards)).astype(np.int64)
+
+
+def preprocess_transactions_sharded(transactions: pd.DataFrame | Iterable[pd.DataFrame], path: str | PathLike,
+                                    shards: int = 16, dtypes: str = 'compact') -> Path:
+    """
+    Preprocesses the transaction log (see ``preprocess_transactions``) by parts, so the log does not have to fit
+    into memory. The transactions are partitioned into on-disk shards by a hash of ``user_id``, and every shard
+    is preprocessed independently, which is valid as the preprocessing is done per user.
+    The results of the shards are appended one after another to the tables in the columnar format
+    (see ``columnar``) in the output folder:
+    - ``prior_transactions`` - the transaction log of product purchases (except for the last transactions).
+    - ``last_transactions`` - the last user transactions.
+    - ``last_products`` - product lists in the last user transactions ordered by user IDs
+      in the CSR form (``offsets``, ``product_ids``).
+
+    The folder can be passed to ``Recommender.fit`` instead of the transaction log,
+    or attached by ``multiproc.TransactionStore``; both memory-map the tables.
+
+    :param transactions: the transaction log of product purchases or an iterable of its parts
+    (e.g. ``pandas.read_csv`` with ``chunksize``).
+    :param path: path to the output folder.
+    :param shards: number of shards.
+    :param dtypes: dtype policy of the columns (see ``DTYPE_POLICIES``).
+    :return: path to the output folder.
+    """
+
+    path = Path(path)
+    if is_columnar(path / 'prior_transactions'):
+        raise FileExistsError(f'Preprocessed transactions already exist in {path}.')
+    path.mkdir(parents=True, exist_ok=True)
+    if isinstance(transactions, pd.DataFrame):
+        transactions = [transactions]
+
+    with tempfile.TemporaryDirectory(dir=path) as tmpdir:
+        shards_path = Path(tmpdir)
+
+        # Partition the parts of the log by users
+        for part in transactions:
+            # The days since the prior order are missing for the first orders of users in any part
+            part = part.astype({'days_since_prior_order': np.float64})
+            shard_ids = get_user_shards(part['user_id'].to_numpy(), shards)
+            for shard in np.unique(shard_ids):
+                append_columns(shards_path / f'{shard:04d}', part.loc[shard_ids == shard])
+
+        # Preprocess the shards
+        user_ids, sizes, product_ids = [], [], []
+        for shard_path in sorted(shards_path.iterdir()):
+            columns, _ = load_columns(shard_path, mmap=False)
+            shutil.rmtree(shard_path)
+            prior_transactions, last_transactions, last_products = \
+                preprocess_transactions(columns_to_frame(columns), dtypes)
+            append_columns(path / 'prior_transactions', prior_transactions)
+            append_columns(path / 'last_transactions', last_transactions)
+            offsets, shard_product_ids = to_csr(last_products)
+            user_ids.append(np.unique(last_transactions['user_id'].to_numpy()))
+            sizes.append(np.diff(offsets))
+            product_ids.append(shard_product_ids)
+
+    # Order the last products by users across the shards
+    user_ids, sizes, product_ids = np.concatenate(user_ids), np.concatenate(sizes), np.concatenate(product_ids)
+    order = np.argsort(user_ids, kind='stable')
+    starts = get_offsets(sizes)[:-1][order]
+    sizes = sizes[order]
+    save_columns(path / 'last_products', {'offsets': get_offsets(sizes),
+                                          'product_ids': product_ids[expand_segments(starts, sizes)]})
+    return path
+
+
+def read_preprocessed_transactions(path: str | PathLike) \
+        -> (pd.DataFrame, pd.DataFrame, (np.ndarray, np.ndarray)):
+    """
+    Opens the transactions preprocessed by ``preprocess_transactions_sharded``. The tables are memory-mapped.
+    :param path: path to the folder of the preprocessed transactions.
+    :return: the transaction log of product purchases (except for the last transactions), the last
+    user transactions and the product lists in the last user transactions in the CSR form.
+    """
+
+    path = Path(path)
+    prior_transactions = columns_to_frame(load_columns(path / 'prior_transactions')[0])
+    last_transactions = columns_to_frame(load_columns(path / 'last_transactions')[0])
+    columns, _ = load_columns(path / 'last_products')
+    return prior_transactions, last_transactions, (columns['offsets'], columns['product_ids'])
+
+
 def get_weights(transactions: pd.DataFrame,
-                days_rate: float = 0.0, cart_rate: float = 0.0):
+                days_rate: float = 0.0, cart_rate: float = 0.0, shifted: bool = False, dtypes: str = 'compact'):
+    """
+    Calculates product weights in transactions.
+    :param transactions: the transaction log of product purchases.
+    :param days_rate: filter rate by time.
+    :param cart_rate: filter rate by the product addition number to the cart.
+    :param shifted: count the days until the last transaction of the user instead of the penultimate one
+    (by adding ``days_before_last_order_shift`` of the prior transactions, see ``preprocess_transactions``).
+    :param dtypes: dtype policy of the weights (see ``DTYPE_POLICIES``).
+    :return: dataframe with columns ``user_id``, ``product_id``, ``weight``.
+    """
+
+    # The attributes are converted to the type of the weights before the negation, as they may be unsigned
+    dtype = get_dtype('weight', dtypes)
     weights = transactions[['user_id', 'product_id']].copy()
-    weights['weight'] = 1
+    weights['weight'] = np.ones(len(weights), dtype=dtype)
 
     if days_rate > 0.:
-        weights['weight'] *= np.exp(-transactions['days_before_last_order'] * days_rate)
+        days = transactions['days_before_last_order'].to_numpy(dtype)
+        if shifted:
+            days = days + transactions['days_before_last_order_shift'].to_numpy(dtype)
+        weights['weight'] *= np.exp(-days * days_rate)
 
     if cart_rate > 0.:
-        weights['weight'] *= np.exp(-transactions['add_to_cart_order'] * cart_rate)
+        weights['weight'] *= np.exp(-transactions['add_to_cart_order'].to_numpy(dtype) * cart_rate)
 
     return weights
 
@@ -130,6 +524,173 @@ def get_ratings(weights: pd.DataFrame, total_rate: float = 0.):
     return ratings
 
 
+def get_sparse_ratings(weights: pd.DataFrame, total_rate: float = 0.) -> SparseRatings:
+    """
+    Generates product ratings among all customers in the sparse form (see ``get_ratings``).
+    The weights are aggregated in a single pass into a user x product matrix with integer-coded users and products.
+
+    :param weights: product weights in transactions.
+    :param total_rate: popularity filtering rate.
+    :return: product ratings.
+    """
+
+    ratings = SparseRatings.from_arrays(weights['user_id'].to_numpy(), weights['product_id'].to_numpy(),
+                                        weights['weight'].to_numpy())
+    return ratings.with_total_rate(total_rate)
+
+
+def get_sparse_ratings_by_chunks(transactions: pd.DataFrame, days_rate: float = 0.0, cart_rate: float = 0.0,
+                                 shifted: bool = False, dtypes: str = 'compact',
+                                 chunk_size: int = 2 ** 22) -> SparseRatings:
+    """
+    Generates product ratings of transactions (see ``get_sparse_ratings``) by chunks of their rows, so the weights
+    (see ``get_weights``) exist for a chunk at a time, e.g. for memory-mapped preprocessed transactions.
+    :param transactions: the transaction log of product purchases.
+    :param days_rate: filter rate by time.
+    :param cart_rate: filter rate by the product addition number to the cart.
+    :param shifted: count the days until the last transaction of the user (see ``get_weights``).
+    :param dtypes: dtype policy of the weights (see ``DTYPE_POLICIES``).
+    :param chunk_size: number of transactions of a chunk.
+    :return: product ratings without the filtering by popularity.
+    """
+
+    return SparseRatings.from_parts([
+        get_sparse_ratings(get_weights(transactions.iloc[start:start + chunk_size], days_rate, cart_rate,
+                                       shifted=shifted, dtypes=dtypes))
+        for start in range(0, max(len(transactions), 1), chunk_size)])
+
+
+def get_product_ratings(ratings: SparseRatings, total_ratings: np.ndarray) -> pd.DataFrame:
+    """
+    Summarizes the ratings of products among all users.
+    :param ratings: product ratings in the sparse form.
+    :param total_ratings: ratings of products before the popularity filtering (see ``get_total_ratings``)
+    ordered by product codes.
+    :return: dataframe aligned with the product codes of the ratings with columns ``product_id``,
+    ``total_rating`` (the popularity of the product) and ``rating`` (the sum of the ratings of the product).
+    """
+
+    return pd.DataFrame({
+        'product_id': ratings.product_ids,
+        'total_rating': total_ratings,
+        'rating': np.bincount(ratings.indices, weights=ratings.data, minlength=ratings.n_products),
+    })
+
+
+def get_updated_ratings(ratings: SparseRatings, product_ratings: pd.DataFrame, weights: pd.DataFrame,
+                        gaps: pd.DataFrame, days_rate: float, total_rate: float) -> (SparseRatings, SparseRatings):
+    """
+    Updates the ratings of the users of new transactions (see ``Recommender.update``).
+    The previous ratings of a user are aged by the gap between its previous and its new last orders,
+    as the weights of its transactions decay by ``exp(-days * days_rate)`` (see ``get_weights``),
+    and the weights of the new transactions are added to them. The popularity of products
+    is kept from the fitting (the new products have no popularity), so the ratings of the other users stay valid.
+    :param ratings: product ratings in the sparse form (of all users or of some users).
+    :param product_ratings: ratings of products among all users (see ``get_product_ratings``).
+    :param weights: product weights in the new transactions.
+    :param gaps: days between the previous and the new last orders of the users
+    (see ``preprocess_new_transactions``).
+    :param days_rate: filter rate by time.
+    :param total_rate: popularity filtering rate.
+    :return: previous ratings of the users (without the new users) and their updated ratings.
+    """
+
+    previous = ratings.take_users(gaps['user_id'].to_numpy())
+    days = gaps.set_index('user_id')['days'].reindex(previous.user_ids).to_numpy(np.float64)
+    # The products of the entries are looked up, as the users have a small part of all products
+    total_ratings = lookup_total_ratings(product_ratings, previous.product_ids[previous.indices])
+    frequencies = previous.data / np.exp(total_ratings * total_rate) * np.exp(-days * days_rate)[previous.rows]
+
+    updated = SparseRatings.from_arrays(
+        np.concatenate([previous.user_ids[previous.rows], weights['user_id'].to_numpy()]),
+        np.concatenate([previous.product_ids[previous.indices], weights['product_id'].to_numpy()]),
+        np.concatenate([frequencies, weights['weight'].to_numpy()]))
+    return previous, updated.with_total_rate(total_rate, lookup_total_ratings(product_ratings, updated.product_ids))
+
+
+def lookup_total_ratings(product_ratings: pd.DataFrame, product_ids: np.ndarray) -> np.ndarray:
+    """
+    Looks up the popularity of products.
+    :param product_ratings: ratings of products among all users (see ``get_product_ratings``).
+    :param product_ids: product IDs.
+    :return: popularity of the products (0 for the unknown products).
+    """
+
+    known_ids = product_ratings['product_id'].to_numpy()
+    product_ids = product_ids.astype(known_ids.dtype, copy=False)
+    positions = np.searchsorted(known_ids, product_ids)
+    known = positions < len(known_ids)
+    known[known] = known_ids[positions[known]] == product_ids[known]
+    total_ratings = np.zeros(len(product_ids))
+    total_ratings[known] = product_ratings['total_rating'].to_numpy()[positions[known]]
+    return total_ratings
+
+
+def get_updated_product_ratings(product_ratings: pd.DataFrame, product_ids: np.ndarray,
+                                previous: SparseRatings, updated: SparseRatings) -> pd.DataFrame:
+    """
+    Updates the ratings of products among all users by the change of the ratings of some users.
+    :param product_ratings: ratings of products among all users (see ``get_product_ratings``).
+    :param product_ids: sorted product IDs of the updated ratings of all users (including the new products).
+    :param previous: previous ratings of the users.
+    :param updated: updated ratings of the users.
+    :return: ratings of products aligned with ``product_ids``.
+    """
+
+    positions = np.searchsorted(product_ids, product_ratings['product_id'].to_numpy())
+    total_ratings = np.zeros(len(product_ids))
+    total_ratings[positions] = product_ratings['total_rating'].to_numpy()
+    sums = np.zeros(len(product_ids))
+    sums[positions] = product_ratings['rating'].to_numpy()
+    sums -= np.bincount(np.searchsorted(product_ids, previous.product_ids)[previous.indices],
+                        weights=previous.data, minlength=len(product_ids))
+    sums += np.bincount(np.searchsorted(product_ids, updated.product_ids)[updated.indices],
+                        weights=updated.data, minlength=len(product_ids))
+    return pd.DataFrame({'product_id': product_ids, 'total_rating': total_ratings, 'rating': sums})
+
+
+def get_ratings_histogram(transactions: pd.DataFrame, by: str = 'days_before_last_order',
+                          days_rate: float = 0.0, cart_rate: float = 0.0,
+                          dtypes: str = 'compact') -> RatingsHistogram:
+    """
+    Generates product ratings among all customers as histograms of a transaction attribute,
+    which allow to recalculate the ratings for any filter rate by this attribute cheaply
+    (see ``sparse_ratings.RatingsHistogram``).
+
+    :param transactions: the transaction log of product purchases.
+    :param by: name of the attribute: ``days_before_last_order`` or ``add_to_cart_order``.
+    :param days_rate: filter rate by time (used when the attribute is ``add_to_cart_order``).
+    :param cart_rate: filter rate by add to cart order (used when the attribute is ``days_before_last_order``).
+    :param dtypes: dtype policy of the weights (see ``DTYPE_POLICIES``).
+    :return: ratings histograms.
+    """
+
+    match by:
+        case 'days_before_last_order':
+            weights = get_weights(transactions, cart_rate=cart_rate, dtypes=dtypes)
+        case 'add_to_cart_order':
+            weights = get_weights(transactions, days_rate=days_rate, dtypes=dtypes)
+        case _:
+            raise ValueError(f'Unknown attribute `{by}`.')
+    return RatingsHistogram.from_arrays(weights['user_id'].to_numpy(), weights['product_id'].to_numpy(),
+                                        transactions[by].to_numpy(), weights['weight'].to_numpy())
+
+
+def get_joint_ratings_histogram(transactions: pd.DataFrame) -> JointRatingsHistogram:
+    """
+    Generates product ratings among all customers as joint histograms of the number of days before the last order
+    and the add to cart order, which allow to recalculate the ratings for any pair of the filter rates
+    by these attributes cheaply (see ``sparse_ratings.JointRatingsHistogram``).
+
+    :param transactions: the transaction log of product purchases.
+    :return: ratings histograms.
+    """
+
+    return JointRatingsHistogram.from_arrays(
+        transactions['user_id'].to_numpy(), transactions['product_id'].to_numpy(),
+        [transactions['days_before_last_order'].to_numpy(), transactions['add_to_cart_order'].to_numpy()])
+
+
 def get_total_ratings(weights: pd.DataFrame):
     """
     Generates a table of product ratings among all customers based on their purchase transactions.
@@ -148,22 +709,67 @@ def get_total_ratings(weights: pd.DataFrame):
     return ratings
 
 
-def get_prediction(ratings: pd.DataFrame,
-                   k: int = 10):
+def get_prediction(ratings: pd.DataFrame | SparseRatings,
+                   k: int = 10, method: str = 'sort', segments: Segments | None = None):
     """
     Generates a prediction of products in the next purchase with the given number of elements.
-    :param ratings: product ratings among users with columns ``user_id``, ``product_id``, ``rating``.
+    :param ratings: product ratings among users with columns ``user_id``, ``product_id``, ``rating``
+    or in the sparse form.
     :param k: maximum number of elements in the prediction.
+    :param method: selection method of the top products:
+    - ``'sort'`` - sorting of the whole ratings table.
+    - ``'partition'`` - partial selection inside the contiguous blocks of users' ratings
+      (see ``sparse_ratings.segment_top_k``).
+    :param segments: segments of the ratings table by users (built if not given, used by the partition method).
     :return: dataframe with columns ``user_id``, ``product_id``.
+    :raise ValueError: if ``k`` is not positive or the method is unknown.
     """
 
+    check_top_k(k, method)
+    if isinstance(ratings, SparseRatings):
+        offsets, product_ids = ratings.top_k(k, method)
+        return pd.DataFrame({
+            'user_id': np.repeat(ratings.user_ids, np.diff(offsets)),
+            'product_id': product_ids,
+        })
+
+    if method == 'partition':
+        if segments is None:
+            segments = Segments.from_frame(ratings)
+        selected = segment_top_k(segments.offsets, segments.take(ratings['rating'].to_numpy()), k)
+        return ratings.iloc[segments.rows()[selected]]
+
     prediction = ratings.sort_values(['user_id', 'rating'], ascending=[True, False])
-    prediction = prediction.groupby('user_id').head(k)
+    sorted_segments = Segments.from_frame(prediction)
+    _, heads = sorted_segments.heads(np.arange(len(sorted_segments.keys)), k)
+    prediction = prediction.iloc[heads]
 
     return prediction
 
 
-def get_aisle_ranks(ratings: pd.DataFrame, products: pd.DataFrame):
+def get_product_aisles(ratings: SparseRatings, products: pd.DataFrame) -> np.ndarray:
+    """
+    Looks up the aisles of the products of sparse ratings.
+    :param ratings: product ratings in the sparse form.
+    :param products: products registry with columns ``product_id``, ``aisle_id``, or aisle IDs indexed by product IDs
+    (which keeps the lookup table of the index between the calls).
+    :return: aisle ID of every product ordered by product codes (-1 for products missing in the registry).
+    """
+
+    aisles = products if isinstance(products, pd.Series) else products.set_index('product_id')['aisle_id']
+    return aisles.reindex(ratings.product_ids).fillna(-1).to_numpy().astype(np.int64)
+
+
+def get_aisle_ranks(ratings: pd.DataFrame | SparseRatings, products: pd.DataFrame | pd.Series):
+    if isinstance(ratings, SparseRatings):
+        aisle_ratings = ratings.aggregate_products(get_product_aisles(ratings, products))
+        order, ranks = rank_segments(aisle_ratings.indptr, aisle_ratings.data)
+        return pd.DataFrame({
+            'user_id': aisle_ratings.user_ids[aisle_ratings.rows],
+            'aisle_id': aisle_ratings.product_ids[aisle_ratings.indices[order]],
+            'aisle_rank': ranks.astype(int),
+        })
+
     extended_ratings = ratings.merge(products[['aisle_id', 'product_id']], on='product_id', how='left')
     aisle_ratings = extended_ratings.groupby(['user_id', 'aisle_id'])['rating'].sum()
     aisle_ranks = aisle_ratings \
@@ -172,7 +778,35 @@ def get_aisle_ranks(ratings: pd.DataFrame, products: pd.DataFrame):
     return aisle_ranks
 
 
-def get_inside_aisle_ranks(ratings: pd.DataFrame, products: pd.DataFrame):
+def rank_products_inside_aisles(product_ids: np.ndarray, product_aisles: np.ndarray,
+                                product_ratings: np.ndarray) -> pd.DataFrame:
+    """
+    Ranks products inside their aisles by their ratings among all users (see ``get_inside_aisle_ranks``).
+    :param product_ids: product IDs.
+    :param product_aisles: aisle IDs of the products.
+    :param product_ratings: ratings of the products among all users.
+    :return: product ranks inside aisles sorted by aisles and ranks.
+    """
+
+    by_aisle = np.argsort(product_aisles, kind='stable')
+    aisle_ids, aisle_sizes = np.unique(product_aisles[by_aisle], return_counts=True)
+    order, ranks = rank_segments(get_offsets(aisle_sizes), product_ratings[by_aisle])
+    return pd.DataFrame({
+        'aisle_id': np.repeat(aisle_ids, aisle_sizes),
+        'product_id': product_ids[by_aisle[order]],
+        'inside_aisle_rank': ranks.astype(int),
+    })
+
+
+def get_inside_aisle_ranks(ratings: pd.DataFrame | SparseRatings, products: pd.DataFrame):
+    if isinstance(ratings, SparseRatings):
+        product_aisles = get_product_aisles(ratings, products)
+        product_ratings = np.bincount(ratings.indices, weights=ratings.data, minlength=ratings.n_products)
+        assigned = np.flatnonzero((product_aisles >= 0) & (np.bincount(ratings.indices,
+                                                                       minlength=ratings.n_products) > 0))
+        return rank_products_inside_aisles(ratings.product_ids[assigned], product_aisles[assigned],
+                                           product_ratings[assigned])
+
     extended_ratings = ratings.merge(products[['aisle_id', 'product_id']], on='product_id', how='left')
     inside_aisle_ratings = extended_ratings.groupby(['aisle_id', 'product_id'])['rating'].sum()
     inside_aisle_ranks = inside_aisle_ratings \
@@ -181,123 +815,375 @@ def get_inside_aisle_ranks(ratings: pd.DataFrame, products: pd.DataFrame):
     return inside_aisle_ranks
 
 
+def replace_rows(table: pd.DataFrame, key: str, keys: np.ndarray, rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces the rows of a table sorted by a key column, e.g. the ranks of some users or aisles.
+    :param table: table sorted by the key column.
+    :param key: name of the key column.
+    :param keys: replaced keys.
+    :param rows: new rows of the replaced keys sorted by the key column.
+    :return: table sorted by the key column (the order of rows with the same key is kept).
+    """
+
+    merged = pd.concat([table.loc[~np.isin(table[key].to_numpy(), keys)], rows], ignore_index=True)
+    # Both parts are sorted, so the stable sort only merges two runs
+    return merged.take(np.argsort(merged[key].to_numpy(), kind='stable')).reset_index(drop=True)
+
+
+def get_fill_appendix(user_ids: np.ndarray, appendix_sizes: np.ndarray,
+                      predicted_user_ids: np.ndarray, predicted_product_ids: np.ndarray,
+                      index: FillIndex, k: int = 10) -> (np.ndarray, np.ndarray):
+    """
+    Selects the products supplementing the predictions of users (see ``fill_in_prediction``).
+    :param user_ids: sorted unique IDs of the users whose predictions are supplemented.
+    :param appendix_sizes: number of missing products of every user.
+    :param predicted_user_ids: user IDs of the products already predicted for the users.
+    :param predicted_product_ids: product IDs of the products already predicted for the users.
+    :param index: offset indexes of the ranks.
+    :param k: size of the predictions.
+    :return: user IDs and product IDs of the supplementing products ordered by users.
+    """
+
+    # Popular aisles of the users and the number of products appended from every aisle
+    aisles_numbers, aisle_positions = index.user_aisles.heads(index.user_aisles.locate(user_ids), k)
+    slot_users = np.repeat(np.arange(len(user_ids)), aisles_numbers)
+    slot_numbers = np.arange(len(slot_users)) - np.repeat(np.cumsum(aisles_numbers) - aisles_numbers,
+                                                          aisles_numbers)
+    slot_sizes = appendix_sizes[slot_users] // aisles_numbers[slot_users] \
+        + (slot_numbers < appendix_sizes[slot_users] % aisles_numbers[slot_users])
+    slot_aisles = index.aisle_ids[aisle_positions]
+    used = slot_sizes > 0
+    slot_users, slot_sizes, slot_aisles = slot_users[used], slot_sizes[used], slot_aisles[used]
+
+    # Popular products of the aisles, except the products already predicted for the user
+    products_numbers, product_positions = index.aisle_products.heads(index.aisle_products.locate(slot_aisles), k)
+    candidate_slots = np.repeat(np.arange(len(slot_users)), products_numbers)
+    candidate_users = user_ids[slot_users[candidate_slots]]
+    candidate_products = index.product_ids[product_positions]
+    base = int(max(candidate_products.max(initial=0), predicted_product_ids.max(initial=0))) + 1
+    new = ~np.isin(candidate_users.astype(np.int64) * base + candidate_products,
+                   predicted_user_ids.astype(np.int64) * base + predicted_product_ids)
+    candidate_slots, candidate_users, candidate_products = \
+        candidate_slots[new], candidate_users[new], candidate_products[new]
+
+    # The first products of every aisle are appended up to the number allocated to the aisle
+    candidate_numbers = np.arange(len(candidate_slots)) - np.searchsorted(candidate_slots, candidate_slots)
+    appended = candidate_numbers < slot_sizes[candidate_slots]
+    return candidate_users[appended], candidate_products[appended]
+
+
 def fill_in_prediction(prediction: pd.DataFrame, aisle_ranks: pd.DataFrame, inside_aisle_ranks: pd.DataFrame,
-                       k: int = 10):
-    sizes = prediction.groupby('user_id').size()
-    small_sizes = sizes.loc[sizes < k].copy()
-    appendix = []
-    for user, small_size in small_sizes.items():
-        appendix_size = k - small_size
-        predicted_products = prediction.loc[prediction['user_id'] == user, 'product_id'].to_list()
-        popular_aisles = aisle_ranks.loc[aisle_ranks['user_id'] == user, 'aisle_id'].head(k).to_list()
-        appendix_size_per_aisle = [appendix_size // len(popular_aisles)] * len(popular_aisles)
-        for index in range(appendix_size - sum(appendix_size_per_aisle)):
-            appendix_size_per_aisle[index] += 1
-        for aisle, size in zip(popular_aisles, appendix_size_per_aisle):
-            if size == 0:
-                break
-            popular_aisle_products = inside_aisle_ranks.loc[inside_aisle_ranks['aisle_id'] == aisle, 'product_id'] \
-                .head(k).to_list()
-            for product in popular_aisle_products:
-                if product not in predicted_products:
-                    appendix.append((user, product))
-                    size -= 1
-                    if size == 0:
-                        break
-    filled_prediction = pd.concat([prediction, pd.DataFrame(appendix, columns=['user_id', 'product_id'])]).fillna(0)
+                       k: int = 10, index: FillIndex | None = None, segments: Segments | None = None):
+    """
+    Supplements the predictions with less than ``k`` products by the most popular products
+    from the aisles which are the most popular with the user. The missing products are distributed evenly
+    among up to ``k`` popular aisles of the user, and the products already predicted are skipped.
+    All users are filled in at once through the offset indexes of the ranks.
+    :param prediction: dataframe with columns ``user_id``, ``product_id``.
+    :param aisle_ranks: aisle ranks of users.
+    :param inside_aisle_ranks: product ranks inside aisles.
+    :param k: size of the predictions.
+    :param index: offset indexes of the ranks (built from the ranks if not given).
+    :param segments: segments of the prediction by users (built if not given).
+    :return: dataframe with columns ``user_id``, ``product_id``.
+    """
+
+    if index is None:
+        index = FillIndex.from_ranks(aisle_ranks, inside_aisle_ranks)
+
+    predicted = Segments.from_frame(prediction) if segments is None else segments
+    small = predicted.sizes < k
+    predicted_rows = predicted.rows()[expand_segments(predicted.offsets[:-1][small], predicted.sizes[small])]
+    user_ids, product_ids = get_fill_appendix(predicted.keys[small], k - predicted.sizes[small],
+                                              prediction['user_id'].to_numpy()[predicted_rows],
+                                              prediction['product_id'].to_numpy()[predicted_rows],
+                                              index, k)
+    appendix = pd.DataFrame({'user_id': user_ids, 'product_id': product_ids})
+
+    filled_prediction = pd.concat([prediction, appendix]).fillna(0)
     return filled_prediction
 
 
 def get_prediction_precision(
-        true: Union[list[int], list[list[int]]],
-        prediction: pd.DataFrame,
-        k: int = 10
+        true: Union[list[int], list[list[int]], tuple[np.ndarray, np.ndarray]],
+        prediction: pd.DataFrame | tuple[np.ndarray, np.ndarray],
+        k: int = 10,
+        segments: Segments | None = None
 ):
     """
     Calculates the prediction accuracy of popular products. If the predictions are for all products without grouping,
     then the accuracy is determined by the ``AP@K`` metric. Otherwise, the average prediction accuracy
     among all product groups is calculated using the ``MAP@K` metric.
     :param true: the actual list of products in the user's purchase, or the list of product lists
-    in the user's purchases.
+    in the user's purchases, or the same lists packed into the CSR form ``(offsets, product_ids)``
+    (see ``average_precision.to_csr``).
     :param prediction: the list of predicted products in the user's purchase, or the list of predicted products
-    in the user's purchases.
+    in the user's purchases, or the predicted products of users in the CSR form ``(offsets, product_ids)``
+    (see ``SparseRatings.top_k``).
     :param k: the number of elements on which the accuracy is calculated.
+    :param segments: segments of the prediction dataframe by users (built if not given).
     :return: the value of the accuracy metric.
     """
-    if isinstance(true[0], int):
+    if not isinstance(true, tuple) and isinstance(true[0], int):
         prediction = prediction['product_id'].to_list()
         precision = apk(true, prediction, k)
     else:
-        prediction = [
-            user_ratings.to_list()
-            for _, user_ratings
-            in prediction.groupby('user_id')['product_id']
-        ]
-        precision = mapk(true, prediction, k)
+        if not isinstance(true, tuple):
+            true = to_csr(true)
+        predicted_offsets, predicted_ids = prediction if isinstance(prediction, tuple) \
+            else get_prediction_csr(prediction, segments)
+        precision = mapk_csr(*true, predicted_offsets, predicted_ids, k)
     return precision
 
 
+def get_prediction_precision_interval(true: tuple[np.ndarray, np.ndarray], prediction: tuple[np.ndarray, np.ndarray],
+                                      k: int = 10, confidence: float = 0.95, resamples: int = 200,
+                                      seed: int = 0) -> (float, float, float):
+    """
+    Calculates the average prediction accuracy among users by the ``MAP@K`` metric
+    and its bootstrap confidence interval (percentiles of the metric over the resamples of the users).
+    The resamples are defined by the seed, so the intervals of different predictions of the same users
+    are comparable.
+    :param true: the lists of products in the users' purchases in the CSR form ``(offsets, product_ids)``.
+    :param prediction: the predicted products of the users in the CSR form ``(offsets, product_ids)``.
+    :param k: the number of elements on which the accuracy is calculated.
+    :param confidence: confidence level of the interval.
+    :param resamples: number of the bootstrap resamples.
+    :param seed: seed of the resamples.
+    :return: the value of the accuracy metric, the lower and the upper bounds of its interval.
+    """
+
+    scores = apk_csr(*true, *prediction, k)
+    rng = np.random.default_rng(seed)
+    means = np.array([scores[rng.integers(0, len(scores), len(scores))].mean() for _ in range(resamples)])
+    lower, upper = np.quantile(means, [(1 - confidence) / 2, (1 + confidence) / 2])
+    return scores.mean(), lower, upper
+
+
+def get_validation_sample(prior_transactions: pd.DataFrame, last_products: tuple[np.ndarray, np.ndarray],
+                          sample: float | int, strata: int = 10) -> (pd.DataFrame, (np.ndarray, np.ndarray)):
+    """
+    Selects a deterministic sample of users stratified by their activity for the validation of predictions:
+    the users are divided into strata by the number of their prior transactions, and every stratum gives
+    its share of the sample taking the users in the order of their hashes (see ``get_user_hashes``).
+    :param prior_transactions: the transaction log of product purchases (except for the last transactions).
+    :param last_products: the product lists in the last user transactions in the CSR form ordered by users.
+    :param sample: share of the users (not greater than 1) or the number of the users in the sample.
+    :param strata: number of the strata.
+    :return: the prior transactions and the last products of the sampled users.
+    """
+
+    user_ids, counts = np.unique(prior_transactions['user_id'].to_numpy(), return_counts=True)
+    size = min(max(int(round(sample * len(user_ids) if sample <= 1 else sample)), 1), len(user_ids))
+
+    # The quotas of the strata are rounded so that they sum up to the sample size
+    activity_ranks = np.empty(len(user_ids), dtype=np.int64)
+    activity_ranks[np.argsort(counts, kind='stable')] = np.arange(len(user_ids))
+    user_strata = activity_ranks * strata // len(user_ids)
+    order = np.lexsort((get_user_hashes(user_ids), user_strata))
+    stratum_sizes = np.bincount(user_strata, minlength=strata)
+    quotas = np.diff(np.round(get_offsets(stratum_sizes) * size / len(user_ids)).astype(np.int64))
+    rows = np.sort(order[expand_segments(get_offsets(stratum_sizes)[:-1], quotas)])
+
+    sampled = np.isin(prior_transactions['user_id'].to_numpy(), user_ids[rows])
+    offsets, product_ids = last_products
+    sizes = offsets[rows + 1] - offsets[rows]
+    return prior_transactions[sampled], (get_offsets(sizes), product_ids[expand_segments(offsets[rows], sizes)])
+
+
+def get_prediction_csr(prediction: pd.DataFrame, segments: Segments | None = None) -> (np.ndarray, np.ndarray):
+    """
+    Packs a prediction dataframe with columns ``user_id``, ``product_id`` into the CSR form ordered by users.
+    The order of the products of every user is kept.
+    :param prediction: prediction dataframe.
+    :param segments: segments of the prediction by users (built if not given).
+    :return: offsets of the users' lists and the concatenated product IDs.
+    """
+    if segments is None:
+        segments = Segments.from_frame(prediction)
+    return segments.offsets, segments.take(prediction['product_id'].to_numpy())
+
+
+def get_recommendation_matrix(user_index: UserIndex, index: FillIndex, k: int = 10) -> np.ndarray:
+    """
+    Packs the top products of users supplemented up to ``k`` products (see ``fill_in_prediction``)
+    into a dense matrix, the array counterpart of ``get_prediction_table``.
+    :param user_index: top products of the users.
+    :param index: offset indexes of the ranks.
+    :param k: size of the predictions.
+    :return: ``int32`` matrix of product IDs with a row for every user of the index and ``k`` columns
+    (0 for missing products).
+    """
+
+    n_users = len(user_index.user_ids)
+    sizes = np.minimum(user_index.sizes, k)
+    rows = np.repeat(np.arange(n_users), sizes)
+    columns = np.arange(len(rows)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    product_ids = user_index.top_product_ids[expand_segments(user_index.top_offsets[:-1], sizes)]
+    matrix = np.zeros((n_users, k), dtype=np.int32)
+    matrix[rows, columns] = product_ids
+
+    small = sizes < k
+    predicted = small[rows]
+    appendix_user_ids, appendix_product_ids = get_fill_appendix(
+        user_index.user_ids[small], k - sizes[small],
+        user_index.user_ids[rows[predicted]], product_ids[predicted], index, k)
+    appendix_rows = np.searchsorted(user_index.user_ids, appendix_user_ids)
+    appendix_columns = sizes[appendix_rows] + np.arange(len(appendix_rows)) \
+        - np.searchsorted(appendix_rows, appendix_rows)
+    matrix[appendix_rows, appendix_columns] = appendix_product_ids
+    return matrix
+
+
+def get_product_names(products: pd.DataFrame) -> np.ndarray:
+    """
+    Builds the dense lookup table of product names by product IDs.
+    :param products: products registry with columns ``product_id``, ``product_name``.
+    :return: array of product names indexed by product IDs (``None`` for IDs missing in the registry).
+    """
+
+    product_ids = products['product_id'].to_numpy()
+    names = np.full(int(product_ids.max(initial=0)) + 1, None, dtype=object)
+    names[product_ids] = products['product_name'].to_numpy()
+    return names
+
+
+def decode_products(product_ids: np.ndarray, names: np.ndarray) -> np.ndarray:
+    """
+    Maps product IDs to product names at once.
+    :param product_ids: array of product IDs of any shape (0 for missing products).
+    :param names: lookup table of product names built by ``get_product_names``.
+    :return: array of product names of the same shape (``None`` for missing and unknown products).
+    """
+
+    known = (product_ids > 0) & (product_ids < len(names))
+    decoded = names[np.where(known, product_ids, 0)]
+    decoded[~known] = None
+    return decoded
+
+
 def get_prediction_table(
         prediction: pd.DataFrame,
+        segments: Segments | None = None
 ):
     """
     Converts a prediction dataframe with columns: ``user_id``, ``product_id`` into a tabular
     dataframe with index from column 'user_id' and columns: 1,2,...,[number of elements in prediction] with values from
     column `product_id`.
     :param prediction: prediction dataframe.
+    :param segments: segments of the prediction by users (built if not given).
     :return: prediction dataframe in tabular form.
     """
-    prediction['rank'] = prediction.groupby('user_id')['product_id'].cumcount() + 1
-    prediction_table = prediction \
-        .pivot(index='user_id', columns='rank', values='product_id') \
-        .fillna(0) \
-        .astype(int)
-    prediction.drop(columns='rank')
+    if segments is None:
+        segments = Segments.from_frame(prediction)
+    table = np.zeros((len(segments.keys), segments.sizes.max(initial=0)), dtype=np.int64)
+    table[segments.segment_ids(), segments.positions()] = prediction['product_id'].to_numpy()
+    prediction_table = pd.DataFrame(table, index=pd.Index(segments.keys, name='user_id'),
+                                    columns=pd.RangeIndex(1, table.shape[1] + 1, name='rank'))
     return prediction_table
 
 
+def get_submission_rows(user_ids: np.ndarray, table: np.ndarray) -> bytes:
+    """
+    Formats rows of the solution csv file: ``user_id,product_id product_id ...`` (see ``save_kaggle_submission_csv``).
+    The IDs are split into fixed-width digit arrays at once, and the bytes of their significant digits and of the
+    separators are selected by a mask, so no strings are built per ID.
+    :param user_ids: user IDs.
+    :param table: matrix of non-negative product IDs recommended to the users (rows in the order of ``user_ids``).
+    :return: rows of the file.
+    """
+    if table.shape[1] == 0:
+        return b''.join(f'{user_id},\n'.encode() for user_id in user_ids.tolist())
+    values = np.concatenate([np.asarray(user_ids, dtype=np.int64)[:, None], table.astype(np.int64, copy=False)],
+                            axis=1)
+    if values.size and values.min() < 0:
+        raise ValueError('IDs must be non-negative.')
+    width = len(str(values.max(initial=0)))
+    buffer = np.empty(values.shape + (width + 1,), dtype=np.uint8)
+    lengths = np.ones(values.shape, dtype=np.int64)
+    for position in range(width - 1, -1, -1):
+        buffer[:, :, position] = values % 10 + ord('0')
+        values = values // 10
+        lengths += values > 0
+    buffer[:, :, width] = ord(' ')
+    buffer[:, 0, width] = ord(',')
+    buffer[:, -1, width] = ord('\n')
+    mask = np.arange(width + 1) >= width - lengths[:, :, None]
+    return buffer[mask].tobytes()
+
+
 def save_kaggle_submission_csv(
-        prediction: pd.DataFrame,
-        file_path: str
+        prediction: pd.DataFrame | np.ndarray,
+        file_path: str | PathLike,
+        segments: Segments | None = None,
+        user_ids: np.ndarray | None = None,
+        compression: str | None = 'infer',
+        chunk_size: int = 65536
 ):
     """
     Saves the prediction as a solution csv file for the `skillbox-recommender-system` competition on the Kaggle platform.
-    
-    :param prediction: prediction of products in the users' next purchase.
+    The rows are formatted in chunks of users (see ``get_submission_rows``) and streamed to the file.
+
+    :param prediction: prediction of products in the users' next purchase:
+    - dataframe with columns ``user_id``, ``product_id`` (ranked by users),
+    - dataframe of product IDs indexed by user IDs (e.g. ``Recommender.recommend(..., ids_only=True)``),
+    - matrix of product IDs recommended to the users of ``user_ids``.
+    Missing products (0) are written as 0.
     :param file_path: path to the solution file.
+    :param segments: segments of the prediction by users (built if not given).
+    :param user_ids: user IDs of the rows of the matrix of product IDs.
+    :param compression: ``'gzip'``, ``None`` or ``'infer'`` - gzip for the ``.gz`` extension of the file.
+    :param chunk_size: number of users formatted at once.
     """
-    prediction_table = get_prediction_table(prediction)
-    prediction_csv = prediction_table \
-        .map(str) \
-        .apply(list, axis=1) \
-        .str.join(' ') \
-        .rename('product_id') \
-        .to_frame()
-    prediction_csv.to_csv(file_path)
+    if isinstance(prediction, np.ndarray):
+        if user_ids is None:
+            raise ValueError('User IDs of the matrix of product IDs are not given.')
+        table = prediction
+    elif 'product_id' in prediction.columns:
+        prediction_table = get_prediction_table(prediction, segments)
+        user_ids, table = prediction_table.index.to_numpy(), prediction_table.to_numpy()
+    else:
+        user_ids, table = prediction.index.to_numpy(), prediction.to_numpy()
+    user_ids = np.asarray(user_ids)
+    if len(user_ids) != len(table):
+        raise ValueError(f'{len(user_ids)} user IDs are given for {len(table)} rows of product IDs.')
+
+    if compression == 'infer':
+        compression = 'gzip' if Path(file_path).suffix == '.gz' else None
+    if compression not in ('gzip', None):
+        raise ValueError(f'Unknown compression: {compression}.')
+    with gzip.open(file_path, 'wb', compresslevel=6) if compression == 'gzip' else open(file_path, 'wb') as file:
+        file.write(b'user_id,product_id\n')
+        for start in range(0, len(user_ids), chunk_size):
+            file.write(get_submission_rows(user_ids[start:start + chunk_size], table[start:start + chunk_size]))
 
 
-def get_map10_by_days_rate(last_products: list[list[int]], prior_transactions: pd.DataFrame, days_rate: float):
+def get_map10_by_days_rate(last_products: list[list[int]], prior_transactions: pd.DataFrame, days_rate: float,
+                           dtypes: str = 'compact'):
     return get_prediction_precision(true=last_products,
-                                    prediction=get_prediction(
-                                        get_ratings(get_weights(prior_transactions, days_rate=days_rate))),
+                                    prediction=get_sparse_ratings(
+                                        get_weights(prior_transactions, days_rate=days_rate,
+                                                    dtypes=dtypes)).top_k(10),
                                     k=10)
 
 
 def get_map10_by_cart_rate(last_products: list[list[int]], prior_transactions: pd.DataFrame,
-                           days_rate: float, cart_rate: float):
+                           days_rate: float, cart_rate: float, dtypes: str = 'compact'):
     return get_prediction_precision(true=last_products,
-                                    prediction=get_prediction(
-                                        get_ratings(get_weights(prior_transactions,
-                                                                days_rate=days_rate, cart_rate=cart_rate))),
+                                    prediction=get_sparse_ratings(
+                                        get_weights(prior_transactions,
+                                                    days_rate=days_rate, cart_rate=cart_rate,
+                                                    dtypes=dtypes)).top_k(10),
                                     k=10)
 
 
 def get_map10_by_total_rate(last_products: list[list[int]], prior_transactions: pd.DataFrame,
-                            days_rate: float, cart_rate: float, total_rate: float):
+                            days_rate: float, cart_rate: float, total_rate: float, dtypes: str = 'compact'):
     return get_prediction_precision(true=last_products,
-                                    prediction=get_prediction(
-                                        get_ratings(get_weights(prior_transactions,
-                                                                days_rate=days_rate,
-                                                                cart_rate=cart_rate,
-                                                                ), total_rate=total_rate)),
+                                    prediction=get_sparse_ratings(
+                                        get_weights(prior_transactions,
+                                                    days_rate=days_rate,
+                                                    cart_rate=cart_rate,
+                                                    dtypes=dtypes,
+                                                    ), total_rate=total_rate).top_k(10),
                                     k=10)
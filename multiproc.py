@@ -3,11 +3,19 @@ Parallel data processing module.
 """
 
 import argparse
-from multiprocessing import Pool
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from os import PathLike
 from pathlib import Path
 import numpy as np
 import pandas as pd
 import functions as f
+from average_precision import to_csr
+from sparse_ratings import SparseRatings
+from columnar import save_columns, load_columns, columns_to_frame, is_columnar
+from profiler import Profiler, StageRecord, profile
 import pickle
 
 
@@ -23,95 +31,415 @@ def load_data(file_path):
     return data
 
 
-def get_map10_by_days_rates(precisions: pd.Series, data_path: Path) -> pd.Series:
+class TransactionStore:
+    """
+    Prior transactions and last user products shared by parallel workers.
+    The columns are published once into memory-mapped files, and every worker attaches to them
+    without copying, so memory consumption does not grow with the number of workers.
+    Only the path to the store and its token are pickled when it is sent to a worker.
+    """
+
+    def __init__(self, path: str | PathLike | None = None, token: str | None = None):
+        """
+        Attaches to the store published in the specified folder.
+        :param path: path to the store folder.
+        :param token: token of the store instance (a new one by default).
+        """
+
+        self.__path = None if path is None else Path(path)
+        self.__token = uuid.uuid4().hex if token is None else token
+        self.__prior_transactions = None
+        self.__last_products = None
+
+    @classmethod
+    def wrap(cls, prior_transactions: pd.DataFrame,
+             last_products: list[list[int]] | tuple[np.ndarray, np.ndarray]) -> 'TransactionStore':
+        """
+        Wraps prior transactions and last user products into a store kept in memory.
+        Such a store is suitable for workers sharing the memory of the calling process (threads, serial execution);
+        it is pickled together with the data.
+        :param prior_transactions: the transaction log of product purchases (except for the last transactions).
+        :param last_products: the list of product lists in the last user transactions
+        or the same lists packed into the CSR form.
+        :return: the store.
+        """
+
+        store = cls()
+        store.__prior_transactions = prior_transactions
+        store.__last_products = last_products if isinstance(last_products, tuple) else to_csr(last_products)
+        return store
+
+    @classmethod
+    def publish(cls, path: str | PathLike, prior_transactions: pd.DataFrame,
+                last_products: list[list[int]] | tuple[np.ndarray, np.ndarray]) -> 'TransactionStore':
+        """
+        Publishes prior transactions and last user products into the specified folder.
+        :param path: path to the store folder.
+        :param prior_transactions: the transaction log of product purchases (except for the last transactions).
+        :param last_products: the list of product lists in the last user transactions
+        or the same lists packed into the CSR form.
+        :return: the store.
+        """
+
+        path = Path(path)
+        if not isinstance(last_products, tuple):
+            last_products = to_csr(last_products)
+        offsets, product_ids = last_products
+        save_columns(path / 'prior_transactions', prior_transactions)
+        save_columns(path / 'last_products', {'offsets': offsets, 'product_ids': product_ids})
+        return cls(path)
+
+    @property
+    def path(self) -> Path | None:
+        """
+        Path to the store folder (``None`` for a store kept in memory).
+        """
+
+        return self.__path
+
+    @property
+    def key(self) -> str:
+        """
+        Key identifying the data of the store in the processes of the workers.
+        It is unique to the store instance, so the aggregates cached by the workers of a reused executor
+        (see ``get_aggregates``) are not taken for another store, even in the same folder rewritten meanwhile.
+        """
+
+        return f'{self.__path if self.__path is not None else "memory"}:{self.__token}'
+
+    @property
+    def prior_transactions(self) -> pd.DataFrame:
+        """
+        The transaction log of product purchases (except for the last transactions) backed by the store files.
+        """
+
+        if self.__prior_transactions is None:
+            columns, _ = load_columns(self.__path / 'prior_transactions')
+            self.__prior_transactions = columns_to_frame(columns)
+        return self.__prior_transactions
+
+    @property
+    def last_products(self) -> (np.ndarray, np.ndarray):
+        """
+        The product lists in the last user transactions in the CSR form.
+        """
+
+        if self.__last_products is None:
+            columns, _ = load_columns(self.__path / 'last_products')
+            self.__last_products = columns['offsets'], columns['product_ids']
+        return self.__last_products
+
+    def __getstate__(self):
+        if self.__path is None:
+            return {'path': None, 'token': self.__token, 'prior_transactions': self.__prior_transactions,
+                    'last_products': self.__last_products}
+        return {'path': self.__path, 'token': self.__token}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['token'])
+        if self.__path is None:
+            self.__prior_transactions = state['prior_transactions']
+            self.__last_products = state['last_products']
+
+
+class SerialExecutor(Executor):
+    """
+    Executor running the submitted calls immediately in the calling thread.
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:
+            future.set_exception(exc)
+        return future
+
+
+def get_executor(executor: str | Executor | None, workers: int) -> (Executor, bool):
+    """
+    Resolves the executor of parallel computations.
+    :param executor: executor instance or its kind:
+    - ``'process'`` - pool of worker processes.
+    - ``'thread'`` - pool of worker threads.
+    - ``'serial'`` - computations in the calling thread.
+    - ``None`` - pool of worker processes for several workers, otherwise serial computations.
+    :param workers: number of parallel workers.
+    :return: executor and the flag whether it has been created here (and has to be shut down by the caller).
+    """
+
+    if isinstance(executor, Executor):
+        return executor, False
+    if executor is None:
+        executor = 'process' if workers > 1 else 'serial'
+    match executor:
+        case 'process':
+            return ProcessPoolExecutor(workers), True
+        case 'thread':
+            return ThreadPoolExecutor(workers), True
+        case 'serial':
+            return SerialExecutor(), True
+        case _:
+            raise ValueError(f'Unknown executor `{executor}`.')
+
+
+def is_shared_memory_executor(executor: Executor) -> bool:
+    """
+    Checks whether the executor runs the calls in the memory of the calling process.
+    """
+
+    return isinstance(executor, (SerialExecutor, ThreadPoolExecutor))
+
+
+# Aggregates (histograms, ratings) built by the last call of a MAP@10 calculation function in this process.
+# The adaptive rate searches call the functions many times with the same fixed arguments,
+# and the aggregates are reused instead of being rebuilt from the transactions.
+_aggregates = {}
+_aggregates_lock = threading.Lock()
+
+
+def get_aggregates(key: tuple, build, *args, **kwargs):
+    """
+    Returns the aggregates cached by their key or builds them (the previous aggregates are released).
+    :param key: key of the aggregates (kind, store key and the arguments of the building).
+    :param build: function building the aggregates.
+    :param args: positional arguments of the function.
+    :param kwargs: keyword arguments of the function.
+    :return: aggregates.
+    """
+
+    with _aggregates_lock:
+        if key not in _aggregates:
+            _aggregates.clear()
+            _aggregates[key] = build(*args, **kwargs)
+        return _aggregates[key]
+
+
+def clear_aggregates():
+    """
+    Releases the aggregates cached in this process.
+    """
+
+    with _aggregates_lock:
+        _aggregates.clear()
+
+
+def get_total_ratings(prior_transactions: pd.DataFrame, days_rate: float, cart_rate: float,
+                      dtypes: str = 'compact') -> (SparseRatings, np.ndarray):
+    """
+    Builds the ratings without the filtering by popularity and the total ratings of the products.
+    """
+
+    ratings = f.get_sparse_ratings(f.get_weights(prior_transactions, days_rate=days_rate, cart_rate=cart_rate,
+                                                 dtypes=dtypes))
+    return ratings, ratings.total_ratings()
+
+
+def set_precision(precisions: pd.Series | pd.DataFrame, point, true: tuple[np.ndarray, np.ndarray],
+                  prediction: tuple[np.ndarray, np.ndarray], confidence: float | None = None):
+    """
+    Calculates the accuracy of the prediction for the MAP@10 metric at a filter coefficient value.
+    :param precisions: Pandas Series with MAP@10 values, or Pandas DataFrame with columns ``precision``,
+    ``lower`` and ``upper`` for the values with their bootstrap confidence intervals.
+    :param point: filter coefficient value (combination of values).
+    :param true: the product lists in the last user transactions in the CSR form.
+    :param prediction: the predicted products of the users in the CSR form.
+    :param confidence: confidence level of the intervals (see ``functions.get_prediction_precision_interval``).
+    """
+
+    if confidence is None:
+        precisions.at[point] = f.get_prediction_precision(true=true, prediction=prediction, k=10)
+    else:
+        precisions.loc[point, :] = f.get_prediction_precision_interval(true, prediction, 10, confidence)
+
+
+def get_map10_by_days_rates(precisions: pd.Series, store: TransactionStore, dtypes: str = 'compact',
+                            profiler: Profiler | None = None, confidence: float | None = None) -> pd.Series:
     """
     Calculates the accuracy of predictions for the MAP@10 metric obtained by filtering only by depth
     based on the number of days until the last transaction for different values of the coefficient filtering.
     :param precisions: Pandas Series whose index is a list of filter coefficient values,
     and np.nan values
-    :param data_path: path to the data folder.
+    :param store: shared store of prior transactions and last products.
+    :param dtypes: dtype policy of the weights (see ``functions.DTYPE_POLICIES``).
+    :param profiler: profiler measuring the histograms building and every coefficient value.
+    :param confidence: confidence level of the bootstrap intervals of the values (see ``set_precision``).
     :return: Pandas Series with ``MAP@10`` metric values
     """
 
-    prior_transactions = load_data(data_path / 'prior_transactions.pkl')
-    last_products = load_data(data_path / 'last_products.pkl')
+    prior_transactions = store.prior_transactions
+    last_products = store.last_products
+
+    with profile(profiler, 'days histogram', len(prior_transactions)):
+        histogram = get_aggregates(('days', store.key, dtypes), f.get_ratings_histogram,
+                                   prior_transactions, 'days_before_last_order', dtypes=dtypes)
 
     for days_rate in precisions.index:
-        map10 = f.get_prediction_precision(
-            true=last_products,
-            prediction=f.get_prediction(
-                f.get_ratings(
-                    f.get_weights(prior_transactions, days_rate=days_rate))),
-            k=10
-        )
-        precisions.at[days_rate] = map10
+        with profile(profiler, f'days_rate={days_rate:.5f}', len(histogram.weights)):
+            set_precision(precisions, days_rate, last_products, histogram.ratings(days_rate).top_k(10), confidence)
 
     return precisions
 
 
-def get_map10_by_cart_rates(precisions: pd.DataFrame, data_path: Path, days_rate: float):
+def get_map10_by_cart_rates(precisions: pd.DataFrame, store: TransactionStore, days_rate: float,
+                            dtypes: str = 'compact', profiler: Profiler | None = None,
+                            confidence: float | None = None):
     """
     Calculates the accuracy of predictions for the MAP@10 metric obtained by filtering by depth
     based on the number of days until the last transaction and filtering by the product added to the cart number
     for different values of the filter coefficient.
     :param precisions: Pandas Series whose index is a list of filter coefficient values,
     and the values are np.nan
-    :param data_path: path to the data folder.
+    :param store: shared store of prior transactions and last products.
     :param days_rate: filter coefficient by time.
+    :param dtypes: dtype policy of the weights (see ``functions.DTYPE_POLICIES``).
+    :param profiler: profiler measuring the histograms building and every coefficient value.
+    :param confidence: confidence level of the bootstrap intervals of the values (see ``set_precision``).
     :return: Pandas Series with ``MAP@10`` metric values.
     """
 
-    prior_transactions = load_data(data_path / 'prior_transactions.pkl')
-    last_products = load_data(data_path / 'last_products.pkl')
+    prior_transactions = store.prior_transactions
+    last_products = store.last_products
+
+    with profile(profiler, 'cart histogram', len(prior_transactions)):
+        histogram = get_aggregates(('cart', store.key, days_rate, dtypes), f.get_ratings_histogram,
+                                   prior_transactions, 'add_to_cart_order', days_rate=days_rate, dtypes=dtypes)
 
     for cart_rate in precisions.index:
-        map10 = f.get_prediction_precision(
-            true=last_products,
-            prediction=f.get_prediction(
-                f.get_ratings(
-                    f.get_weights(
-                        prior_transactions, days_rate=days_rate, cart_rate=cart_rate))),
-            k=10
-        )
-        precisions.at[cart_rate] = map10
+        with profile(profiler, f'cart_rate={cart_rate:.5f}', len(histogram.weights)):
+            set_precision(precisions, cart_rate, last_products, histogram.ratings(cart_rate).top_k(10), confidence)
 
     return precisions
 
 
-def get_map10_by_total_rates(precisions: pd.DataFrame, data_path: Path,
-                             days_rate: float, cart_rate: float):
+def get_map10_by_total_rates(precisions: pd.DataFrame, store: TransactionStore,
+                             days_rate: float, cart_rate: float, dtypes: str = 'compact',
+                             profiler: Profiler | None = None, confidence: float | None = None):
     """
     Calculates the prediction accuracy of a metric MAP@10 obtained by filtering by depth
     based on information about the number of days before the last transaction and filtering by the product addition number to the cart
     with different values of the filtering coefficient by global rating.
     :param precisions: Pandas Series, the index of which is a list of values of the filtering coefficient,
     and the values of np.nan
-    :param data_path: path to the folder with data.
+    :param store: shared store of prior transactions and last products.
     :param days_rate: filtering coefficient by time.
     :param cart_rate: filtering coefficient by the product addition number to the cart.
+    :param dtypes: dtype policy of the weights (see ``functions.DTYPE_POLICIES``).
+    :param profiler: profiler measuring the ratings building and every coefficient value.
+    :param confidence: confidence level of the bootstrap intervals of the values (see ``set_precision``).
     :return: Pandas Series with metric values ``MAP@10``
     """
 
-    prior_transactions = load_data(data_path / 'prior_transactions.pkl')
-    last_products = load_data(data_path / 'last_products.pkl')
+    prior_transactions = store.prior_transactions
+    last_products = store.last_products
 
-    weights = f.get_weights(prior_transactions, days_rate=days_rate, cart_rate=cart_rate)
-    ratings = f.get_ratings(weights).rename(columns={'rating': 'user_rating'})
-    total_ratings = f.get_total_ratings(weights).rename(columns={'rating': 'total_rating'})
-    ratings = ratings.merge(total_ratings, on='product_id', how='left')
+    with profile(profiler, 'ratings', len(prior_transactions)):
+        ratings, total_ratings = get_aggregates(('total', store.key, days_rate, cart_rate, dtypes), get_total_ratings,
+                                                prior_transactions, days_rate, cart_rate, dtypes)
 
     for rate in precisions.index:
-        ratings['rating'] = ratings['user_rating'] * np.exp(ratings['total_rating'] * rate)
-        map10 = f.get_prediction_precision(
-            true=last_products,
-            prediction=f.get_prediction(ratings),
-            k=10
-        )
-        precisions.at[rate] = map10
+        with profile(profiler, f'total_rate={rate:.5f}', ratings.nnz):
+            set_precision(precisions, rate, last_products, ratings.with_total_rate(rate, total_ratings).top_k(10),
+                          confidence)
+
+    return precisions
+
+
+def get_map10_by_joint_rates(precisions: pd.Series, store: TransactionStore, dtypes: str = 'compact',
+                             profiler: Profiler | None = None, confidence: float | None = None) -> pd.Series:
+    """
+    Calculates the prediction accuracy of a metric MAP@10 obtained by filtering by depth
+    based on the number of days before the last transaction, by the product addition number to the cart
+    and by global rating with different combinations of the filtering coefficients.
+    The ratings for every combination are calculated from the joint histograms of the transactions
+    (see ``functions.get_joint_ratings_histogram``).
+    :param precisions: Pandas Series, the index of which is a list of combinations of the filtering coefficients
+    (``days_rate``, ``cart_rate``, ``total_rate``), and the values of np.nan
+    :param store: shared store of prior transactions and last products.
+    :param dtypes: dtype policy of the transactions (the histograms weights are ``float64``).
+    :param profiler: profiler measuring the histograms building and every combination.
+    :param confidence: confidence level of the bootstrap intervals of the values (see ``set_precision``).
+    :return: Pandas Series with metric values ``MAP@10``
+    """
+
+    prior_transactions = store.prior_transactions
+    last_products = store.last_products
+
+    with profile(profiler, 'joint histogram', len(prior_transactions)):
+        histogram = get_aggregates(('joint', store.key, dtypes), f.get_joint_ratings_histogram, prior_transactions)
+
+    for days_rate, cart_rate, total_rate in precisions.index:
+        with profile(profiler, f'rates=({days_rate:.5f}, {cart_rate:.5f}, {total_rate:.5f})', histogram.n_entries):
+            set_precision(precisions, (days_rate, cart_rate, total_rate), last_products,
+                          histogram.ratings([days_rate, cart_rate]).with_total_rate(total_rate).top_k(10),
+                          confidence)
 
     return precisions
 
 
+RATE_NAMES = {
+    get_map10_by_days_rates: 'days_rate',
+    get_map10_by_cart_rates: 'cart_rate',
+    get_map10_by_total_rates: 'total_rate',
+    get_map10_by_joint_rates: ['days_rate', 'cart_rate', 'total_rate'],
+}
+
+
+def call_profiled(func, profiler: Profiler, *args, **kwargs) -> (object, list[StageRecord]):
+    """
+    Calls a MAP@10 calculation function with a profiler in a worker.
+    :return: result of the function and the records of the stages measured by the profiler.
+    """
+
+    return func(*args, profiler=profiler, **kwargs), profiler.records
+
+
+def get_map10_by_rates(executor: Executor, workers: int, func, points: np.array, store: TransactionStore,
+                       *args, dtypes: str = 'compact', profiler: Profiler | None = None,
+                       confidence: float | None = None) -> pd.Series | pd.DataFrame:
+    """
+    Calculates the accuracy of predictions for the MAP@10 metric at the filter coefficient values in parallel.
+    The values are distributed among the workers evenly, and each worker evaluates its share of them in one call.
+    :param executor: executor of the parallel computations.
+    :param workers: number of parallel workers.
+    :param func: MAP@10 calculation function (``get_map10_by_days_rates``, ``get_map10_by_cart_rates``,
+    ``get_map10_by_total_rates`` or ``get_map10_by_joint_rates``).
+    :param points: filter coefficient values (2D array of the combinations for ``get_map10_by_joint_rates``).
+    :param store: shared store of prior transactions and last products.
+    :param args: additional arguments of the calculation function (the fixed filter coefficients).
+    :param dtypes: dtype policy of the weights (see ``functions.DTYPE_POLICIES``).
+    :param profiler: profiler of the calling process. Every worker measures its stages by its own profiler,
+    and their records are added to this one nested into its current stage and marked by the worker number.
+    :param confidence: confidence level of the bootstrap intervals of the values.
+    :return: Pandas Series with ``MAP@10`` metric values, or Pandas DataFrame with columns ``precision``,
+    ``lower`` and ``upper`` of the values and their intervals if the confidence level is given.
+    """
+
+    if np.ndim(points) == 2:
+        index = pd.MultiIndex.from_arrays(np.transpose(points), names=RATE_NAMES[func])
+    else:
+        index = pd.Index(points, name=RATE_NAMES[func])
+    if confidence is None:
+        precisions = pd.Series(np.nan, index=index, name='precision')
+    else:
+        precisions = pd.DataFrame(np.nan, index=index, columns=['precision', 'lower', 'upper'])
+    chunks = [precisions.iloc[worker::workers].copy() for worker in range(min(workers, len(precisions)))]
+    if profiler is None:
+        futures = [executor.submit(func, chunk, store, *args, dtypes=dtypes, confidence=confidence)
+                   for chunk in chunks]
+        return pd.concat([future.result() for future in futures]).sort_index()
+
+    futures = [executor.submit(call_profiled, func, Profiler(), chunk, store, *args, dtypes=dtypes,
+                               confidence=confidence)
+               for chunk in chunks]
+    results = []
+    for worker, future in enumerate(futures):
+        result, records = future.result()
+        profiler.add(records, worker)
+        results.append(result)
+    return pd.concat(results).sort_index()
+
+
 if __name__ == '__main__':
 
     __spec__ = "ModuleSpec(name='builtins', loader=<class '_frozen_importlib.BuiltinImporter'>)"
@@ -133,33 +461,23 @@ if __name__ == '__main__':
     var_range = np.linspace(float(args.start), float(args.stop), int(args.num))
     func = locals()[args.func]
 
-    precisions = pd.DataFrame(
-        columns=['var', 'precision', 'worker'],
-        dtype=int
-    )
-
-    precisions['var'] = var_range
-    precisions['worker'] = precisions.index % WORKERS
-    precisions.set_index('var', inplace=True)
-
-    with Pool(WORKERS) as pool:
-        if func == get_map10_by_days_rates:
-            precisions.index.name = 'days_rate'
-            process_results = [pool.apply_async(func, (data, DATA_PATH))
-                               for _, data in precisions.groupby('worker')['precision']]
-        elif func == get_map10_by_cart_rates:
-            days_rate = float(args.days_rate)
-            precisions.index.name = 'cart_rate'
-            process_results = [pool.apply_async(func, (data, DATA_PATH, days_rate))
-                               for _, data in precisions.groupby('worker')['precision']]
-        elif func == get_map10_by_total_rates:
-            days_rate = float(args.days_rate)
-            cart_rate = float(args.cart_rate)
-            precisions.index.name = 'total_rate'
-            process_results = [pool.apply_async(func, (data, DATA_PATH, days_rate, cart_rate))
-                               for _, data in precisions.groupby('worker')['precision']]
-
-        result = pd.concat([process_result.get() for process_result in process_results]).sort_index()
+    # The data is published once into the shared store, and the workers attach to it without copying
+    with tempfile.TemporaryDirectory(dir=DATA_PATH) as tmpdir:
+        if is_columnar(DATA_PATH / 'prior_transactions'):
+            store = TransactionStore(DATA_PATH)
+        else:
+            store = TransactionStore.publish(tmpdir,
+                                             load_data(DATA_PATH / 'prior_transactions.pkl'),
+                                             load_data(DATA_PATH / 'last_products.pkl'))
+
+        with ProcessPoolExecutor(WORKERS) as executor:
+            if func == get_map10_by_days_rates:
+                result = get_map10_by_rates(executor, WORKERS, func, var_range, store)
+            elif func == get_map10_by_cart_rates:
+                result = get_map10_by_rates(executor, WORKERS, func, var_range, store, float(args.days_rate))
+            elif func == get_map10_by_total_rates:
+                result = get_map10_by_rates(executor, WORKERS, func, var_range, store,
+                                            float(args.days_rate), float(args.cart_rate))
 
     with open(DATA_PATH / 'precisions.pkl', 'wb') as fp:
         # noinspection PyTypeChecker
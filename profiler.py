@@ -0,0 +1,223 @@
+"""
+Stage-level instrumentation of the model: wall time, CPU time, peak memory and row counts.
+"""
+
+import contextlib
+import resource
+import threading
+import time
+import pandas as pd
+
+
+def get_rss() -> int:
+    """
+    Returns the resident set size of the process in bytes (its peak if the current size is not available).
+    """
+
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSMonitor:
+    """
+    Context manager sampling the resident set size of the process in a background thread
+    to find its peak inside the context.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """
+        :param interval: sampling interval in seconds.
+        """
+
+        self.__interval = interval
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.start_rss = 0
+        self.peak_rss = 0
+
+    def __sample(self):
+        while not self.__stop.wait(self.__interval):
+            self.peak_rss = max(self.peak_rss, get_rss())
+
+    def __enter__(self) -> 'RSSMonitor':
+        self.start_rss = self.peak_rss = get_rss()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__stop.set()
+        self.__thread.join()
+        self.peak_rss = max(self.peak_rss, get_rss())
+
+
+class StageRecord:
+    """
+    Measurements of a stage.
+    """
+
+    def __init__(self, name: str, rows: int | None = None, depth: int = 0):
+        """
+        :param name: stage name.
+        :param rows: number of rows processed by the stage (may be set inside the stage).
+        :param depth: nesting depth of the stage.
+        """
+
+        self.name = name
+        self.rows = rows
+        self.depth = depth
+        self.worker = None
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.peak_rss = 0
+        self.rss_growth = 0
+
+    def to_dict(self) -> dict:
+        """
+        Exports the measurements as a JSON-serializable dictionary (memory in megabytes).
+        """
+
+        return {
+            'stage': self.name,
+            'depth': self.depth,
+            'worker': self.worker,
+            'rows': self.rows,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'rows_per_second': self.rows / self.wall_time if self.rows is not None and self.wall_time > 0 else None,
+            'peak_rss_mb': self.peak_rss / 2 ** 20,
+            'rss_growth_mb': self.rss_growth / 2 ** 20,
+        }
+
+
+class ProfileReport:
+    """
+    Measurements of the stages in the order of their start.
+    """
+
+    def __init__(self, records: list[StageRecord]):
+        self.records = records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def to_dicts(self) -> list[dict]:
+        """
+        Exports the measurements as a list of JSON-serializable dictionaries (see ``StageRecord.to_dict``).
+        """
+
+        return [record.to_dict() for record in self.records]
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Exports the measurements as a dataframe.
+        """
+
+        return pd.DataFrame(self.to_dicts())
+
+    def __str__(self) -> str:
+        lines = [f'{"stage":<40} {"wall, s":>9} {"CPU, s":>9} {"rows":>11} {"peak RSS, MB":>13} {"growth, MB":>11}']
+        for record in self.records:
+            name = '  ' * record.depth + record.name + ('' if record.worker is None else f' [{record.worker}]')
+            rows = '' if record.rows is None else record.rows
+            lines.append(f'{name:<40} {record.wall_time:9.3f} {record.cpu_time:9.3f} {rows:>11} '
+                         f'{record.peak_rss / 2 ** 20:13.1f} {record.rss_growth / 2 ** 20:11.1f}')
+        return '\n'.join(lines)
+
+
+class Profiler:
+    """
+    Recorder of the measurements of nested stages.
+    Every stage is a context, which measures its wall time, CPU time of the process, peak resident set size
+    of the process and its growth. The stages of parallel workers are recorded by profilers of the workers
+    and added to the profiler of the calling process (see ``multiproc.get_map10_by_rates``).
+    """
+
+    def __init__(self, callback=None, rss_interval: float = 0.005):
+        """
+        :param callback: function called with every finished stage record (e.g. to log the progress).
+        :param rss_interval: sampling interval of the resident set size in seconds.
+        """
+
+        self.__callback = callback
+        self.__rss_interval = rss_interval
+        self.__depth = 0
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows: int | None = None):
+        """
+        Measures a stage.
+        :param name: stage name.
+        :param rows: number of rows processed by the stage (may be set to the yielded record inside the stage).
+        :return: context yielding the record of the stage.
+        """
+
+        record = StageRecord(name, rows, self.__depth)
+        self.records.append(record)
+        self.__depth += 1
+        try:
+            with RSSMonitor(self.__rss_interval) as monitor:
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                yield record
+                record.wall_time = time.perf_counter() - wall_start
+                record.cpu_time = time.process_time() - cpu_start
+            record.peak_rss = monitor.peak_rss
+            record.rss_growth = monitor.peak_rss - monitor.start_rss
+        finally:
+            self.__depth -= 1
+        if self.__callback is not None:
+            self.__callback(record)
+
+    def add(self, records: list[StageRecord], worker: int | None = None):
+        """
+        Adds the records of the stages measured by another profiler (e.g. of a parallel worker)
+        as the stages nested into the current stage.
+        :param records: records of the stages.
+        :param worker: number of the worker.
+        """
+
+        for record in records:
+            record.depth += self.__depth
+            record.worker = worker
+            self.records.append(record)
+            if self.__callback is not None:
+                self.__callback(record)
+
+    def report(self) -> ProfileReport:
+        """
+        Returns the measurements of the recorded stages.
+        """
+
+        return ProfileReport(list(self.records))
+
+    def __getstate__(self):
+        # The callback stays in the calling process
+        return {'rss_interval': self.__rss_interval}
+
+    def __setstate__(self, state):
+        self.__init__(rss_interval=state['rss_interval'])
+
+
+@contextlib.contextmanager
+def profile(profiler: Profiler | None, name: str, rows: int | None = None):
+    """
+    Measures a stage by the profiler if it is given.
+    :param profiler: profiler or ``None``.
+    :param name: stage name.
+    :param rows: number of rows processed by the stage.
+    :return: context yielding the record of the stage (not stored without a profiler).
+    """
+
+    if profiler is None:
+        yield StageRecord(name, rows)
+    else:
+        with profiler.stage(name, rows) as record:
+            yield record
@@ -1,14 +1,200 @@
+import functools
+import itertools
 import sys
-import subprocess
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Executor
 from os import PathLike
 
 import numpy as np
 import pandas as pd
 import functions as f
+import multiproc as mp
+from average_precision import to_csr
+from sparse_ratings import SparseRatings
+from segments import Segments, FillIndex, UserIndex
+from columnar import save_columns, load_columns, columns_to_frame
+from profiler import Profiler, ProfileReport, profile
 import tempfile
 import pathlib
 import pickle
+import json
+
+
+class Deferred:
+    """
+    Loader of a model component which is called on the first access to the component.
+    """
+
+    def __init__(self, load, *args):
+        self.load = load
+        self.args = args
+
+    def __call__(self):
+        return self.load(*self.args)
+
+
+class LazyComponent:
+    """
+    Model component attribute which is materialized on first access when it holds a ``Deferred`` loader.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = f'_lazy{name}'
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.name)
+        if isinstance(value, Deferred):
+            value = instance.__dict__[self.name] = value()
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+# Versions of the model states, unique among all models of the process (see ``Recommender.version``)
+_versions = itertools.count(1)
+
+
+class RecommendationCache:
+    """
+    Bounded cache of the recommendations of users by the model state (see ``Recommender.use_cache``).
+    Recommendations are kept per (model version, user ID, size) and evicted in the least recently used order
+    when the number of entries or their memory exceeds the limits, or when they expire.
+    The entries of the previous model versions are dropped at once when a new version is cached or requested.
+    The cache is thread-safe.
+    """
+
+    def __init__(self, max_entries: int = 100000, max_bytes: int = 64 * 2 ** 20, ttl: float | None = None):
+        """
+        :param max_entries: maximum number of entries.
+        :param max_bytes: maximum memory of the entries (their arrays and keys) in bytes.
+        :param ttl: lifetime of the entries in seconds (``None`` - unlimited).
+        """
+
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__user_keys = {}
+        self.__version = None
+        self.__lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __set_version(self, version: int):
+        if version != self.__version:
+            self.__clear()
+            self.__version = version
+
+    def __clear(self):
+        self.__entries.clear()
+        self.__user_keys.clear()
+        self.nbytes = 0
+
+    def __remove(self, key: tuple):
+        _, row, size = self.__entries.pop(key)
+        self.nbytes -= size
+        keys = self.__user_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.__user_keys[key[0]]
+
+    def get_many(self, version: int, user_ids: list[int], k: int) -> dict[int, np.ndarray]:
+        """
+        Finds the cached recommendations of users.
+        :param version: model version.
+        :param user_ids: user IDs.
+        :param k: size of the recommendations.
+        :return: product IDs recommended to the found users by their IDs.
+        """
+
+        now = time.monotonic()
+        found = {}
+        with self.__lock:
+            self.__set_version(version)
+            for user_id in user_ids:
+                key = (user_id, k)
+                entry = self.__entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] is not None and entry[0] <= now:
+                    self.__remove(key)
+                    continue
+                self.__entries.move_to_end(key)
+                found[user_id] = entry[1]
+            self.hits += len(found)
+            self.misses += len(user_ids) - len(found)
+        return found
+
+    def put_many(self, version: int, user_ids: np.ndarray, product_ids: np.ndarray, k: int):
+        """
+        Caches the recommendations of users.
+        :param version: model version.
+        :param user_ids: user IDs.
+        :param product_ids: matrix of the product IDs recommended to the users.
+        :param k: size of the recommendations.
+        """
+
+        expires = None if self.__ttl is None else time.monotonic() + self.__ttl
+        with self.__lock:
+            self.__set_version(version)
+            for user_id, row in zip(user_ids.tolist(), product_ids):
+                key = (user_id, k)
+                if key in self.__entries:
+                    self.__remove(key)
+                row = row.copy()
+                row.flags.writeable = False
+                size = sys.getsizeof(row) + sys.getsizeof(key)
+                self.__entries[key] = (expires, row, size)
+                self.__user_keys.setdefault(user_id, set()).add(key)
+                self.nbytes += size
+            while self.__entries and (len(self.__entries) > self.__max_entries or self.nbytes > self.__max_bytes):
+                self.__remove(next(iter(self.__entries)))
+
+    def invalidate(self, user_ids: list[int] | None = None):
+        """
+        Drops the cached recommendations.
+        :param user_ids: IDs of the users whose recommendations of all sizes are dropped (``None`` - all users).
+        """
+
+        with self.__lock:
+            if user_ids is None:
+                self.__clear()
+                return
+            for user_id in user_ids:
+                for key in list(self.__user_keys.get(user_id, ())):
+                    self.__remove(key)
+
+
+class ObservedUser:
+    """
+    Recommendation components of a user updated by the orders observed after the fitting
+    (see ``Recommender.observe_order``).
+    """
+
+    def __init__(self, ratings: SparseRatings, aisle_ranks: pd.DataFrame, user_index: UserIndex,
+                 fill_index: FillIndex, recommendations: np.ndarray):
+        """
+        :param ratings: product ratings of the user.
+        :param aisle_ranks: aisle ranks of the user.
+        :param user_index: top products of the user.
+        :param fill_index: offset indexes of the aisle ranks of the user and of the ranks inside the aisles.
+        :param recommendations: materialized recommendations of the user.
+        """
+
+        self.ratings = ratings
+        self.aisle_ranks = aisle_ranks
+        self.user_index = user_index
+        self.fill_index = fill_index
+        self.recommendations = recommendations
 
 
 class Recommender:
@@ -28,6 +214,26 @@ class Recommender:
     __cart_rate_degree = 3
     __total_rate_points = np.linspace(0.0, 1.0, 21)
     __total_rate_degree = 3
+    __days_rate_tolerance = 0.005
+    __cart_rate_tolerance = 0.0025
+    __total_rate_tolerance = 0.05
+    __validation_confidence = 0.95
+    __FILTERINGS = ('days', 'cart', 'total')
+    __FORMAT = 'recommender-columnar'
+    __FORMAT_VERSION = 1
+    __MANIFEST_FILE = 'manifest.json'
+    __weights = LazyComponent()
+    __ratings = LazyComponent()
+    __product_ratings = LazyComponent()
+    __products = LazyComponent()
+    __aisle_ranks = LazyComponent()
+    __inside_aisle_ranks = LazyComponent()
+    __fill_index = LazyComponent()
+    __user_ids = LazyComponent()
+    __user_index = LazyComponent()
+    __recommendations = LazyComponent()
+    __product_names = LazyComponent()
+    __product_aisles = LazyComponent()
 
     def __init__(self):
         self.__days_rate = 0.
@@ -37,12 +243,29 @@ class Recommender:
         self.__total_rate = 0.
         self.__total_map10 = 0.
         self.__weights = pd.DataFrame()
-        self.__ratings = pd.DataFrame()
+        self.__ratings = None
+        self.__product_ratings = None
         self.__products = pd.DataFrame()
         self.__aisle_ranks = pd.DataFrame()
         self.__inside_aisle_ranks = pd.DataFrame()
-        self.__tmpdir = ''
+        self.__fill_index = None
+        self.__user_index = None
+        self.__recommendations = None
+        self.__product_names = None
+        self.__product_aisles = None
+        self.__observed = {}
+        self.__observed_lock = threading.Lock()
+        self.__cache = None
+        self.__version = 0
+        self.__observations = 0
+        self.__executor = None
+        self.__store = None
+        self.__profiler = None
+        self.__search_methods = dict.fromkeys(self.__FILTERINGS, 'grid')
+        self.__search_points = {}
+        self.__confidence = None
         self.__workers = 0
+        self.__dtypes = 'compact'
         self.__user_ids = []
         self.__fitted = False
 
@@ -55,38 +278,77 @@ class Recommender:
 
         return wrapper
 
-    def __multiprocessing(self, points: np.array, func: str):
+    def __multiprocessing(self, points: np.array, func) -> pd.Series:
         """
-        Runs the parallel computing script multiproc.py with the required parameters.
+        Calculates MAP@10 values at the filter rate values on the executor of the model fitting.
         :param points: filter rate values.
-        :param func: MAP@10 calculation function.
-        :return: MAP@10 values dataframe.
+        :param func: MAP@10 calculation function of the ``multiproc`` module.
+        :return: MAP@10 values series.
         """
 
-        cmd = f'{sys.executable} multiproc.py --workers={self.__workers} --data_path={self.__tmpdir} ' \
-              f'--start={points[0]} --stop={points[-1]} --num={len(points)} --func={func} ' \
-              f'--days_rate={self.__days_rate} --cart_rate={self.__cart_rate}'
-        subprocess.run(cmd)
-        with open(f'{self.__tmpdir}/precisions.pkl', 'rb') as fp:
-            # noinspection PyTypeChecker
-            map10 = pickle.load(fp)
-        return map10
+        args = {
+            mp.get_map10_by_days_rates: (),
+            mp.get_map10_by_cart_rates: (self.__days_rate,),
+            mp.get_map10_by_total_rates: (self.__days_rate, self.__cart_rate),
+            mp.get_map10_by_joint_rates: (),
+        }[func]
+        return mp.get_map10_by_rates(self.__executor, self.__workers, func, points, self.__store, *args,
+                                     dtypes=self.__dtypes, profiler=self.__profiler, confidence=self.__confidence)
+
+    def __evaluate(self, func, evaluated: list, points: np.ndarray) -> pd.Series:
+        """
+        Calculates MAP@10 values at the filter rate values for a search and collects them
+        (with their confidence intervals on a validation sample).
+        :param func: MAP@10 calculation function of the ``multiproc`` module.
+        :param evaluated: list collecting the calculated values.
+        :param points: filter rate values.
+        :return: MAP@10 values series.
+        """
+
+        precisions = self.__multiprocessing(points, func)
+        evaluated.append(precisions)
+        return precisions['precision'] if isinstance(precisions, pd.DataFrame) else precisions
+
+    def __search_rate(self, filtering: str, func, points: np.ndarray, degree: int, tolerance: float) \
+            -> (pd.Series, np.ndarray | None, float):
+        """
+        Searches for the optimal value of the filter rate by the search method of the filtering.
+        :param filtering: filtering name (``days``, ``cart`` or ``total``).
+        :param func: MAP@10 calculation function of the ``multiproc`` module.
+        :param points: filter rate values of the grid search (their range bounds the adaptive searches).
+        :param degree: degree of the polynomial approximation of the grid search.
+        :param tolerance: tolerance of the optimal value of the adaptive searches.
+        :return: MAP@10 values at the evaluated rates, their approximation (the grid search only)
+        and the optimal rate.
+        """
+
+        method = self.__search_methods[filtering]
+        evaluated = []
+        evaluate = functools.partial(self.__evaluate, func, evaluated)
+        if method == 'grid':
+            map10 = evaluate(points)
+            map10_predicted, rate = f.approximate_precision_by_rate(points, map10, degree)
+        else:
+            map10, rate = f.search_optimal_rate(evaluate, points.min(), points.max(), tolerance, method,
+                                                self.__workers)
+            map10_predicted = None
+        self.__search_points[filtering] = pd.concat(evaluated).sort_index()
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'`{filtering}_rate` {method} search: {len(map10)} evaluations.')
+        return self.__search_points[filtering], map10_predicted, rate
 
     def __search_optimal_days_rate(self, prior_transactions: pd.DataFrame, last_products: [int]):
         """
         Searches for the optimal value of the filtration rate over time.
         """
         
-        self.__days_rate_map10 = self.__multiprocessing(self.__days_rate_points, 'get_map10_by_days_rates')
+        self.__days_rate_map10, self.__days_rate_map10_predicted, self.__days_rate = self.__search_rate(
+            'days', mp.get_map10_by_days_rates, self.__days_rate_points, self.__days_rate_degree,
+            self.__days_rate_tolerance)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
               f'`days_rates` points: {self.__days_rate_map10}')
-        self.__days_rate_map10_predicted, self.__days_rate = \
-            f.approximate_precision_by_rate(self.__days_rate_points, self.__days_rate_map10, self.__days_rate_degree)
-        self.__days_map10 = f.get_prediction_precision(
-            last_products, f.get_prediction(
-                f.get_ratings(
-                    f.get_weights(
-                        prior_transactions, self.__days_rate))))
+        self.__days_map10 = f.get_map10_by_days_rate(last_products, prior_transactions, self.__days_rate,
+                                                     self.__dtypes)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
               f'optimal `days_rate` value found: {self.__days_rate:.5f}, MAP@10={self.__days_map10:.5f}')
 
@@ -95,16 +357,13 @@ class Recommender:
         Searches for the optimal value of the filter rate by the number of adding a product to the cart.
         """
         
-        self.__cart_rate_map10 = self.__multiprocessing(self.__cart_rate_points, 'get_map10_by_cart_rates')
+        self.__cart_rate_map10, self.__cart_rate_map10_predicted, self.__cart_rate = self.__search_rate(
+            'cart', mp.get_map10_by_cart_rates, self.__cart_rate_points, self.__cart_rate_degree,
+            self.__cart_rate_tolerance)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
               f'`cart_rates` points: {self.__cart_rate_map10}')
-        self.__cart_rate_map10_predicted, self.__cart_rate = \
-            f.approximate_precision_by_rate(self.__cart_rate_points, self.__cart_rate_map10, self.__cart_rate_degree)
-        self.__cart_map10 = f.get_prediction_precision(
-            last_products, f.get_prediction(
-                f.get_ratings(
-                    f.get_weights(
-                        prior_transactions, self.__days_rate, self.__cart_rate))))
+        self.__cart_map10 = f.get_map10_by_cart_rate(last_products, prior_transactions,
+                                                     self.__days_rate, self.__cart_rate, self.__dtypes)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
               f'optimal `cart_rate` value found: {self.__cart_rate:.5f}, MAP@10={self.__cart_map10:.5f}')
 
@@ -113,70 +372,496 @@ class Recommender:
         Searches for the optimal value of the filter rate by popularity.
         """
         
-        self.__total_rate_map10 = self.__multiprocessing(self.__total_rate_points, 'get_map10_by_total_rates')
+        self.__total_rate_map10, self.__total_rate_map10_predicted, self.__total_rate = self.__search_rate(
+            'total', mp.get_map10_by_total_rates, self.__total_rate_points, self.__total_rate_degree,
+            self.__total_rate_tolerance)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
               f'`total_rate` points: {self.__total_rate_map10}')
-        self.__total_rate_map10_predicted, self.__total_rate = \
-            f.approximate_precision_by_rate(self.__total_rate_points, self.__total_rate_map10, self.__total_rate_degree)
-        self.__total_map10 = f.get_prediction_precision(
-            last_products, f.get_prediction(
-                f.get_ratings(f.get_weights(
-                    prior_transactions, self.__days_rate, self.__cart_rate),
-                    self.__total_rate)))
+        self.__total_map10 = f.get_map10_by_total_rate(last_products, prior_transactions,
+                                                       self.__days_rate, self.__cart_rate, self.__total_rate,
+                                                       self.__dtypes)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
               f'optimal `total_rate` value found: {self.__total_rate:.5f}, MAP@10={self.__total_map10:.5f}')
 
-    def fit(self, products: pd.DataFrame, transactions: pd.DataFrame, workers: int = 4):
+    def __search_optimal_rates_joint(self, prior_transactions: pd.DataFrame, last_products: [int]):
+        """
+        Searches for the optimal combination of the filtration rates over time, by the number of adding a product
+        to the cart and by popularity jointly (see ``functions.search_optimal_rates_joint``).
+        A fitted model starts the search from its rates.
+        """
+
+        bounds = np.array([[points.min(), points.max()] for points in
+                           (self.__days_rate_points, self.__cart_rate_points, self.__total_rate_points)])
+        tolerances = np.array([self.__days_rate_tolerance, self.__cart_rate_tolerance, self.__total_rate_tolerance])
+        start = [self.__days_rate, self.__cart_rate, self.__total_rate] if self.__fitted else None
+        evaluated = []
+        map10, rates = f.search_optimal_rates_joint(
+            functools.partial(self.__evaluate, mp.get_map10_by_joint_rates, evaluated), bounds, tolerances, start)
+        self.__days_rate, self.__cart_rate, self.__total_rate = rates.tolist()
+        self.__search_points['joint'] = pd.concat(evaluated).sort_index()
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'joint search: {len(map10)} evaluations, best MAP@10={map10.max():.5f}.')
+
+        self.__days_map10 = f.get_map10_by_days_rate(last_products, prior_transactions, self.__days_rate,
+                                                     self.__dtypes)
+        self.__cart_map10 = f.get_map10_by_cart_rate(last_products, prior_transactions,
+                                                     self.__days_rate, self.__cart_rate, self.__dtypes)
+        self.__total_map10 = f.get_map10_by_total_rate(last_products, prior_transactions,
+                                                       self.__days_rate, self.__cart_rate, self.__total_rate,
+                                                       self.__dtypes)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'optimal rates found: `days_rate`={self.__days_rate:.5f}, `cart_rate`={self.__cart_rate:.5f}, '
+              f'`total_rate`={self.__total_rate:.5f}, MAP@10={self.__total_map10:.5f}')
+
+    def fit(self, products: pd.DataFrame, transactions: pd.DataFrame | str | PathLike, workers: int = 4,
+            executor: str | Executor | None = None, dtypes: str = 'compact',
+            profiler: Profiler | None = None, search: str | dict[str, str] = 'grid',
+            validation_sample: float | int | None = None, validation_recheck: bool = True) -> ProfileReport | None:
         """
         Computes optimal rates for filtering.
         :var products: Products registry.
-        :var transactions: Transactions log.
+        :var transactions: Transactions log, or path to the transactions preprocessed by
+        ``functions.preprocess_transactions_sharded`` (for logs larger than memory), which are memory-mapped.
+        Their weights are aggregated into the ratings by chunks and are not kept (the model is saved without them).
+        :var workers: Number of parallel workers.
+        :var executor: Executor of the rates search or its kind (see ``multiproc.get_executor``):
+        ``'process'``, ``'thread'``, ``'serial'`` or ``None`` (processes for several workers, otherwise serial).
+        An executor instance is used as is and is not shut down.
+        :var dtypes: Dtype policy of the transactions and weights (see ``functions.DTYPE_POLICIES``):
+        ``'compact'`` (narrow integer columns and ``float32`` weights) or ``'wide'`` (``int64`` and ``float64``).
+        The types of preprocessed transactions are defined at their preprocessing.
+        :var profiler: Profiler measuring wall time, CPU time, peak memory and number of rows of the fitting stages:
+        preprocessing, search of every rate with its points evaluated by the workers, weights, ratings,
+        aisle ranks, ranks inside aisles, fill index and materialized recommendations.
+        :var search: Search method of the optimal rates (see ``functions.RATE_SEARCH_METHODS``), or the methods
+        by filtering names (``days``, ``cart``, ``total``; ``'grid'`` for the missing ones):
+        - ``'grid'`` - polynomial approximation of MAP@10 at the fixed grid of 21 rates.
+        - ``'golden'`` - golden-section search evaluating one rate per iteration (about 7 evaluations).
+        - ``'refine'`` - successive refinement of the grid around the best rate evaluating a batch of rates
+        per iteration on all the workers.
+        Alternatively, ``'joint'`` searches for all the rates jointly by the compass search over the combinations
+        of the rates evaluated in parallel batches from the joint histograms of the transactions
+        (see ``functions.search_optimal_rates_joint``). The search of a fitted model starts from its rates.
+        The numbers of evaluations are reported by ``get_evaluations``.
+        :var validation_sample: Share (not greater than 1) or number of users of the deterministic sample
+        stratified by the users activity (see ``functions.get_validation_sample``), on which the rates are searched.
+        MAP@10 values of the searches are reported with their bootstrap confidence intervals
+        (see ``get_search_points``). ``None`` - all users.
+        :var validation_recheck: Check MAP@10 of the found rates on all users (see ``get_eval_map10``)
+        instead of the sample.
+        :return: Report of the profiler (``None`` without a profiler).
         """
 
+        joint = search == 'joint'
+        methods = {} if joint else search if isinstance(search, dict) else dict.fromkeys(self.__FILTERINGS, search)
+        for filtering, method in methods.items():
+            if filtering not in self.__FILTERINGS or method not in f.RATE_SEARCH_METHODS:
+                raise ValueError(f'Unknown rate search method `{method}` of filtering `{filtering}`.')
+        self.__search_methods = {filtering: methods.get(filtering, 'grid') for filtering in self.__FILTERINGS}
+        self.__search_points = {}
+
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: fitting...')
         self.__products = products
-        prior_transactions, last_transactions, last_products = f.preprocess_transactions(transactions)
-        transactions = prior_transactions.copy()
-        transactions['days_before_last_order'] += transactions['days_before_last_order_shift']
-        transactions = pd.concat([transactions, last_transactions])
+        self.__dtypes = dtypes
+        self.__profiler = profiler
+        if isinstance(transactions, pd.DataFrame):
+            data_path = None
+            with profile(profiler, 'preprocessing', len(transactions)):
+                prior_transactions, last_transactions, last_products = f.preprocess_transactions(transactions, dtypes)
+                last_products = to_csr(last_products)
+        else:
+            data_path = pathlib.Path(transactions)
+            with profile(profiler, 'preprocessing') as stage:
+                prior_transactions, last_transactions, last_products = f.read_preprocessed_transactions(data_path)
+                stage.rows = len(prior_transactions) + len(last_transactions)
+        if validation_sample is None:
+            search_transactions, search_products = prior_transactions, last_products
+            self.__confidence = None
+        else:
+            with profile(profiler, 'validation sample') as stage:
+                search_transactions, search_products = f.get_validation_sample(prior_transactions, last_products,
+                                                                               validation_sample)
+                stage.rows = len(search_transactions)
+            self.__confidence = self.__validation_confidence
+            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+                  f'validation sample: {len(search_products[0]) - 1} users.')
+        check_transactions, check_products = (prior_transactions, last_products) if validation_recheck \
+            else (search_transactions, search_products)
         self.__workers = workers
+        self.__executor, own_executor = mp.get_executor(executor, workers)
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            self.__tmpdir = pathlib.Path(tmpdir)
-            with open(self.__tmpdir / 'prior_transactions.pkl', 'wb') as fp:
-                # noinspection PyTypeChecker
-                pickle.dump(prior_transactions, fp)
-            with open(self.__tmpdir / 'last_products.pkl', 'wb') as fp:
-                # noinspection PyTypeChecker
-                pickle.dump(last_products, fp)
-            self.__search_optimal_days_rate(prior_transactions, last_products)
-            self.__search_optimal_cart_rate(prior_transactions, last_products)
-            self.__search_optimal_total_rate(prior_transactions, last_products)
-
-
-        self.__weights = f.get_weights(transactions, self.__days_rate, self.__cart_rate)
-        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: weights calculated.')
-        self.__ratings = f.get_ratings(self.__weights, self.__total_rate)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                # Workers in separate processes attach to the data published into memory-mapped files
+                # (the preprocessed transactions are published already), the others share it with the calling process
+                if data_path is not None and validation_sample is None:
+                    self.__store = mp.TransactionStore(data_path)
+                elif mp.is_shared_memory_executor(self.__executor):
+                    self.__store = mp.TransactionStore.wrap(search_transactions, search_products)
+                else:
+                    self.__store = mp.TransactionStore.publish(tmpdir, search_transactions, search_products)
+                if joint:
+                    with profile(profiler, 'joint rate search', len(search_transactions)):
+                        self.__search_optimal_rates_joint(check_transactions, check_products)
+                else:
+                    with profile(profiler, 'days_rate search', len(search_transactions)):
+                        self.__search_optimal_days_rate(check_transactions, check_products)
+                    with profile(profiler, 'cart_rate search', len(search_transactions)):
+                        self.__search_optimal_cart_rate(check_transactions, check_products)
+                    with profile(profiler, 'total_rate search', len(search_transactions)):
+                        self.__search_optimal_total_rate(check_transactions, check_products)
+                self.__store = None
+        finally:
+            if own_executor:
+                self.__executor.shutdown()
+            self.__executor = None
+            self.__profiler = None
+            mp.clear_aggregates()
+
+        if data_path is None:
+            with profile(profiler, 'weights', len(prior_transactions) + len(last_transactions)):
+                self.__weights = pd.concat([
+                    f.get_weights(prior_transactions, self.__days_rate, self.__cart_rate, shifted=True, dtypes=dtypes),
+                    f.get_weights(last_transactions, self.__days_rate, self.__cart_rate, dtypes=dtypes),
+                ], ignore_index=True)
+            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: weights calculated.')
+        else:
+            # The weights of the preprocessed transactions are aggregated by chunks and are not kept
+            self.__weights = None
+        with profile(profiler, 'ratings', len(prior_transactions) + len(last_transactions)):
+            if data_path is None:
+                frequencies = f.get_sparse_ratings(self.__weights)
+            else:
+                frequencies = SparseRatings.from_parts([
+                    f.get_sparse_ratings_by_chunks(prior_transactions, self.__days_rate, self.__cart_rate,
+                                                   shifted=True, dtypes=dtypes),
+                    f.get_sparse_ratings_by_chunks(last_transactions, self.__days_rate, self.__cart_rate,
+                                                   dtypes=dtypes),
+                ])
+            total_ratings = frequencies.total_ratings()
+            self.__ratings = frequencies.with_total_rate(self.__total_rate, total_ratings)
+            self.__product_ratings = f.get_product_ratings(self.__ratings, total_ratings)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: ratings compiled.')
-        self.__aisle_ranks = f.get_aisle_ranks(self.__ratings, self.__products)
+        with profile(profiler, 'aisle ranks', self.__ratings.nnz) as stage:
+            self.__aisle_ranks = f.get_aisle_ranks(self.__ratings, self.__products)
+            stage.rows = len(self.__aisle_ranks)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: aisles ranked.')
-        self.__inside_aisle_ranks = f.get_inside_aisle_ranks(self.__ratings, self.__products)
+        with profile(profiler, 'inside-aisle ranks', self.__ratings.nnz) as stage:
+            self.__inside_aisle_ranks = f.get_inside_aisle_ranks(self.__ratings, self.__products)
+            stage.rows = len(self.__inside_aisle_ranks)
         print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: products inside aisles ranked.')
+        with profile(profiler, 'fill index', len(self.__aisle_ranks) + len(self.__inside_aisle_ranks)):
+            self.__fill_index = FillIndex.from_ranks(self.__aisle_ranks, self.__inside_aisle_ranks)
+        with profile(profiler, 'materialization', self.__ratings.n_users):
+            self.__materialize()
         print('-----------------------------------------------------------------')
 
-        self.__user_ids = self.__ratings['user_id'].unique().tolist()
+        self.__user_ids = self.__ratings.user_ids.tolist()
+        self.__product_names = Deferred(self.__build_product_names)
+        self.__product_aisles = Deferred(self.__index_product_aisles)
+        self.__observed = {}
+        self.__version = next(_versions)
 
         self.__fitted = True
+        return None if profiler is None else profiler.report()
+
+    def __materialize(self, k_max: int = 10):
+        """
+        Builds the user index and the recommendations of all users of size ``k_max``.
+        """
+
+        self.__user_index = UserIndex.from_ratings(self.__ratings, k_max)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: users indexed.')
+        self.__recommendations = f.get_recommendation_matrix(self.__user_index, self.__fill_index, k_max)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: recommendations materialized.')
+
+    @__check_fitted
+    def materialize(self, k_max: int = 10):
+        """
+        Precomputes the filled recommendations of all users, so recommendations of any size up to ``k_max``
+        are slices of the precomputed table. Fitting materializes recommendations of size 10.
+        The table is saved with the model.
+        :param k_max: Maximum size of recommendations.
+        """
+
+        self.__materialize(k_max)
+        self.__version = next(_versions)
 
-    def load(self, path: str | PathLike):
+    @__check_fitted
+    def update(self, new_transactions: pd.DataFrame, profiler: Profiler | None = None) -> ProfileReport | None:
+        """
+        Updates the model by the transactions of new orders (e.g. a daily batch) with the fitted rates.
+        The ratings of the users of the new orders are aged by the days since their previous last orders
+        and merged with the weights of the new transactions (see ``functions.get_updated_ratings``);
+        the popularity of products is kept from the fitting until the next one.
+        Only the aisle ranks of these users, the ranks inside the aisles of their products,
+        and the materialized recommendations of these users and of the users supplemented from the aisles are
+        recomputed, so the update costs time proportional to the new transactions and their users' histories,
+        apart from the linear copying of the merged tables.
+        The transactions weights of the fitting are dropped (the updated model is saved without them).
+        The orders observed by ``observe_order`` are merged into the model tables before the update.
+        :param new_transactions: Transactions log of the new orders with the columns of the fitted log.
+        The first new order of a known user continues its history, so its ``days_since_prior_order``
+        counts from the last known order.
+        :param profiler: Profiler measuring the update stages (see ``fit``).
+        :return: Report of the profiler (``None`` without a profiler).
+        """
+
+        self.__check_updatable()
+        self.__merge_observed()
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'updating by {len(new_transactions)} transactions...')
+        with profile(profiler, 'preprocessing', len(new_transactions)):
+            transactions, gaps = f.preprocess_new_transactions(new_transactions, self.__dtypes)
+        with profile(profiler, 'weights', len(transactions)):
+            weights = f.get_weights(transactions, self.__days_rate, self.__cart_rate, dtypes=self.__dtypes)
+        with profile(profiler, 'ratings', len(weights)) as stage:
+            previous, updated = f.get_updated_ratings(self.__ratings, self.__product_ratings, weights, gaps,
+                                                      self.__days_rate, self.__total_rate)
+            stage.rows = updated.nnz
+        self.__merge_ratings(previous, updated, profiler)
+
+        self.__weights = None
+        return None if profiler is None else profiler.report()
+
+    @__check_fitted
+    def observe_order(self, user_id: int, products: list[int] | np.ndarray, days_since_prior_order: float = 0.):
+        """
+        Updates the recommendations of a user by its new order, so the following recommendations to the user
+        reflect the order (see ``update`` for batches of orders).
+        The ratings of the user are aged and merged with the weights of the order as by ``update``,
+        and the aisle ranks, the top products and the materialized recommendations of the user are recomputed,
+        which costs time proportional to the order and the history of the user.
+        The other users, the ranks inside aisles and the popularity of products are not changed.
+        The components of the user are kept apart and replace the model tables in ``recommend``,
+        so the tables are not modified (e.g. when they are memory-mapped and shared by serving processes).
+        The observed orders are merged into the tables by ``update`` and ``save``.
+        The cached recommendations of the user are dropped (see ``use_cache``).
+        Concurrent calls are serialized, and concurrent recommendations get either the previous
+        or the updated recommendations of the user.
+        :param user_id: ID of the user (a new user is added).
+        :param products: IDs of the ordered products in the order of their addition to the cart.
+        :param days_since_prior_order: Days since the previous order of the user.
+        """
+
+        self.__check_updatable()
+        products = np.asarray(products, dtype=self.__ratings.product_ids.dtype)
+        transactions = pd.DataFrame({
+            'user_id': np.full(len(products), user_id, dtype=self.__ratings.user_ids.dtype),
+            'product_id': products,
+            'days_before_last_order': np.zeros(len(products), dtype=np.int64),
+            'add_to_cart_order': np.arange(1, len(products) + 1),
+        })
+        weights = f.get_weights(transactions, self.__days_rate, self.__cart_rate, dtypes=self.__dtypes)
+        gaps = pd.DataFrame({'user_id': [user_id], 'days': [days_since_prior_order]})
+
+        with self.__observed_lock:
+            observed = self.__observed.get(user_id)
+            ratings = self.__ratings.take_users(user_id) if observed is None else observed.ratings
+            _, ratings = f.get_updated_ratings(ratings, self.__product_ratings, weights, gaps,
+                                               self.__days_rate, self.__total_rate)
+            aisle_ranks = f.get_aisle_ranks(ratings, self.__product_aisles)
+            fill_index = FillIndex(Segments.from_frame(aisle_ranks), aisle_ranks['aisle_id'].to_numpy(),
+                                   self.__fill_index.aisle_products, self.__fill_index.product_ids)
+            user_index = UserIndex.from_ratings(ratings, self.__user_index.k_max)
+            recommendations = f.get_recommendation_matrix(user_index, fill_index, self.__recommendations.shape[1])
+            self.__observed[user_id] = ObservedUser(ratings, aisle_ranks, user_index, fill_index, recommendations)
+            self.__observations += 1
+            if self.__cache is not None:
+                self.__cache.invalidate([user_id])
+
+    def __check_updatable(self):
+        if self.__product_ratings is None:
+            raise ValueError('The model can not be updated: it is loaded without the transactions weights, '
+                             'which are needed to restore the popularity of products.')
+
+    def __merge_observed(self):
+        """
+        Merges the components of the users updated by the observed orders into the model tables.
+        """
+
+        with self.__observed_lock:
+            if not self.__observed:
+                return
+            observed = [user.ratings for user in self.__observed.values()]
+            updated = SparseRatings.from_arrays(
+                np.concatenate([ratings.user_ids[ratings.rows] for ratings in observed]),
+                np.concatenate([ratings.product_ids[ratings.indices] for ratings in observed]),
+                np.concatenate([ratings.data for ratings in observed]))
+            self.__merge_ratings(self.__ratings.take_users(updated.user_ids), updated)
+            self.__observed = {}
+
+    def __merge_ratings(self, previous: SparseRatings, updated: SparseRatings, profiler: Profiler | None = None):
+        """
+        Replaces the ratings of some users by their updated ratings and refreshes the ranks and the recommendations
+        affected by them (see ``update``).
+        :param previous: previous ratings of the users.
+        :param updated: updated ratings of the users.
+        :param profiler: Profiler measuring the stages.
+        """
+
+        with profile(profiler, 'merge', updated.nnz):
+            self.__ratings = self.__ratings.replace_users(updated)
+            self.__product_ratings = f.get_updated_product_ratings(self.__product_ratings, self.__ratings.product_ids,
+                                                                   previous, updated)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'ratings of {updated.n_users} users updated.')
+
+        with profile(profiler, 'aisle ranks', updated.nnz):
+            self.__aisle_ranks = f.replace_rows(self.__aisle_ranks, 'user_id', updated.user_ids,
+                                                f.get_aisle_ranks(updated, self.__product_aisles))
+        with profile(profiler, 'inside-aisle ranks') as stage:
+            product_aisles = f.get_product_aisles(self.__ratings, self.__product_aisles)
+            aisle_ids = np.unique(product_aisles[np.searchsorted(self.__ratings.product_ids, np.union1d(
+                previous.product_ids[previous.indices], updated.product_ids[updated.indices]))])
+            aisle_ids = aisle_ids[aisle_ids >= 0]
+            products = np.flatnonzero(np.isin(product_aisles, aisle_ids))
+            self.__inside_aisle_ranks = f.replace_rows(
+                self.__inside_aisle_ranks, 'aisle_id', aisle_ids,
+                f.rank_products_inside_aisles(self.__ratings.product_ids[products], product_aisles[products],
+                                              self.__product_ratings['rating'].to_numpy()[products]))
+            stage.rows = len(products)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: ranks of {len(aisle_ids)} aisles updated.')
+        with profile(profiler, 'fill index', len(self.__aisle_ranks) + len(self.__inside_aisle_ranks)):
+            self.__fill_index = FillIndex.from_ranks(self.__aisle_ranks, self.__inside_aisle_ranks)
+
+        with profile(profiler, 'materialization') as stage:
+            k_max = self.__recommendations.shape[1]
+            user_index = self.__user_index.replace_users(UserIndex.from_ratings(updated, self.__user_index.k_max))
+            recommendations = np.zeros((len(user_index.user_ids), k_max), dtype=self.__recommendations.dtype)
+            recommendations[np.searchsorted(user_index.user_ids, self.__user_index.user_ids)] = \
+                self.__recommendations
+            # The supplements of the other users may come from the re-ranked aisles
+            rows = np.union1d(np.searchsorted(user_index.user_ids, updated.user_ids),
+                              np.flatnonzero(user_index.sizes < k_max))
+            recommendations[rows] = f.get_recommendation_matrix(user_index.take(rows), self.__fill_index, k_max)
+            self.__user_index, self.__recommendations = user_index, recommendations
+            stage.rows = len(rows)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'recommendations of {len(rows)} users materialized.')
+        print('-----------------------------------------------------------------')
+
+        self.__user_ids = Deferred(self.__list_user_ids)
+        self.__version = next(_versions)
+
+    def load(self, path: str | PathLike, weights: bool = True):
         """
         Loads model state from files in specified directory.
+        Both the columnar format and the legacy pickle format (see ``save``) are recognized.
+        Only the filtering rates are read at once, every table is read on the first access to it.
+        Tables of the columnar format are memory-mapped, so the loading takes milliseconds,
+        and several processes serving the same model share its data in the page cache.
+        To migrate a model from the legacy format, load it and save it again.
         :param path: Path to model directory.
+        :param weights: Load the transactions weights, which are not used for recommendations.
+        Models loaded without weights (for serving only) are saved without them.
         :return:
         """
         if isinstance(path, str):
             path = pathlib.Path(path)
 
+        if (path / self.__MANIFEST_FILE).exists():
+            self.__load_columnar(path, weights)
+        else:
+            self.__load_pickle(path, weights)
+
+        self.__user_ids = Deferred(self.__list_user_ids)
+        self.__product_names = Deferred(self.__build_product_names)
+        self.__product_aisles = Deferred(self.__index_product_aisles)
+        self.__search_points = {}
+        self.__observed = {}
+        self.__version = next(_versions)
+
+        self.__fitted = True
+
+    def __list_user_ids(self) -> [int]:
+        return self.__ratings.user_ids.tolist()
+
+    def __index_product_aisles(self) -> pd.Series:
+        return self.__products.set_index('product_id')['aisle_id']
+
+    def __build_product_ratings(self) -> pd.DataFrame | None:
+        # Models saved before the product ratings were kept restore them from the weights
+        if self.__total_rate <= 0.:
+            return f.get_product_ratings(self.__ratings, self.__ratings.total_ratings())
+        if self.__weights is None:
+            return None
+        return f.get_product_ratings(self.__ratings, f.get_sparse_ratings(self.__weights).total_ratings())
+
+    def __build_fill_index(self) -> FillIndex:
+        return FillIndex.from_ranks(self.__aisle_ranks, self.__inside_aisle_ranks)
+
+    def __build_user_index(self) -> UserIndex:
+        return UserIndex.from_ratings(self.__ratings)
+
+    def __build_recommendations(self) -> np.ndarray:
+        return f.get_recommendation_matrix(self.__user_index, self.__fill_index, self.__user_index.k_max)
+
+    def __build_product_names(self) -> np.ndarray:
+        # The products are read inside the loader, so they stay deferred until the names are needed
+        return f.get_product_names(self.__products)
+
+    @staticmethod
+    def __read_frame(path: pathlib.Path) -> pd.DataFrame:
+        return columns_to_frame(load_columns(path)[0])
+
+    @staticmethod
+    def __read_ratings(path: pathlib.Path) -> SparseRatings:
+        columns, _ = load_columns(path)
+        return SparseRatings(columns['user_ids'], columns['product_ids'],
+                             columns['indptr'], columns['indices'], columns['data'])
+
+    @staticmethod
+    def __read_fill_index(path: pathlib.Path) -> FillIndex:
+        return FillIndex.from_columns(load_columns(path)[0])
+
+    @staticmethod
+    def __read_user_index(path: pathlib.Path) -> UserIndex:
+        columns, attrs = load_columns(path)
+        return UserIndex.from_columns(columns, attrs['k_max'])
+
+    @staticmethod
+    def __read_recommendations(path: pathlib.Path) -> np.ndarray:
+        return load_columns(path)[0]['product_ids']
+
+    @staticmethod
+    def __read_pickled_ratings(file_path: pathlib.Path) -> SparseRatings:
+        return SparseRatings.from_frame(pd.read_pickle(file_path))
+
+    def __load_columnar(self, path: pathlib.Path, weights: bool):
+        """
+        Loads model state saved in the columnar format.
+        """
+
+        with open(path / self.__MANIFEST_FILE) as fp:
+            manifest = json.load(fp)
+        if manifest['format'] != self.__FORMAT or manifest['version'] > self.__FORMAT_VERSION:
+            raise ValueError(f'Unsupported model format {manifest["format"]} of version {manifest["version"]}.')
+
+        self.__days_rate, self.__days_map10 = manifest['days']
+        self.__cart_rate, self.__cart_map10 = manifest['cart']
+        self.__total_rate, self.__total_map10 = manifest['total']
+
+        tables = manifest['tables']
+        self.__weights = Deferred(self.__read_frame, path / 'weights') \
+            if weights and 'weights' in tables else None
+        self.__ratings = Deferred(self.__read_ratings, path / 'ratings')
+        self.__product_ratings = Deferred(self.__read_frame, path / 'product_ratings') \
+            if 'product_ratings' in tables else Deferred(self.__build_product_ratings)
+        self.__aisle_ranks = Deferred(self.__read_frame, path / 'aisle_ranks')
+        self.__inside_aisle_ranks = Deferred(self.__read_frame, path / 'inside_aisle_ranks')
+        self.__products = Deferred(self.__read_frame, path / 'products')
+        self.__fill_index = Deferred(self.__read_fill_index, path / 'fill_index')
+        self.__user_index = Deferred(self.__read_user_index, path / 'user_index') \
+            if 'user_index' in tables else Deferred(self.__build_user_index)
+        self.__recommendations = Deferred(self.__read_recommendations, path / 'recommendations') \
+            if 'recommendations' in tables else Deferred(self.__build_recommendations)
+
+    def __load_pickle(self, path: pathlib.Path, weights: bool):
+        """
+        Loads model state saved in the legacy pickle format.
+        """
+
         file_path = path / 'days.pkl'
         with open(file_path, 'rb') as fp:
             self.__days_rate, self.__days_map10 = pickle.load(fp)
@@ -190,34 +875,96 @@ class Recommender:
             self.__total_rate, self.__total_map10 = pickle.load(fp)
 
         file_path = path / 'weights.zip'
-        self.__weights = pd.read_pickle(file_path)
+        self.__weights = Deferred(pd.read_pickle, file_path) if weights and file_path.exists() else None
 
         file_path = path / 'ratings.zip'
-        self.__ratings = pd.read_pickle(file_path)
+        self.__ratings = Deferred(self.__read_pickled_ratings, file_path)
+
+        file_path = path / 'product_ratings.zip'
+        self.__product_ratings = Deferred(pd.read_pickle, file_path) if file_path.exists() \
+            else Deferred(self.__build_product_ratings)
 
         file_path = path / 'aisle_ranks.zip'
-        self.__aisle_ranks = pd.read_pickle(file_path)
+        self.__aisle_ranks = Deferred(pd.read_pickle, file_path)
 
         file_path = path / 'inside_aisle_ranks.zip'
-        self.__inside_aisle_ranks = pd.read_pickle(file_path)
+        self.__inside_aisle_ranks = Deferred(pd.read_pickle, file_path)
 
         file_path = path / 'products.zip'
-        self.__products = pd.read_pickle(file_path)
+        self.__products = Deferred(pd.read_pickle, file_path)
 
-        self.__user_ids = self.__ratings['user_id'].unique().tolist()
-
-        self.__fitted = True
+        self.__fill_index = Deferred(self.__build_fill_index)
+        self.__user_index = Deferred(self.__build_user_index)
+        self.__recommendations = Deferred(self.__build_recommendations)
 
     @__check_fitted
-    def save(self, path: str | PathLike):
+    def save(self, path: str | PathLike, fmt: str = 'columnar'):
         """
         Saves model state to files in specified directory.
         :param path: Path to model directory.
+        :param fmt: Format of the files:
+        - ``columnar`` - raw little-endian column arrays of the tables with a JSON manifest (``manifest.json``)
+          describing the format version, the filtering rates and the tables.
+        - ``pickle`` - legacy format: zip-compressed pickles of the tables and pickles of the filtering rates.
+        The orders observed by ``observe_order`` are merged into the tables before saving.
         """
 
         if isinstance(path, str):
             path = pathlib.Path(path)
         path.mkdir(exist_ok=True)
+        self.__merge_observed()
+
+        match fmt:
+            case 'columnar':
+                self.__save_columnar(path)
+            case 'pickle':
+                self.__save_pickle(path)
+            case _:
+                raise ValueError(f'Unknown model format `{fmt}`.')
+
+    def __save_columnar(self, path: pathlib.Path):
+        """
+        Saves model state in the columnar format.
+        """
+
+        tables = ['ratings', 'aisle_ranks', 'inside_aisle_ranks', 'products', 'fill_index', 'user_index',
+                  'recommendations']
+        if self.__weights is not None:
+            save_columns(path / 'weights', self.__weights)
+            tables.append('weights')
+        save_columns(path / 'ratings', {
+            'user_ids': self.__ratings.user_ids,
+            'product_ids': self.__ratings.product_ids,
+            'indptr': self.__ratings.indptr,
+            'indices': self.__ratings.indices,
+            'data': self.__ratings.data,
+        })
+        if self.__product_ratings is not None:
+            save_columns(path / 'product_ratings', self.__product_ratings)
+            tables.append('product_ratings')
+        save_columns(path / 'aisle_ranks', self.__aisle_ranks)
+        save_columns(path / 'inside_aisle_ranks', self.__inside_aisle_ranks)
+        save_columns(path / 'products', self.__products)
+        save_columns(path / 'fill_index', self.__fill_index.to_columns())
+        save_columns(path / 'user_index', self.__user_index.to_columns(), {'k_max': self.__user_index.k_max})
+        save_columns(path / 'recommendations', {'product_ids': self.__recommendations})
+
+        # The manifest is written last, so a model directory with a manifest is complete
+        manifest = {
+            'format': self.__FORMAT,
+            'version': self.__FORMAT_VERSION,
+            'days': [self.__days_rate, self.__days_map10],
+            'cart': [self.__cart_rate, self.__cart_map10],
+            'total': [self.__total_rate, self.__total_map10],
+            'tables': tables,
+        }
+        with open(path / self.__MANIFEST_FILE, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+
+    def __save_pickle(self, path: pathlib.Path):
+        """
+        Saves model state in the legacy pickle format.
+        """
 
         file_path = path / 'days.pkl'
         with open(file_path, 'wb') as fp:
@@ -234,11 +981,16 @@ class Recommender:
             # noinspection PyTypeChecker
             pickle.dump((self.__total_rate, self.__total_map10), fp)
 
-        file_path = path / 'weights.zip'
-        self.__weights.to_pickle(file_path)
+        if self.__weights is not None:
+            file_path = path / 'weights.zip'
+            self.__weights.to_pickle(file_path)
 
         file_path = path / 'ratings.zip'
-        self.__ratings.to_pickle(file_path)
+        self.__ratings.to_frame().to_pickle(file_path)
+
+        if self.__product_ratings is not None:
+            file_path = path / 'product_ratings.zip'
+            self.__product_ratings.to_pickle(file_path)
 
         file_path = path / 'aisle_ranks.zip'
         self.__aisle_ranks.to_pickle(file_path)
@@ -250,51 +1002,182 @@ class Recommender:
         self.__products.to_pickle(file_path)
 
     @__check_fitted
-    def recommend(self, user_id: int | list[int] | None = None, k: int = 10) -> (pd.DataFrame, float):
+    def recommend(self, user_id: int | list[int] | None = None, k: int = 10,
+                  ids_only: bool = False, verbose: bool = True) -> (pd.DataFrame, float):
         """
         Generates recommendations for a single/multiple/all users.
         :param user_id: ID of users to get recommendation:
         - `int` - for single user
         - list of `int` - for multiple users
         - `None` - for all users
-        :param k: Size of recommendations.
-        :return: Recommendation as `pandas.Dataframe`.
+        :param k: Size of recommendations. Sizes up to the size of the materialized recommendations
+        (see ``materialize``) are sliced from them.
+        :param ids_only: Return product IDs instead of product names (0 for missing products).
+        :param verbose: Print the progress (e.g. off for serving).
+        :return: Recommendation as `pandas.Dataframe` indexed by user IDs with columns ``product_#1``, ...,
+        ``product_#k`` (missing products are ``None``).
         """
         if isinstance(user_id, list):
             if len(user_id) == 0:
                 user_id = None
 
         if user_id is None:
-            ratings = self.__ratings
-            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
-                  f'predicting {k} products for all users...')
+            if verbose:
+                print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+                      f'predicting {k} products for all users...')
         elif isinstance(user_id, int):
-            ratings = self.__ratings.loc[self.__ratings['user_id'] == user_id]
-            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
-                  f'predicting {k} products for user with {user_id} ID...')
+            if verbose:
+                print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+                      f'predicting {k} products for user with {user_id} ID...')
         elif isinstance(user_id, list):
-            ratings = self.__ratings.loc[self.__ratings['user_id'].isin(user_id)]
-            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
-                  f'predicting {k} products for ({len(user_id)}) users...')
+            if verbose:
+                print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+                      f'predicting {k} products for ({len(user_id)}) users...')
         else:
             raise TypeError()
 
-        prediction = f.get_prediction_table(f.fill_in_prediction(
-            f.get_prediction(ratings, k=k),
-            self.__aisle_ranks, self.__inside_aisle_ranks, k))
-        prediction.reset_index(inplace=True)
-        for column in range(1, k + 1):
-            prediction = prediction.merge(
-                self.__products[['product_id', 'product_name']],
-                left_on=column,
-                right_on='product_id'
-            ).drop(columns=[column, 'product_id']).rename(columns={'product_name': f'product_#{column}'})
-        prediction.sort_values('user_id', inplace=True)
-        prediction.set_index('user_id', inplace=True)
-        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: prediction compiled.')
-        print('-----------------------------------------------------------------')
+        if self.__cache is None or user_id is None:
+            user_ids, product_ids = self.__get_recommendations(user_id, k)
+        else:
+            user_ids, product_ids = self.__get_cached_recommendations(user_id, k)
+        prediction = pd.DataFrame(product_ids if ids_only else f.decode_products(product_ids, self.__product_names),
+                                  index=pd.Index(user_ids, name='user_id'),
+                                  columns=[f'product_#{column}' for column in range(1, k + 1)])
+        if verbose:
+            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: prediction compiled.')
+            print('-----------------------------------------------------------------')
         return prediction
 
+    def __get_recommendations(self, user_id: int | list[int] | None, k: int) -> (np.ndarray, np.ndarray):
+        """
+        Computes the recommendations of single/multiple/all users (see ``recommend``).
+        :return: sorted IDs of the found users and the matrix of the product IDs recommended to them.
+        """
+
+        if user_id is None:
+            rows = np.arange(len(self.__user_index.user_ids))
+        elif isinstance(user_id, int):
+            row = self.__user_index.locate(user_id)
+            rows = np.array([row] if row >= 0 else [], dtype=np.int64)
+        else:
+            rows = self.__user_index.locate_users(user_id)
+
+        user_ids = self.__user_index.user_ids[rows]
+        product_ids = self.__get_recommendation_ids(rows, k, self.__user_index, self.__recommendations,
+                                                    self.__ratings, self.__fill_index)
+        if self.__observed:
+            user_ids, product_ids = self.__apply_observed(user_id, user_ids, product_ids, k)
+        return user_ids, product_ids
+
+    def __get_cached_recommendations(self, user_id: int | list[int], k: int) -> (np.ndarray, np.ndarray):
+        """
+        Takes the recommendations of single/multiple users from the cache and computes the missing ones
+        by a single call (see ``use_cache``).
+        :return: sorted IDs of the found users and the matrix of the product IDs recommended to them.
+        """
+
+        cache, version, observations = self.__cache, self.__version, self.__observations
+        user_ids = [user_id] if isinstance(user_id, int) else list(dict.fromkeys(user_id))
+        cached = cache.get_many(version, user_ids, k)
+        missing = [user_id for user_id in user_ids if user_id not in cached]
+        if missing:
+            found_ids, product_ids = self.__get_recommendations(missing[0] if len(missing) == 1 else missing, k)
+            # an order observed meanwhile may be missed by the computed recommendations, so they are not cached
+            with self.__observed_lock:
+                if observations == self.__observations:
+                    cache.put_many(version, found_ids, product_ids, k)
+        else:
+            found_ids = np.zeros(0, dtype=self.__user_index.user_ids.dtype)
+            product_ids = np.zeros((0, k), dtype=np.int32)
+        if not cached:
+            return found_ids, product_ids
+
+        cached_ids = np.array(sorted(cached), dtype=found_ids.dtype)
+        merged_ids = np.union1d(found_ids, cached_ids)
+        merged_product_ids = np.zeros((len(merged_ids), k), dtype=product_ids.dtype)
+        merged_product_ids[np.searchsorted(merged_ids, found_ids)] = product_ids
+        merged_product_ids[np.searchsorted(merged_ids, cached_ids)] = [cached[user_id]
+                                                                       for user_id in cached_ids.tolist()]
+        return merged_ids, merged_product_ids
+
+    def use_cache(self, cache: RecommendationCache | None):
+        """
+        Caches the recommendations of single and multiple users (see ``RecommendationCache``):
+        the repeated requests are answered from the cache, and the recommendations of the requested users
+        missing in the cache are computed by a single call. The cache is dropped when the model is fitted,
+        loaded, updated or materialized, and the recommendations of a user - when its order is observed.
+        The recommendations of all users are not cached.
+        :param cache: cache (``None`` - stop caching).
+        """
+
+        self.__cache = cache
+
+    @property
+    def version(self) -> int:
+        """
+        Version of the model state, changed when the model is fitted, loaded, updated or materialized.
+        """
+
+        return self.__version
+
+    @staticmethod
+    def __get_recommendation_ids(rows: np.ndarray, k: int, user_index: UserIndex, recommendations: np.ndarray,
+                                 ratings: SparseRatings, fill_index: FillIndex) -> np.ndarray:
+        """
+        Returns the product IDs recommended to users.
+        Sizes up to the size of the materialized recommendations are sliced from them; the users whose own top
+        products are fewer than ``k`` are supplemented again, as the popular aisle products are distributed
+        among ``k`` aisles. Larger sizes are computed from the ratings.
+        :param rows: rows of the users in the user index.
+        :param k: Size of recommendations.
+        :param user_index: user index.
+        :param recommendations: materialized recommendations of the users of the index.
+        :param ratings: product ratings of the users.
+        :param fill_index: offset indexes of the ranks.
+        :return: matrix of product IDs with ``k`` columns (0 for missing products).
+        """
+
+        if k > recommendations.shape[1]:
+            user_index = UserIndex.from_ratings(ratings.take_users(user_index.user_ids[rows]), k)
+            return f.get_recommendation_matrix(user_index, fill_index, k)
+
+        product_ids = recommendations[rows, :k]
+        if k < recommendations.shape[1]:
+            small = user_index.sizes[rows] < k
+            if small.any():
+                product_ids[small] = f.get_recommendation_matrix(user_index.take(rows[small]), fill_index, k)
+        return product_ids
+
+    def __apply_observed(self, requested: int | list[int] | None, user_ids: np.ndarray, product_ids: np.ndarray,
+                         k: int) -> (np.ndarray, np.ndarray):
+        """
+        Replaces the recommendations of the requested users updated by the observed orders
+        (see ``observe_order``) and adds the requested new users.
+        :param requested: ID of the requested users (see ``recommend``).
+        :param user_ids: sorted IDs of the requested users found in the user index.
+        :param product_ids: recommendations of the users.
+        :param k: Size of recommendations.
+        :return: sorted user IDs and their recommendations.
+        """
+
+        observed = self.__observed.copy()
+        requested = observed.keys() if requested is None else [requested] if isinstance(requested, int) else requested
+        users = {user_id: observed[user_id] for user_id in requested if user_id in observed}
+        users = {user_id: user for user_id, user in users.items() if len(user.user_index.user_ids)}
+        if not users:
+            return user_ids, product_ids
+
+        observed_ids = np.array(sorted(users), dtype=user_ids.dtype)
+        observed_product_ids = np.concatenate([
+            self.__get_recommendation_ids(np.zeros(1, dtype=np.int64), k, user.user_index, user.recommendations,
+                                          user.ratings, user.fill_index)
+            for user in (users[user_id] for user_id in observed_ids.tolist())])
+        merged_ids = np.union1d(user_ids, observed_ids)
+        merged_product_ids = np.zeros((len(merged_ids), k), dtype=product_ids.dtype)
+        merged_product_ids[np.searchsorted(merged_ids, user_ids)] = product_ids
+        merged_product_ids[np.searchsorted(merged_ids, observed_ids)] = observed_product_ids
+        return merged_ids, merged_product_ids
+
     @__check_fitted
     def get_rate(self, filtering):
         """
@@ -309,13 +1192,47 @@ class Recommender:
         match filtering:
             case 'days':
                 return self.__days_rate
-            case 'days':
+            case 'cart':
                 return self.__cart_rate
-            case 'days':
+            case 'total':
                 return self.__total_rate
             case _:
                 raise ValueError()
 
+    @__check_fitted
+    def get_evaluations(self, filtering) -> int | None:
+        """
+        Returns the number of MAP@10 evaluations of the optimal rate search.
+        :param filtering: Filtering name:
+        - ``days``- by time.
+        - ``cart`` - by product addition number to cart.
+        - ``total`` - by popularity.
+        - ``joint`` - all the rates by the joint search.
+        :return: number of evaluations (``None`` for a loaded model or another search).
+        """
+
+        if filtering not in self.__FILTERINGS + ('joint',):
+            raise ValueError()
+        return len(self.__search_points[filtering]) if filtering in self.__search_points else None
+
+    @__check_fitted
+    def get_search_points(self, filtering) -> pd.Series | pd.DataFrame | None:
+        """
+        Returns MAP@10 values at the rates evaluated by the optimal rate search.
+        :param filtering: Filtering name:
+        - ``days``- by time.
+        - ``cart`` - by product addition number to cart.
+        - ``total`` - by popularity.
+        - ``joint`` - all the rates by the joint search.
+        :return: Pandas Series with MAP@10 values indexed by the rates, or Pandas DataFrame with columns
+        ``precision``, ``lower`` and ``upper`` of the values and their bootstrap confidence intervals
+        for the search on a validation sample (``None`` for a loaded model or another search).
+        """
+
+        if filtering not in self.__FILTERINGS + ('joint',):
+            raise ValueError()
+        return self.__search_points.get(filtering)
+
     @__check_fitted
     def get_eval_map10(self, filtering):
         """
@@ -330,9 +1247,9 @@ class Recommender:
         match filtering:
             case 'days':
                 return self.__days_map10
-            case 'days':
+            case 'cart':
                 return self.__cart_map10
-            case 'days':
+            case 'total':
                 return self.__total_map10
             case _:
                 raise ValueError()
@@ -9,29 +9,40 @@ from main import GC_BUCKET, GC_DATA_PATH
 
 @st.cache_resource(show_spinner='Loading...')
 def load_recommender(bucket=GC_BUCKET, data_path: str = GC_DATA_PATH) -> recommender.Recommender:
+    # Weights are not used for recommendations, so they are not downloaded.
+    # The tables are read on the first access, so the files are kept for the lifetime of the app.
     file_names = (
         'days.pkl', 'cart.pkl', 'total.pkl',
-        'weights.zip', 'ratings.zip', 'aisle_ranks.zip', 'inside_aisle_ranks.zip',
+        'ratings.zip', 'aisle_ranks.zip', 'inside_aisle_ranks.zip',
         'products.zip'
     )
 
+    model_path = Path('model')
+    model_path.mkdir(exist_ok=True)
     for file_name in file_names:
         file_path = f'{data_path}/model/{file_name}'
         blob = bucket.blob(file_path)
-        blob.download_to_filename(file_name)
+        blob.download_to_filename(model_path / file_name)
 
     model = recommender.Recommender()
-    model.load('.')
-
-    for file_name in file_names:
-        Path(file_name).unlink()
+    model.load(model_path, weights=False)
+    # Recommendations of the selected customers are cached per customer, so adding a customer to the selection
+    # computes only its recommendations.
+    model.use_cache(recommender.RecommendationCache(max_entries=100000, max_bytes=64 * 2 ** 20))
 
     return model
 
 
-@st.cache_data(show_spinner='Generating recommendations...')
+# The model is not hashed, so its version keys the cached tables of a reloaded model apart
+@st.cache_data(show_spinner='Generating recommendations...', max_entries=10)
+def get_all_recommendation(_recommender: recommender.Recommender, version: int, k: int = 10) -> pd.DataFrame:
+    return _recommender.recommend(None, k)
+
+
 def get_recommendation(_recommender: recommender.Recommender,
                        user_ids: int|list[int]|None=None, k: int=10) -> pd.DataFrame:
+    if user_ids is None or isinstance(user_ids, list) and len(user_ids) == 0:
+        return get_all_recommendation(_recommender, _recommender.version, k)
     return _recommender.recommend(user_ids, k)
 
 
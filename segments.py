@@ -0,0 +1,310 @@
+"""
+Offset indexes of tables grouped by integer keys.
+"""
+
+import numpy as np
+import pandas as pd
+from sparse_ratings import get_offsets, expand_segments, merge_segments
+
+
+class Segments:
+    """
+    Rows of a table grouped into contiguous segments by an integer key (e.g. ``user_id``).
+    Keeps the sorted unique keys, the offsets of their segments and the permutation ordering the rows by keys
+    (``None`` when the rows are already ordered). The order of rows with the same key is kept.
+    """
+
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray, order: np.ndarray | None = None):
+        """
+        :param keys: sorted unique keys.
+        :param offsets: offsets of the segments of the keys in the ordered rows.
+        :param order: permutation ordering the rows by keys.
+        """
+
+        self.keys = keys
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def from_keys(cls, keys: np.ndarray) -> 'Segments':
+        """
+        Groups rows by keys.
+        :param keys: key of every row.
+        :return: segments.
+        """
+
+        keys = np.asarray(keys)
+        order = None
+        if len(keys) > 1 and (keys[1:] < keys[:-1]).any():
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+        unique_keys, sizes = np.unique(keys, return_counts=True)
+        return cls(unique_keys, get_offsets(sizes), order)
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, key: str = 'user_id') -> 'Segments':
+        """
+        Groups rows of a table by a key column.
+        :param frame: table.
+        :param key: name of the key column.
+        :return: segments.
+        """
+
+        return cls.from_keys(frame[key].to_numpy())
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """
+        Sizes of the segments.
+        """
+
+        return np.diff(self.offsets)
+
+    def rows(self) -> np.ndarray:
+        """
+        Lists the rows in the segments order.
+        """
+
+        return self.take(np.arange(self.offsets[-1]))
+
+    def positions(self) -> np.ndarray:
+        """
+        Numbers the rows inside their segments (as ``groupby(key).cumcount()``).
+        :return: position of every row inside its segment in the original order of the rows.
+        """
+
+        sizes = self.sizes
+        positions = np.arange(self.offsets[-1]) - np.repeat(self.offsets[:-1], sizes)
+        if self.order is not None:
+            positions[self.order] = positions.copy()
+        return positions
+
+    def segment_ids(self) -> np.ndarray:
+        """
+        Numbers the segments of the rows.
+        :return: position of the segment of every row in the original order of the rows.
+        """
+
+        segment_ids = np.repeat(np.arange(len(self.keys)), self.sizes)
+        if self.order is not None:
+            segment_ids[self.order] = segment_ids.copy()
+        return segment_ids
+
+    def take(self, values: np.ndarray) -> np.ndarray:
+        """
+        Orders values of the rows by segments.
+        :param values: values of the rows in the original order.
+        :return: values in the segments order.
+        """
+
+        return values if self.order is None else values[self.order]
+
+    def locate(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Finds segments of keys.
+        :param keys: keys.
+        :return: positions of the segments of the keys (-1 for unknown keys).
+        """
+
+        keys = np.asarray(keys)
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return np.where(found, positions, -1)
+
+    def heads(self, positions: np.ndarray, n: int) -> (np.ndarray, np.ndarray):
+        """
+        Selects up to ``n`` first rows of the segments.
+        :param positions: positions of the segments (-1 for no segment).
+        :param n: maximum number of rows per segment.
+        :return: number of selected rows of every segment and the concatenated positions of the selected rows
+        in the segments order.
+        """
+
+        found = positions >= 0
+        starts = np.where(found, self.offsets[positions], 0)
+        sizes = np.where(found, np.minimum(self.offsets[positions + 1] - starts, n), 0)
+        return sizes, expand_segments(starts, sizes)
+
+
+class FillIndex:
+    """
+    Offset indexes of the aisle ranks used to fill in predictions (see ``functions.fill_in_prediction``):
+    user -> aisles ordered by ranks, and aisle -> products ordered by ranks inside the aisle.
+    """
+
+    def __init__(self, user_aisles: Segments, aisle_ids: np.ndarray,
+                 aisle_products: Segments, product_ids: np.ndarray):
+        """
+        :param user_aisles: segments of users in ``aisle_ids``.
+        :param aisle_ids: aisle IDs ordered by users and ranks.
+        :param aisle_products: segments of aisles in ``product_ids``.
+        :param product_ids: product IDs ordered by aisles and ranks inside the aisles.
+        """
+
+        self.user_aisles = user_aisles
+        self.aisle_ids = aisle_ids
+        self.aisle_products = aisle_products
+        self.product_ids = product_ids
+
+    @classmethod
+    def from_ranks(cls, aisle_ranks: pd.DataFrame, inside_aisle_ranks: pd.DataFrame) -> 'FillIndex':
+        """
+        Builds the indexes from the ranks tables.
+        :param aisle_ranks: aisle ranks of users sorted by users and ranks.
+        :param inside_aisle_ranks: product ranks inside aisles sorted by aisles and ranks.
+        :return: indexes.
+        """
+
+        user_aisles = Segments.from_keys(aisle_ranks['user_id'].to_numpy())
+        aisle_products = Segments.from_keys(inside_aisle_ranks['aisle_id'].to_numpy())
+        return cls(user_aisles, user_aisles.take(aisle_ranks['aisle_id'].to_numpy()),
+                   aisle_products, aisle_products.take(inside_aisle_ranks['product_id'].to_numpy()))
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray]) -> 'FillIndex':
+        """
+        Restores the indexes from the arrays produced by ``to_columns``.
+        """
+
+        return cls(Segments(columns['user_ids'], columns['user_offsets']), columns['aisle_ids'],
+                   Segments(columns['aisle_keys'], columns['aisle_offsets']), columns['product_ids'])
+
+    def to_columns(self) -> dict[str, np.ndarray]:
+        """
+        Exports the indexes as arrays (e.g. for ``columnar.save_columns``).
+        """
+
+        return {
+            'user_ids': self.user_aisles.keys,
+            'user_offsets': self.user_aisles.offsets,
+            'aisle_ids': self.aisle_ids,
+            'aisle_keys': self.aisle_products.keys,
+            'aisle_offsets': self.aisle_products.offsets,
+            'product_ids': self.product_ids,
+        }
+
+
+class UserIndex:
+    """
+    Fitted-time index of users for fast lookups: user ID -> row of the ratings through a dense lookup table,
+    and the products with the highest ratings of every user (up to ``k_max``) in the CSR form.
+    """
+
+    def __init__(self, user_ids: np.ndarray, top_offsets: np.ndarray, top_product_ids: np.ndarray, k_max: int):
+        """
+        :param user_ids: sorted unique user IDs (rows of the ratings).
+        :param top_offsets: offsets of the users' top products in ``top_product_ids``.
+        :param top_product_ids: top products of the users ordered by descending ratings.
+        :param k_max: maximum number of the top products of a user.
+        """
+
+        self.user_ids = user_ids
+        self.top_offsets = top_offsets
+        self.top_product_ids = top_product_ids
+        self.k_max = k_max
+        self.__rows = None
+
+    @classmethod
+    def from_ratings(cls, ratings, k_max: int = 10) -> 'UserIndex':
+        """
+        Builds the index of sparse ratings.
+        :param ratings: product ratings in the sparse form (``sparse_ratings.SparseRatings``).
+        :param k_max: maximum number of the top products of a user.
+        :return: index.
+        """
+
+        top_offsets, top_product_ids = ratings.top_k(k_max)
+        return cls(ratings.user_ids, top_offsets, top_product_ids, k_max)
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray], k_max: int) -> 'UserIndex':
+        """
+        Restores the index from the arrays produced by ``to_columns``.
+        """
+
+        return cls(columns['user_ids'], columns['top_offsets'], columns['top_product_ids'], k_max)
+
+    def to_columns(self) -> dict[str, np.ndarray]:
+        """
+        Exports the index as arrays (e.g. for ``columnar.save_columns``).
+        """
+
+        return {
+            'user_ids': self.user_ids,
+            'top_offsets': self.top_offsets,
+            'top_product_ids': self.top_product_ids,
+        }
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """
+        Numbers of the top products of the users.
+        """
+
+        return np.diff(self.top_offsets)
+
+    def take(self, rows: np.ndarray) -> 'UserIndex':
+        """
+        Selects the users.
+        :param rows: rows of the users.
+        :return: index of the selected users.
+        """
+
+        sizes = self.top_offsets[rows + 1] - self.top_offsets[rows]
+        return UserIndex(self.user_ids[rows], get_offsets(sizes),
+                         self.top_product_ids[expand_segments(self.top_offsets[rows], sizes)], self.k_max)
+
+    def replace_users(self, user_index: 'UserIndex') -> 'UserIndex':
+        """
+        Replaces the top products of the users by their top products in another index and adds the new users
+        (see ``sparse_ratings.merge_segments``).
+        :param user_index: index of the replaced and the new users with the same ``k_max``.
+        :return: index.
+        """
+
+        user_ids, top_offsets, positions = merge_segments(self.user_ids, self.top_offsets,
+                                                          user_index.user_ids, user_index.top_offsets)
+        return UserIndex(user_ids, top_offsets,
+                         np.concatenate([self.top_product_ids, user_index.top_product_ids])[positions], self.k_max)
+
+    def locate(self, user_id: int) -> int:
+        """
+        Finds the row of the user through the dense lookup table of user IDs
+        (built on the first call if the IDs are compact enough).
+        :param user_id: user ID.
+        :return: row of the user (-1 for an unknown user).
+        """
+
+        if self.__rows is None and len(self.user_ids) and \
+                0 <= self.user_ids[0] and self.user_ids[-1] <= 4 * len(self.user_ids) + (1 << 20):
+            self.__rows = np.full(int(self.user_ids[-1]) + 1, -1, dtype=np.int32)
+            self.__rows[self.user_ids] = np.arange(len(self.user_ids))
+        if self.__rows is not None:
+            return int(self.__rows[user_id]) if 0 <= user_id < len(self.__rows) else -1
+        row = int(np.searchsorted(self.user_ids, user_id))
+        return row if row < len(self.user_ids) and self.user_ids[row] == user_id else -1
+
+    def locate_users(self, user_ids: int | list[int] | np.ndarray) -> np.ndarray:
+        """
+        Finds the rows of users. Unknown users are skipped.
+        :param user_ids: user IDs.
+        :return: rows of the users in ascending order of the IDs.
+        """
+
+        user_ids = np.unique(np.atleast_1d(user_ids))
+        positions = np.searchsorted(self.user_ids, user_ids)
+        found = positions < len(self.user_ids)
+        found[found] = self.user_ids[positions[found]] == user_ids[found]
+        return positions[found]
+
+    def top(self, row: int, k: int) -> np.ndarray:
+        """
+        Returns the top products of the user.
+        :param row: row of the user.
+        :param k: number of products (not greater than ``k_max``).
+        :return: product IDs ordered by descending ratings.
+        """
+
+        start = self.top_offsets[row]
+        return self.top_product_ids[start:min(start + k, self.top_offsets[row + 1])]
@@ -0,0 +1,9 @@
+"""
+HTTP service of the recommendations of a saved model.
+
+Run from the repository folder:
+
+    python -m service model --port 8000 --max-batch 64 --max-wait 2
+"""
+
+from service.server import MicroBatcher, RecommendationService
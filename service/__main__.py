@@ -0,0 +1,20 @@
+import argparse
+import asyncio
+from service.server import RecommendationService
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='HTTP service of the recommendations of a saved model.')
+    parser.add_argument('model', help='Path to the model directory.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host of the service.')
+    parser.add_argument('--port', type=int, default=8000, help='Port of the service.')
+    parser.add_argument('--max-batch', type=int, default=64, help='Maximum number of requests in a batch.')
+    parser.add_argument('--max-wait', type=float, default=2., help='Maximum waiting time of a request, ms.')
+    parser.add_argument('--max-k', type=int, default=100, help='Maximum size of the recommendations.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of threads running the batches.')
+
+    args = parser.parse_args()
+
+    service = RecommendationService(args.model, args.host, args.port, args.max_batch, args.max_wait / 1000,
+                                    args.max_k, args.workers)
+    asyncio.run(service.serve())
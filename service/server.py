@@ -0,0 +1,300 @@
+"""
+Asyncio HTTP service of the recommendations of a saved model with micro-batching of the requests.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import signal
+import time
+import urllib.parse
+from os import PathLike
+from pathlib import Path
+import numpy as np
+from recommender import Recommender
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class RequestError(Exception):
+    """
+    Error of a request answered with the HTTP status.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Coalescer of concurrent single-user recommendation requests: the requests arriving within a short window
+    are answered by a single vectorized ``Recommender.recommend`` call over the list of their users
+    (a call per distinct size of the recommendations). A batch is started when it reaches its maximum size
+    or when its first request has waited for the maximum time.
+    The calls are run on an executor, so the event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, get_model, executor: concurrent.futures.Executor,
+                 max_batch: int = 64, max_wait: float = 0.002):
+        """
+        :param get_model: function returning the current model (it is taken once per batch).
+        :param executor: executor of the model calls.
+        :param max_batch: maximum number of requests in a batch.
+        :param max_wait: maximum waiting time of a request for its batch in seconds.
+        """
+
+        self.__get_model = get_model
+        self.__executor = executor
+        self.__max_batch = max_batch
+        self.__max_wait = max_wait
+        self.__pending = []
+        self.__timer = None
+        self.requests = 0
+        self.batches = 0
+
+    async def recommend(self, user_id: int, k: int) -> np.ndarray | None:
+        """
+        Recommends products to a user.
+        :param user_id: user ID.
+        :param k: size of the recommendations.
+        :return: product IDs (0 for missing products) or ``None`` for an unknown user.
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending.append((user_id, k, future))
+        if len(self.__pending) >= self.__max_batch:
+            self.__flush()
+        elif self.__timer is None:
+            self.__timer = loop.call_later(self.__max_wait, self.__flush)
+        return await future
+
+    def __flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        batch, self.__pending = self.__pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self.__run(batch))
+
+    async def __run(self, batch: list):
+        model = self.__get_model()
+        self.requests += len(batch)
+        self.batches += 1
+        by_sizes = {}
+        for request in batch:
+            by_sizes.setdefault(request[1], []).append(request)
+        loop = asyncio.get_running_loop()
+        for k, requests in by_sizes.items():
+            user_ids = list(dict.fromkeys(user_id for user_id, _, _ in requests))
+            try:
+                prediction = await loop.run_in_executor(
+                    self.__executor, functools.partial(model.recommend, user_ids, k, ids_only=True, verbose=False))
+            except Exception as error:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            rows = dict(zip(prediction.index.tolist(), prediction.to_numpy()))
+            for user_id, _, future in requests:
+                if not future.done():
+                    future.set_result(rows.get(user_id))
+
+
+class RecommendationService:
+    """
+    HTTP/1.1 service of the recommendations of a saved model (see ``Recommender.save``) with the endpoints:
+    - ``GET /recommend?user_id=...&k=...`` - recommended product IDs of a user
+      (``{"user_id": ..., "k": ..., "product_ids": [...]}``); the requests are micro-batched (see ``MicroBatcher``).
+    - ``GET /health`` - status of the service, version and path of the model, numbers of the served requests
+      and of their batches.
+    - ``POST /reload[?path=...]`` - reloads the model (from another directory if the path is given).
+      The new model is loaded and warmed up aside, then replaces the current one; the batches
+      started before are completed by the previous model. ``SIGHUP`` reloads the model as well.
+    """
+
+    def __init__(self, model_path: str | PathLike, host: str = '127.0.0.1', port: int = 8000,
+                 max_batch: int = 64, max_wait: float = 0.002, max_k: int = 100, workers: int = 1):
+        """
+        :param model_path: path to the model directory.
+        :param host: host of the service.
+        :param port: port of the service.
+        :param max_batch: maximum number of requests in a batch.
+        :param max_wait: maximum waiting time of a request for its batch in seconds.
+        :param max_k: maximum size of the recommendations.
+        :param workers: number of threads running the batches.
+        """
+
+        self.__model_path = Path(model_path)
+        self.__host = host
+        self.__port = port
+        self.__max_k = max_k
+        self.__executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='recommend')
+        self.__batcher = MicroBatcher(lambda: self.__model, self.__executor, max_batch, max_wait)
+        self.__reload_lock = None
+        self.__model = None
+        self.__version = 0
+        self.__loaded = None
+        self.__stopping = None
+
+    @staticmethod
+    def __load(path: Path) -> Recommender:
+        """
+        Loads the model for serving (without weights) and reads the tables of the recommendations.
+        """
+
+        model = Recommender()
+        model.load(path, weights=False)
+        if model.users:
+            model.recommend(model.users[0], ids_only=True, verbose=False)
+        return model
+
+    async def reload(self, path: str | PathLike | None = None) -> int:
+        """
+        Reloads the model. The current model is kept if the loading fails.
+        :param path: path to the model directory (the current one by default).
+        :return: version of the loaded model.
+        """
+
+        async with self.__reload_lock:
+            path = self.__model_path if path is None else Path(path)
+            model = await asyncio.get_running_loop().run_in_executor(None, self.__load, path)
+            self.__model, self.__model_path = model, path
+            self.__version += 1
+            self.__loaded = time.time()
+            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+                  f'model {path} loaded (version {self.__version}).')
+            return self.__version
+
+    async def __reload_on_signal(self):
+        try:
+            await self.reload()
+        except Exception as error:
+            print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: model reload failed: {error}')
+
+    async def __route(self, method: str, target: str) -> (int, dict):
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        match url.path:
+            case '/recommend':
+                if method != 'GET':
+                    raise RequestError(405, f'Method {method} is not allowed.')
+                user_id = self.__get_int(params, 'user_id')
+                k = self.__get_int(params, 'k', 10)
+                if not 1 <= k <= self.__max_k:
+                    raise RequestError(400, f'Parameter `k` must be between 1 and {self.__max_k}.')
+                product_ids = await self.__batcher.recommend(user_id, k)
+                if product_ids is None:
+                    raise RequestError(404, f'Unknown user {user_id}.')
+                return 200, {'user_id': user_id, 'k': k, 'product_ids': product_ids[product_ids > 0].tolist()}
+            case '/health':
+                if method != 'GET':
+                    raise RequestError(405, f'Method {method} is not allowed.')
+                return 200, {
+                    'status': 'ok',
+                    'model': str(self.__model_path),
+                    'version': self.__version,
+                    'loaded': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.__loaded)),
+                    'requests': self.__batcher.requests,
+                    'batches': self.__batcher.batches,
+                }
+            case '/reload':
+                if method != 'POST':
+                    raise RequestError(405, f'Method {method} is not allowed.')
+                path = params['path'][-1] if 'path' in params else None
+                try:
+                    version = await self.reload(path)
+                except Exception as error:
+                    raise RequestError(500, f'Model reload failed: {error}')
+                return 200, {'status': 'reloaded', 'model': str(self.__model_path), 'version': version}
+            case _:
+                raise RequestError(404, f'Unknown path {url.path}.')
+
+    @staticmethod
+    def __get_int(params: dict, name: str, default: int | None = None) -> int:
+        if name not in params:
+            if default is None:
+                raise RequestError(400, f'Parameter `{name}` is required.')
+            return default
+        try:
+            return int(params[name][-1])
+        except ValueError:
+            raise RequestError(400, f'Parameter `{name}` must be an integer.')
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves the requests of a connection (kept alive by default as in HTTP/1.1).
+        """
+
+        try:
+            while not self.__stopping.is_set():
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if 'content-length' in headers:
+                    await reader.readexactly(int(headers['content-length']))
+
+                parts = request_line.decode('latin-1').split()
+                keep_alive = len(parts) == 3 and parts[2] == 'HTTP/1.1' \
+                    and headers.get('connection', '').lower() != 'close'
+                try:
+                    if len(parts) != 3:
+                        raise RequestError(400, 'Malformed request line.')
+                    status, body = await self.__route(parts[0], parts[1])
+                except RequestError as error:
+                    status, body = error.status, {'error': str(error)}
+                except Exception as error:
+                    status, body = 500, {'error': f'{type(error).__name__}: {error}'}
+
+                content = json.dumps(body).encode()
+                writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(content)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """
+        Loads the model and serves the requests until ``SIGINT`` or ``SIGTERM``.
+        """
+
+        self.__reload_lock = asyncio.Lock()
+        self.__stopping = asyncio.Event()
+        await self.reload()
+
+        loop = asyncio.get_running_loop()
+        for signal_name, handler in (('SIGINT', self.__stopping.set), ('SIGTERM', self.__stopping.set),
+                                     ('SIGHUP', lambda: loop.create_task(self.__reload_on_signal()))):
+            if hasattr(signal, signal_name):
+                try:
+                    loop.add_signal_handler(getattr(signal, signal_name), handler)
+                except (NotImplementedError, RuntimeError):
+                    pass
+
+        server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: '
+              f'serving on http://{self.__host}:{self.__port}...')
+        async with server:
+            await self.__stopping.wait()
+        self.__executor.shutdown()
+        print(f'{time.strftime("%H:%M:%S", time.localtime(time.time()))}: service stopped.')
+
+    def stop(self):
+        """
+        Stops the service (from the thread of its event loop).
+        """
+
+        self.__stopping.set()
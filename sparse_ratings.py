@@ -0,0 +1,560 @@
+"""
+Sparse representation of product ratings.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def encode_ids(ids: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Codes identifiers by integer indices in ascending order of the identifiers.
+    Small non-negative identifiers are coded in linear time through a dense lookup table,
+    the others through sorting.
+    :param ids: 1D array of integer identifiers.
+    :return: sorted unique identifiers and the codes of the given identifiers.
+    """
+
+    ids = np.asarray(ids)
+    if len(ids) == 0:
+        return ids[:0], np.zeros(0, dtype=np.int64)
+    low, high = ids.min(), ids.max()
+    if ids.dtype.kind in 'iu' and low >= 0 and high <= 4 * len(ids) + (1 << 20):
+        present = np.zeros(int(high) + 1, dtype=bool)
+        present[ids] = True
+        unique_ids = np.flatnonzero(present).astype(ids.dtype)
+        lookup = np.cumsum(present) - 1
+        return unique_ids, lookup[ids]
+    return np.unique(ids, return_inverse=True)
+
+
+def get_offsets(sizes: np.ndarray) -> np.ndarray:
+    """
+    Converts segment sizes into segment offsets.
+    :param sizes: sizes of the segments.
+    :return: offsets of the segments starts (the length is the number of segments plus one).
+    """
+
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def expand_segments(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """
+    Lists the positions of all elements of the segments.
+    :param starts: positions of the segments starts.
+    :param sizes: sizes of the segments.
+    :return: concatenated ranges of the segments positions.
+    """
+
+    return np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+
+
+def merge_segments(keys: np.ndarray, offsets: np.ndarray,
+                   new_keys: np.ndarray, new_offsets: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Replaces the segments of the keys by the new segments of the same keys and inserts the new segments
+    of the other keys. The segments are not compared element by element, so the merge costs a pass over the keys
+    and a copy of the elements.
+    :param keys: sorted unique keys of the segments.
+    :param offsets: offsets of the segments (starting from 0).
+    :param new_keys: sorted unique keys of the new segments.
+    :param new_offsets: offsets of the new segments (starting from 0).
+    :return: sorted unique merged keys, offsets of their segments and positions of their elements
+    in the concatenation of the elements of the segments and the elements of the new segments.
+    """
+
+    positions = np.searchsorted(new_keys, keys)
+    replaced = positions < len(new_keys)
+    replaced[replaced] = new_keys[positions[replaced]] == keys[replaced]
+    kept = np.flatnonzero(~replaced)
+
+    # Both parts are sorted, so the stable sort only merges two runs
+    merged_keys = np.concatenate([keys[kept], new_keys.astype(keys.dtype, copy=False)])
+    order = np.argsort(merged_keys, kind='stable')
+    starts = np.concatenate([offsets[kept], new_offsets[:-1] + offsets[-1]])[order]
+    sizes = np.concatenate([np.diff(offsets)[kept], np.diff(new_offsets)])[order]
+    return merged_keys[order], get_offsets(sizes), expand_segments(starts, sizes)
+
+
+def get_rank_keys(values: np.ndarray, bits: int = 12) -> np.ndarray:
+    """
+    Rounds off the lowest bits of the mantissas of non-negative values, so that the values which differ only
+    by the rounding errors of summation (aggregation orders differ between pandas and numpy) are ranked as equal.
+    :param values: non-negative values.
+    :param bits: number of the rounded off bits of the mantissas (12 bits keep about 12 significant digits).
+    :return: values used as ranking keys.
+    """
+
+    keys = np.asarray(values, dtype=np.float64).view(np.int64)
+    return ((keys + (1 << (bits - 1))) & ~((1 << bits) - 1)).view(np.float64)
+
+
+def rank_segments(offsets: np.ndarray, values: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Ranks non-negative values inside every segment in descending order.
+    Equal values (see ``get_rank_keys``) get the average of their positions (as ``pandas.Series.rank`` does by default)
+    and keep their original order.
+    :param offsets: offsets of the segments.
+    :param values: values to rank.
+    :return: permutation ordering the values by segments and descending values, and the ranks of the values
+    in this order.
+    """
+
+    sizes = np.diff(offsets)
+    segments = np.repeat(np.arange(len(sizes)), sizes)
+    values = get_rank_keys(values)
+    order = np.lexsort((-values, segments))
+    sorted_values = values[order]
+    positions = np.arange(len(order)) - np.repeat(offsets[:-1] - offsets[0], sizes)
+
+    # Groups of equal values inside the segments
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (sorted_values[1:] != sorted_values[:-1]) | (segments[1:] != segments[:-1])
+    firsts = np.flatnonzero(new_group)
+    lasts = np.append(firsts[1:] - 1, len(order) - 1)
+    group_ranks = (positions[firsts] + positions[lasts]) / 2 + 1
+    ranks = np.repeat(group_ranks, lasts - firsts + 1)
+    return order, ranks
+
+
+# Selection methods of the top values inside segments (see ``segment_top_k``)
+TOP_K_METHODS = ('sort', 'partition')
+
+
+def check_top_k(k: int, method: str):
+    """
+    Checks the arguments of the top values selection (see ``segment_top_k``).
+    :param k: maximum number of selected values in a segment.
+    :param method: selection method.
+    :raise ValueError: if ``k`` is not positive or the method is unknown.
+    """
+
+    if k < 1:
+        raise ValueError(f'Number of the selected values must be positive, got {k}.')
+    if method not in TOP_K_METHODS:
+        raise ValueError(f'Unknown top-k selection method `{method}`.')
+
+
+def segment_top_k(offsets: np.ndarray, values: np.ndarray, k: int, method: str = 'partition') -> np.ndarray:
+    """
+    Selects the positions of the ``k`` highest non-negative values inside every segment.
+    Equal values (see ``get_rank_keys``) are ordered by their positions.
+    :param offsets: offsets of the segments.
+    :param values: values.
+    :param k: maximum number of selected values in a segment.
+    :param method: selection method:
+    - ``'partition'`` - partial selection inside segments: segments longer than ``k`` are grouped into blocks
+      of similar length, and ``np.partition`` finds the threshold values of all segments of a block at once.
+    - ``'sort'`` - sorting of all values by segments and values.
+    :return: positions of the selected values ordered by segments and descending values.
+    """
+
+    check_top_k(k, method)
+    keys = get_rank_keys(values)
+    sizes = np.diff(offsets)
+    segments = np.repeat(np.arange(len(sizes)), sizes)
+    if method == 'sort':
+        order = np.lexsort((-keys, segments))
+        positions = np.arange(len(order)) - np.repeat(offsets[:-1] - offsets[0], sizes)
+        return order[positions < k]
+
+    # Segments not longer than k are selected entirely
+    short = np.flatnonzero(sizes <= k)
+    selected = [expand_segments(offsets[short] - offsets[0], sizes[short])]
+
+    # Long segments are padded up to a power of two and partitioned by blocks of the same padded length
+    long = np.flatnonzero(sizes > k)
+    widths = 1 << np.ceil(np.log2(sizes[long])).astype(int)
+    for width in np.unique(widths):
+        rows = long[widths == width]
+        columns = np.arange(width)
+        valid = columns < sizes[rows, None]
+        block_positions = np.where(valid, offsets[rows, None] - offsets[0] + columns, 0)
+        block = np.where(valid, keys[block_positions], -np.inf)
+        thresholds = -np.partition(-block, k - 1, axis=1)[:, k - 1:k]
+        greater = block > thresholds
+        equal = block == thresholds
+        equal_needed = k - greater.sum(axis=1, keepdims=True)
+        selected.append(block_positions[greater | (equal & (np.cumsum(equal, axis=1) <= equal_needed))])
+
+    selected = np.concatenate(selected)
+    return selected[np.lexsort((selected, -keys[selected], segments[selected]))]
+
+
+class SparseRatings:
+    """
+    Product ratings of users as a sparse user x product matrix in the CSR form.
+    Users and products are coded by integer indices: row ``i`` belongs to user ``user_ids[i]``,
+    column ``j`` belongs to product ``product_ids[j]``.
+    Inside every row the products are ordered by their codes.
+    """
+
+    def __init__(self, user_ids: np.ndarray, product_ids: np.ndarray,
+                 indptr: np.ndarray, indices: np.ndarray, data: np.ndarray):
+        """
+        :param user_ids: sorted unique user IDs (row labels).
+        :param product_ids: sorted unique product IDs (column labels).
+        :param indptr: offsets of the rows in ``indices`` and ``data``.
+        :param indices: product codes of the non-zero ratings.
+        :param data: non-zero ratings.
+        """
+
+        self.user_ids = user_ids
+        self.product_ids = product_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def from_arrays(cls, user_ids: np.ndarray, product_ids: np.ndarray, weights: np.ndarray) -> 'SparseRatings':
+        """
+        Aggregates product weights of users into ratings in a single pass.
+        :param user_ids: user IDs of the weights.
+        :param product_ids: product IDs of the weights.
+        :param weights: product weights.
+        :return: ratings.
+        """
+
+        unique_user_ids, user_codes = encode_ids(user_ids)
+        unique_product_ids, product_codes = encode_ids(product_ids)
+        n_products = len(unique_product_ids)
+        pair_keys, pair_codes = encode_ids(user_codes.astype(np.int64) * n_products + product_codes)
+        data = np.bincount(pair_codes, weights=weights, minlength=len(pair_keys))
+        rows = pair_keys // max(n_products, 1)
+        indptr = get_offsets(np.bincount(rows, minlength=len(unique_user_ids)))
+        indices = (pair_keys - rows * n_products).astype(np.int32)
+        return cls(unique_user_ids, unique_product_ids, indptr, indices, data)
+
+    @classmethod
+    def from_parts(cls, parts: list['SparseRatings']) -> 'SparseRatings':
+        """
+        Sums ratings of parts of the weights (e.g. chunks of a transaction log) into ratings.
+        :param parts: ratings of the parts.
+        :return: ratings.
+        """
+
+        return cls.from_arrays(np.concatenate([part.user_ids[part.rows] for part in parts]),
+                               np.concatenate([part.product_ids[part.indices] for part in parts]),
+                               np.concatenate([part.data for part in parts]))
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, column: str = 'rating') -> 'SparseRatings':
+        """
+        Builds ratings from a long-format dataframe.
+        :param frame: dataframe with columns ``user_id``, ``product_id`` and the values column.
+        :param column: name of the values column.
+        :return: ratings.
+        """
+
+        return cls.from_arrays(frame['user_id'].to_numpy(), frame['product_id'].to_numpy(),
+                               frame[column].to_numpy())
+
+    @property
+    def n_users(self) -> int:
+        """
+        Number of users (rows).
+        """
+
+        return len(self.user_ids)
+
+    @property
+    def n_products(self) -> int:
+        """
+        Number of products (columns).
+        """
+
+        return len(self.product_ids)
+
+    @property
+    def nnz(self) -> int:
+        """
+        Number of non-zero ratings.
+        """
+
+        return len(self.indices)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory occupied by the arrays of the ratings.
+        """
+
+        return sum(array.nbytes for array in (self.user_ids, self.product_ids, self.indptr, self.indices, self.data))
+
+    @property
+    def rows(self) -> np.ndarray:
+        """
+        User codes of the non-zero ratings.
+        """
+
+        return np.repeat(np.arange(self.n_users), np.diff(self.indptr))
+
+    def with_data(self, data: np.ndarray) -> 'SparseRatings':
+        """
+        Creates ratings with the same structure and other values.
+        :param data: new non-zero ratings.
+        :return: ratings.
+        """
+
+        return SparseRatings(self.user_ids, self.product_ids, self.indptr, self.indices, data)
+
+    def total_ratings(self) -> np.ndarray:
+        """
+        Calculates the ratings of products among all users (see ``functions.get_total_ratings``).
+        :return: ratings of products ordered by product codes.
+        """
+
+        return np.bincount(self.indices, weights=self.data, minlength=self.n_products) / max(self.n_users, 1)
+
+    def with_total_rate(self, total_rate: float, total_ratings: np.ndarray | None = None) -> 'SparseRatings':
+        """
+        Filters ratings by popularity of products.
+        :param total_rate: popularity filtering rate.
+        :param total_ratings: ratings of products among all users (calculated from these ratings by default).
+        :return: ratings.
+        """
+
+        if total_rate <= 0.:
+            return self
+        if total_ratings is None:
+            total_ratings = self.total_ratings()
+        return self.with_data(self.data * np.exp(total_ratings[self.indices] * total_rate))
+
+    def take_users(self, user_ids: int | list[int] | np.ndarray) -> 'SparseRatings':
+        """
+        Selects the ratings of the given users. Unknown users are skipped.
+        :param user_ids: user IDs.
+        :return: ratings with the rows of the given users in ascending order of the IDs.
+        """
+
+        # The IDs are cast to the type of the users, so the search does not convert all users
+        user_ids = np.unique(np.atleast_1d(user_ids).astype(self.user_ids.dtype, copy=False))
+        positions = np.searchsorted(self.user_ids, user_ids)
+        found = positions < self.n_users
+        found[found] = self.user_ids[positions[found]] == user_ids[found]
+        rows = positions[found]
+        starts, sizes = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+        entries = expand_segments(starts, sizes)
+        return SparseRatings(self.user_ids[rows], self.product_ids, get_offsets(sizes),
+                             self.indices[entries], self.data[entries])
+
+    def replace_users(self, ratings: 'SparseRatings') -> 'SparseRatings':
+        """
+        Replaces the rows of the users by their rows in other ratings and adds the rows of the new users
+        (see ``merge_segments``). Products of the other ratings are added to the products.
+        :param ratings: ratings of the replaced and the new users.
+        :return: ratings.
+        """
+
+        product_ids = np.union1d(self.product_ids, ratings.product_ids).astype(self.product_ids.dtype, copy=False)
+        indices = self.indices if len(product_ids) == self.n_products \
+            else np.searchsorted(product_ids, self.product_ids).astype(np.int32)[self.indices]
+        user_ids, indptr, positions = merge_segments(self.user_ids, self.indptr, ratings.user_ids, ratings.indptr)
+        indices = np.concatenate([indices,
+                                  np.searchsorted(product_ids, ratings.product_ids).astype(np.int32)[ratings.indices]])
+        return SparseRatings(user_ids, product_ids, indptr, indices[positions],
+                             np.concatenate([self.data, ratings.data])[positions])
+
+    def top_k(self, k: int = 10, method: str = 'partition') -> (np.ndarray, np.ndarray):
+        """
+        Selects the products with the highest ratings in every row.
+        Products with equal ratings (see ``get_rank_keys``) are ordered by product IDs.
+        :param k: maximum number of products in a row.
+        :param method: selection method (see ``segment_top_k``).
+        :return: offsets of the rows and product IDs in the CSR form, ordered by descending ratings inside the rows.
+        """
+
+        selected = segment_top_k(self.indptr, self.data, k, method)
+        return get_offsets(np.minimum(np.diff(self.indptr), k)), self.product_ids[self.indices[selected]]
+
+    def aggregate_products(self, group_ids: np.ndarray) -> 'SparseRatings':
+        """
+        Sums the ratings of products by groups of products (e.g. aisles) for every user.
+        Products which are not assigned to any group are skipped.
+        :param group_ids: group ID of every product ordered by product codes (negative values for no group).
+        :return: ratings of the groups of products.
+        """
+
+        groups = group_ids[self.indices]
+        assigned = groups >= 0
+        return SparseRatings.from_arrays(self.user_ids[self.rows[assigned]], groups[assigned], self.data[assigned])
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Converts ratings into a long-format dataframe.
+        :return: dataframe with columns ``user_id``, ``product_id``, ``rating``.
+        """
+
+        return pd.DataFrame({
+            'user_id': self.user_ids[self.rows],
+            'product_id': self.product_ids[self.indices],
+            'rating': self.data,
+        })
+
+
+def encode_pairs(user_ids: np.ndarray, product_ids: np.ndarray) -> ('SparseRatings', np.ndarray):
+    """
+    Encodes user-product pairs of transactions.
+    :param user_ids: user IDs of the transactions.
+    :param product_ids: product IDs of the transactions.
+    :return: ratings defining users, products and user-product pairs (without values)
+    and the pair code (position in the ratings) of every transaction.
+    """
+
+    unique_user_ids, user_codes = encode_ids(user_ids)
+    unique_product_ids, product_codes = encode_ids(product_ids)
+    n_products = len(unique_product_ids)
+    pair_keys, pair_codes = encode_ids(user_codes.astype(np.int64) * n_products + product_codes)
+    rows = pair_keys // max(n_products, 1)
+    structure = SparseRatings(unique_user_ids, unique_product_ids,
+                              get_offsets(np.bincount(rows, minlength=len(unique_user_ids))),
+                              (pair_keys - rows * n_products).astype(np.int32), np.zeros(0))
+    return structure, pair_codes
+
+
+class RatingsHistogram:
+    """
+    Product ratings of users stored as histograms of a transaction attribute with small number of distinct values
+    (days before the last order, add to cart order).
+    Every user-product pair keeps the total weight of its transactions for every value of the attribute,
+    so the rating of the pair for any filter rate is a dot product of the histogram with ``exp(-values * rate)``.
+    Once the histograms are built, ratings for a new rate cost a pass over the histogram entries
+    instead of a recomputation of the weights and a regrouping of all transactions.
+    """
+
+    def __init__(self, structure: SparseRatings, values: np.ndarray,
+                 pair_codes: np.ndarray, value_codes: np.ndarray, weights: np.ndarray):
+        """
+        :param structure: ratings defining users, products and user-product pairs (their values are not used).
+        :param values: sorted distinct values of the attribute.
+        :param pair_codes: pair code (position in the ratings) of every histogram entry.
+        :param value_codes: attribute value code of every histogram entry.
+        :param weights: total weight of every histogram entry.
+        """
+
+        self.structure = structure
+        self.values = values
+        self.pair_codes = pair_codes
+        self.value_codes = value_codes
+        self.weights = weights
+
+    @classmethod
+    def from_arrays(cls, user_ids: np.ndarray, product_ids: np.ndarray, values: np.ndarray,
+                    weights: np.ndarray | None = None) -> 'RatingsHistogram':
+        """
+        Builds histograms from transactions.
+        :param user_ids: user IDs of the transactions.
+        :param product_ids: product IDs of the transactions.
+        :param values: values of the attribute in the transactions.
+        :param weights: weights of the transactions (ones by default).
+        :return: histograms.
+        """
+
+        if weights is None:
+            weights = np.ones(len(user_ids))
+        structure, pair_codes = encode_pairs(user_ids, product_ids)
+
+        unique_values, value_codes = encode_ids(values)
+        n_values = len(unique_values)
+        entry_keys, entry_codes = encode_ids(pair_codes * n_values + value_codes)
+        entry_weights = np.bincount(entry_codes, weights=weights, minlength=len(entry_keys))
+        return cls(structure, unique_values, entry_keys // n_values, entry_keys % n_values, entry_weights)
+
+    @property
+    def n_entries(self) -> int:
+        """
+        Number of non-zero histogram entries.
+        """
+
+        return len(self.weights)
+
+    def ratings(self, rate: float) -> SparseRatings:
+        """
+        Calculates the ratings filtered by the attribute with the given rate.
+        :param rate: filter rate.
+        :return: ratings.
+        """
+
+        factors = np.exp(-self.values.astype(np.float64) * rate)
+        data = np.bincount(self.pair_codes, weights=self.weights * factors[self.value_codes],
+                           minlength=self.structure.nnz)
+        return self.structure.with_data(data)
+
+
+class JointRatingsHistogram:
+    """
+    Product ratings of users stored as joint histograms of several transaction attributes
+    (days before the last order and add to cart order), which allow to recalculate the ratings
+    for any combination of the filter rates by the attributes (see ``RatingsHistogram``).
+    """
+
+    def __init__(self, structure: SparseRatings, values: list[np.ndarray],
+                 pair_codes: np.ndarray, value_codes: list[np.ndarray], weights: np.ndarray):
+        """
+        :param structure: ratings defining users, products and user-product pairs (their values are not used).
+        :param values: sorted distinct values of every attribute.
+        :param pair_codes: pair code (position in the ratings) of every histogram entry.
+        :param value_codes: value codes of every attribute of every histogram entry.
+        :param weights: total weight of every histogram entry.
+        """
+
+        self.structure = structure
+        self.values = values
+        self.pair_codes = pair_codes
+        self.value_codes = value_codes
+        self.weights = weights
+
+    @classmethod
+    def from_arrays(cls, user_ids: np.ndarray, product_ids: np.ndarray, values: list[np.ndarray],
+                    weights: np.ndarray | None = None) -> 'JointRatingsHistogram':
+        """
+        Builds histograms from transactions.
+        :param user_ids: user IDs of the transactions.
+        :param product_ids: product IDs of the transactions.
+        :param values: values of every attribute in the transactions.
+        :param weights: weights of the transactions (ones by default).
+        :return: histograms.
+        """
+
+        if weights is None:
+            weights = np.ones(len(user_ids))
+        structure, pair_codes = encode_pairs(user_ids, product_ids)
+
+        entry_keys = pair_codes.astype(np.int64)
+        unique_values = []
+        for attribute_values in values:
+            attribute_unique_values, attribute_codes = encode_ids(attribute_values)
+            unique_values.append(attribute_unique_values)
+            entry_keys = entry_keys * len(attribute_unique_values) + attribute_codes
+        entry_keys, entry_codes = encode_ids(entry_keys)
+        entry_weights = np.bincount(entry_codes, weights=weights, minlength=len(entry_keys))
+
+        value_codes = []
+        for attribute_unique_values in reversed(unique_values):
+            value_codes.append(entry_keys % len(attribute_unique_values))
+            entry_keys = entry_keys // len(attribute_unique_values)
+        return cls(structure, unique_values, entry_keys, value_codes[::-1], entry_weights)
+
+    @property
+    def n_entries(self) -> int:
+        """
+        Number of non-zero histogram entries.
+        """
+
+        return len(self.weights)
+
+    def ratings(self, rates: list[float]) -> SparseRatings:
+        """
+        Calculates the ratings filtered by the attributes with the given rates.
+        :param rates: filter rate of every attribute.
+        :return: ratings.
+        """
+
+        weights = self.weights
+        for values, codes, rate in zip(self.values, self.value_codes, rates):
+            if rate > 0.:
+                weights = weights * np.exp(-values.astype(np.float64) * rate)[codes]
+        data = np.bincount(self.pair_codes, weights=weights, minlength=self.structure.nnz)
+        return self.structure.with_data(data)
@@ -0,0 +1,66 @@
+"""
+Fixtures of the tests: a small synthetic transaction log (see ``benchmarks.generator``) split into the history
+of a fitted model and a batch of new orders.
+"""
+
+import contextlib
+import io
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.generator import generate_instacart
+from recommender import Recommender
+
+
+@pytest.fixture(scope='session')
+def log() -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """
+    Products registry, the whole transaction log, the fitted part of the log and the batch of new orders:
+    the last 0-2 orders of the users and all orders of a few new users.
+    """
+
+    products, transactions = generate_instacart(400, n_products=2000, seed=1)
+    # The new orders of the same day are numbered apart by the incremental preprocessing, unlike the full one
+    # (see ``functions.preprocess_new_transactions``), so the log has no such orders
+    gaps = transactions['days_since_prior_order']
+    transactions['days_since_prior_order'] = gaps.mask(gaps == 0, 1.)
+
+    rng = np.random.default_rng(0)
+    user_ids = transactions['user_id'].unique()
+    new_orders = pd.Series(rng.integers(0, 3, len(user_ids)), index=user_ids)
+    new_user_ids = user_ids[rng.random(len(user_ids)) < 0.05]
+    last_orders = transactions.groupby('user_id')['order_number'].transform('max')
+    in_batch = (transactions['order_number'] > last_orders - transactions['user_id'].map(new_orders)) \
+        | transactions['user_id'].isin(new_user_ids)
+    return products, transactions, transactions[~in_batch], transactions[in_batch]
+
+
+@pytest.fixture(scope='session')
+def model_path(log, tmp_path_factory) -> Path:
+    """
+    Path to the model fitted on the history.
+    """
+
+    products, _, history, _ = log
+    path = tmp_path_factory.mktemp('model')
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = Recommender()
+        model.fit(products, history.copy(), workers=1, executor='serial')
+        model.save(path)
+    return path
+
+
+def load_model(path: Path) -> Recommender:
+    """
+    Loads a model without the progress output.
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = Recommender()
+        model.load(path)
+    return model
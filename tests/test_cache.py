@@ -0,0 +1,43 @@
+"""
+Tests of the cache of the recommendations (``recommender.RecommendationCache``).
+"""
+
+import contextlib
+import io
+import numpy as np
+from recommender import RecommendationCache
+from conftest import load_model
+
+
+def test_cache_follows_model(log, model_path):
+    _, _, _, batch = log
+    model = load_model(model_path)
+    expected = load_model(model_path)
+    cache = RecommendationCache()
+    model.use_cache(cache)
+    user_ids = batch['user_id'].unique().tolist()[:50]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.recommend(user_ids[:20], 10)
+        assert model.recommend(user_ids, 10).equals(expected.recommend(user_ids, 10))
+        assert cache.hits == 20 and cache.misses == len(user_ids)
+
+        version = model.version
+        model.update(batch)
+        expected.update(batch)
+        assert model.version != version
+        assert model.recommend(user_ids, 10).equals(expected.recommend(user_ids, 10))
+
+        products = expected.recommend(user_ids[1], 10, ids_only=True).iloc[0]
+        model.observe_order(user_ids[0], products[products > 0].to_numpy(), 1.)
+        expected.observe_order(user_ids[0], products[products > 0].to_numpy(), 1.)
+        assert model.recommend(user_ids, 10).equals(expected.recommend(user_ids, 10))
+
+
+def test_cache_limits():
+    cache = RecommendationCache(max_entries=3)
+    cache.put_many(1, np.arange(5), np.ones((5, 10), dtype=np.int32), 10)
+    assert len(cache) == 3
+    assert sorted(cache.get_many(1, list(range(5)), 10)) == [2, 3, 4]
+    assert cache.get_many(2, [4], 10) == {}
+    assert len(cache) == 0
@@ -0,0 +1,29 @@
+"""
+Tests of the online ingestion of orders by a model (``Recommender.observe_order``).
+"""
+
+import contextlib
+import io
+import numpy as np
+from conftest import load_model
+
+
+def test_observe_order_matches_update(log, model_path, tmp_path):
+    _, _, _, batch = log
+    updated = load_model(model_path)
+    observed = load_model(model_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        updated.update(batch)
+
+    orders = batch.sort_values(['user_id', 'order_number', 'add_to_cart_order']) \
+        .groupby(['user_id', 'order_number'], sort=False)
+    for (user_id, _), order in orders:
+        days = order['days_since_prior_order'].iloc[0]
+        observed.observe_order(int(user_id), order['product_id'].to_numpy(), 0. if np.isnan(days) else days)
+
+    # The observed orders merged into the model tables match the update
+    with contextlib.redirect_stdout(io.StringIO()):
+        observed.save(tmp_path / 'observed')
+    merged = load_model(tmp_path / 'observed')
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert merged.recommend(None, 10, ids_only=True).equals(updated.recommend(None, 10, ids_only=True))
@@ -0,0 +1,55 @@
+"""
+Tests of the solution file writer (``functions.save_kaggle_submission_csv``).
+"""
+
+import gzip
+import numpy as np
+import pandas as pd
+import pytest
+import functions as f
+
+
+def save_with_pandas(prediction: pd.DataFrame, file_path):
+    # The writer formatting the rows by pandas cell by cell
+    f.get_prediction_table(prediction) \
+        .map(str) \
+        .apply(list, axis=1) \
+        .str.join(' ') \
+        .rename('product_id') \
+        .to_frame() \
+        .to_csv(file_path)
+
+
+@pytest.fixture
+def prediction() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    user_ids = np.sort(rng.choice(10 ** 6, 500, replace=False))
+    sizes = rng.integers(1, 11, len(user_ids))
+    product_ids = rng.integers(1, 50000, sizes.sum())
+    product_ids[::7] = 0
+    return pd.DataFrame({'user_id': np.repeat(user_ids, sizes), 'product_id': product_ids})
+
+
+def test_matches_pandas(prediction, tmp_path):
+    save_with_pandas(prediction, tmp_path / 'expected.csv')
+    expected = (tmp_path / 'expected.csv').read_bytes()
+    table = f.get_prediction_table(prediction)
+
+    f.save_kaggle_submission_csv(prediction, tmp_path / 'long.csv', chunk_size=64)
+    f.save_kaggle_submission_csv(table, tmp_path / 'table.csv')
+    f.save_kaggle_submission_csv(table.to_numpy(), tmp_path / 'matrix.csv.gz', user_ids=table.index.to_numpy())
+    assert (tmp_path / 'long.csv').read_bytes() == expected
+    assert (tmp_path / 'table.csv').read_bytes() == expected
+    assert gzip.decompress((tmp_path / 'matrix.csv.gz').read_bytes()) == expected
+
+
+def test_edge_cases(tmp_path):
+    f.save_kaggle_submission_csv(pd.DataFrame({'user_id': [0, 5], 'product_id': [0, 7]}), tmp_path / 'zeros.csv')
+    assert (tmp_path / 'zeros.csv').read_text() == 'user_id,product_id\n0,0\n5,7\n'
+    f.save_kaggle_submission_csv(np.zeros((0, 10), dtype=np.int32), tmp_path / 'empty.csv',
+                                 user_ids=np.zeros(0, dtype=np.int64))
+    assert (tmp_path / 'empty.csv').read_text() == 'user_id,product_id\n'
+    with pytest.raises(ValueError):
+        f.save_kaggle_submission_csv(np.array([[-1]]), tmp_path / 'negative.csv', user_ids=np.array([1]))
+    with pytest.raises(ValueError):
+        f.save_kaggle_submission_csv(np.array([[1]]), tmp_path / 'missing.csv')
@@ -0,0 +1,84 @@
+"""
+Tests of the incremental update of a model by a batch of new orders (``Recommender.update``).
+"""
+
+import contextlib
+import io
+import numpy as np
+import pandas as pd
+import functions as f
+from segments import FillIndex, UserIndex
+from sparse_ratings import SparseRatings, merge_segments
+from conftest import load_model
+
+
+def get_random_ratings(rng: np.random.Generator, user_ids: np.ndarray) -> SparseRatings:
+    sizes = rng.integers(1, 6, len(user_ids))
+    return SparseRatings.from_arrays(np.repeat(user_ids, sizes), rng.integers(1, 30, sizes.sum()),
+                                     rng.random(sizes.sum()))
+
+
+def test_merge_segments():
+    rng = np.random.default_rng(0)
+    keys = np.sort(rng.choice(100, 40, replace=False))
+    new_keys = np.sort(rng.choice(100, 20, replace=False))
+    offsets = f.get_offsets(rng.integers(0, 4, len(keys)))
+    new_offsets = f.get_offsets(rng.integers(0, 4, len(new_keys)))
+    elements = np.arange(offsets[-1] + new_offsets[-1])
+
+    segments = {key: elements[offsets[i]:offsets[i + 1]] for i, key in enumerate(keys)}
+    segments.update({key: elements[offsets[-1] + new_offsets[i]:offsets[-1] + new_offsets[i + 1]]
+                     for i, key in enumerate(new_keys)})
+    merged_keys, merged_offsets, positions = merge_segments(keys, offsets, new_keys, new_offsets)
+
+    assert merged_keys.tolist() == sorted(segments)
+    assert np.array_equal(merged_offsets, f.get_offsets([len(segments[key]) for key in merged_keys.tolist()]))
+    assert np.array_equal(positions, np.concatenate([segments[key] for key in merged_keys.tolist()]))
+
+
+def test_replace_users():
+    rng = np.random.default_rng(1)
+    ratings = get_random_ratings(rng, np.arange(1, 60, 2))
+    new_ratings = get_random_ratings(rng, np.arange(40, 80, 3))
+
+    replaced = ratings.replace_users(new_ratings).to_frame()
+    frame = ratings.to_frame()
+    expected = pd.concat([frame.loc[~frame['user_id'].isin(new_ratings.user_ids)], new_ratings.to_frame()]) \
+        .sort_values(['user_id', 'product_id'], ignore_index=True)
+    pd.testing.assert_frame_equal(replaced, expected, check_dtype=False)
+
+
+def test_replace_rows():
+    table = pd.DataFrame({'user_id': [1, 1, 2, 4, 4, 6], 'rank': [1, 2, 1, 1, 2, 1]})
+    rows = pd.DataFrame({'user_id': [2, 2, 3, 6], 'rank': [1, 2, 1, 1]})
+    replaced = f.replace_rows(table, 'user_id', np.array([2, 3, 6]), rows)
+    assert replaced['user_id'].tolist() == [1, 1, 2, 2, 3, 4, 4, 6]
+    assert replaced['rank'].tolist() == [1, 2, 1, 2, 1, 1, 2, 1]
+
+
+def test_update_matches_recompute(log, model_path):
+    products, transactions, history, batch = log
+    model = load_model(model_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.update(batch)
+        recommendations = model.recommend(None, 10, ids_only=True)
+    days_rate, cart_rate, total_rate = model.get_rate('days'), model.get_rate('cart'), model.get_rate('total')
+
+    # Ratings of the whole log with the popularity of products in the history
+    def get_frequencies(log: pd.DataFrame) -> SparseRatings:
+        prior_transactions, last_transactions, _ = f.preprocess_transactions(log.copy())
+        return f.get_sparse_ratings(pd.concat([
+            f.get_weights(prior_transactions, days_rate, cart_rate, shifted=True),
+            f.get_weights(last_transactions, days_rate, cart_rate),
+        ], ignore_index=True))
+
+    fitted = get_frequencies(history)
+    frequencies = get_frequencies(transactions)
+    total_ratings = pd.Series(fitted.total_ratings(), index=fitted.product_ids) \
+        .reindex(frequencies.product_ids, fill_value=0.).to_numpy()
+    ratings = frequencies.with_total_rate(total_rate, total_ratings)
+
+    fill_index = FillIndex.from_ranks(f.get_aisle_ranks(ratings, products), f.get_inside_aisle_ranks(ratings, products))
+    expected = f.get_recommendation_matrix(UserIndex.from_ratings(ratings), fill_index, 10)
+    assert np.array_equal(recommendations.index.to_numpy(), ratings.user_ids)
+    assert np.array_equal(recommendations.to_numpy(), expected)